@@ -0,0 +1,218 @@
+#    (C) Copyright 2015-2021 Sei Lisa. All rights reserved.
+#
+#    This file is part of LSL PyOptimizer.
+#
+#    LSL PyOptimizer is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    LSL PyOptimizer is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with LSL PyOptimizer. If not, see <http://www.gnu.org/licenses/>.
+
+# Interface for using the optimizer from other Python programs.
+#
+# Example:
+#
+#     from lslopt.lslapi import Library, optimize_source
+#     lib = Library()
+#     result = optimize_source(script, '-dcr,+shrinknames', lib)
+#     if result.output is None:
+#         for d in result.diagnostics:
+#             print(d)
+#
+# The library should be created once and reused for every script; it can be
+# shared by several threads. The external preprocessor is not run; the source
+# is expected to be already preprocessed if the processpre option is used.
+
+import threading
+from lslopt import lslcommon, lslloadlib, lsltimings
+from lslopt.lslparse import parser, EParse
+from lslopt.lsloptimizer import optimizer
+from lslopt.lsloutput import outscript
+from strutil import *
+
+validoptions = frozenset({'extendedglobalexpr','breakcont','extendedtypecast',
+    'extendedassignment','allowkeyconcat','allowmultistrings','duplabels',
+    'lazylists','enableswitch','errmissingdefault','funcoverride','optimize',
+    'optsigns','optfloats','constfold','dcr','shrinknames','addstrings',
+    'foldtabs','warntabs','processpre','explicitcast','listlength','listadd',
+    'inline', 'cse', 'cseall', 'licm', 'speed', 'balanced', 'help',
+    # undocumented
+    'lso','expr','rsrclimit',
+    # 'clear' is handled as a special case
+    # 'prettify' is internal, as it's a user flag
+})
+
+defaultoptions = frozenset({'extendedglobalexpr','extendedtypecast',
+    'extendedassignment','allowkeyconcat','allowmultistrings','processpre',
+    'warntabs','optimize','optsigns','optfloats','constfold','dcr',
+    'errmissingdefault','listlength','listadd',
+})
+
+assert not (defaultoptions - validoptions), (u"Default options not present in"
+    u" validoptions: '%s'"
+    % (b"', '".join(defaultoptions - validoptions)).decode('utf8'))
+
+def ApplyOptions(options, changes):
+    """Apply a comma-separated list of option changes in the format of -O to
+    the given set of options, and return the new set. Raises ValueError with
+    the offending change if an option is not recognized.
+    """
+    options = set(options)
+    for chg in changes.lower().split(','):
+        if not chg:
+            continue
+        if chg in ('clear', '+clear'):
+            options = set()
+            continue
+        if chg == '-clear':
+            # ignore
+            continue
+        chgfix = chg
+        if chgfix[0] not in ('+', '-'):
+            chgfix = '+' + chgfix
+        if chgfix[1:] not in validoptions:
+            raise ValueError(chg)
+        if chgfix[0] == '-':
+            options.discard(chgfix[1:])
+        else:
+            options.add(chgfix[1:])
+    return options
+
+class Library(object):
+    """The builtins and function data, loaded once. The parser, optimizer
+    and output objects are created on demand, one set per thread.
+    """
+    def __init__(self, builtins = None, fndata = None, cache = True):
+        self.warnings = []
+        # Collect the warnings issued while loading.
+        with lslcommon.context(warnings = self.warnings):
+            self.lib = lslloadlib.LoadLibrary(builtins, fndata, cache)
+        self.events, self.constants, self.functions = self.lib
+        self.local = threading.local()
+
+    def tools(self):
+        """Return the parser, optimizer and output objects of this thread."""
+        local = self.local
+        if not hasattr(local, 'parser'):
+            local.parser = parser(self.lib)
+            local.optimizer = optimizer(self.lib)
+            local.outscript = outscript()
+        return local.parser, local.optimizer, local.outscript
+
+class diagnostic(object):
+    """A message about the script. severity is 'error' or 'warning'. line,
+    column and filename are only known for errors, and are None otherwise.
+    """
+    def __init__(self, severity, message, line = None, column = None,
+                 filename = None):
+        self.severity = severity
+        self.message = message
+        self.line = line
+        self.column = column
+        self.filename = filename
+
+    def __repr__(self):
+        return ('diagnostic(%r, %r, %r, %r, %r)'
+                % (self.severity, self.message, self.line, self.column,
+                   self.filename))
+
+    def __str__(self):
+        if self.line is None:
+            return u2str(u'%s: %s' % (self.severity, self.message), 'utf8')
+        return u2str(u'%s:%d:%d: %s: %s'
+                     % (str2u(self.filename, 'utf8'), self.line, self.column,
+                        self.severity, self.message), 'utf8')
+
+class result(object):
+    """Result of optimize_source. output is the optimized script, or None if
+    there were errors. diagnostics is a list of diagnostic objects. timings
+    is the lsltimings.timings object with the measurements of the phases, if
+    they were requested.
+    """
+    def __init__(self, output, diagnostics, timings = None):
+        self.output = output
+        self.diagnostics = diagnostics
+        self.timings = timings
+
+    @property
+    def ok(self):
+        return self.output is not None
+
+    @property
+    def errors(self):
+        return [d for d in self.diagnostics if d.severity == 'error']
+
+    @property
+    def warnings(self):
+        return [d for d in self.diagnostics if d.severity == 'warning']
+
+def optimize_source(text, options = None, library = None,
+                    filename = '<stdin>', timings = False):
+    """Parse, optimize and output the given LSL source and return a result
+    object. Nothing is written to stdout or stderr.
+
+    options can be None for the default options; a string with changes to
+    the default options in the same format as the -O command line option,
+    e.g. '-dcr,+shrinknames'; or a collection of option names, used as is.
+    The options 'lso' and 'expr' select LSO mode and expression mode.
+
+    library is a Library object; if not given, a default one is created,
+    which is slow, so it's better to create one and pass it every time.
+
+    filename is the name of the script, for the diagnostics.
+
+    If timings is set, the wall time, CPU time, peak memory and node counts
+    of each phase are measured and returned in the timings attribute of the
+    result; its Report() and JSON() methods format them.
+
+    Raises ValueError if an option is not recognized.
+    """
+    if options is None:
+        options = set(defaultoptions)
+    elif isinstance(options, (str, unicode)):
+        options = ApplyOptions(defaultoptions, any2str(options, 'utf8'))
+    else:
+        options = set(options)
+        for opt in options:
+            if opt not in validoptions:
+                raise ValueError(opt)
+    if library is None:
+        library = Library()
+
+    warnings = []
+    measures = lsltimings.timings() if timings else None
+    ctx = lslcommon.context(LSO = 'lso' in options,
+                            IsCalc = 'expr' in options, warnings = warnings,
+                            timings = measures)
+    options -= set(('lso', 'expr'))
+
+    script = any2str(text, 'utf8')
+    p, o, out = library.tools()
+    try:
+        lsltimings.Begin(ctx, 'Parse')
+        try:
+            ts = p.parse(script, options, filename, ctx = ctx)
+        except EParse as e:
+            return result(None, [diagnostic('warning', w) for w in warnings]
+                + [diagnostic('error', e.rawmsg, e.lno, e.cno,
+                              filename if e.fname == '<stdin>' else e.fname)],
+                measures)
+        lsltimings.End(ctx, ts[0])
+        lsltimings.Begin(ctx, 'Optimize', ts[0])
+        ts = o.optimize(ts, options, ctx = ctx)
+        lsltimings.End(ctx, ts[0])
+        lsltimings.Begin(ctx, 'Output', ts[0])
+        output = out.output(ts, options, ctx = ctx)
+        lsltimings.End(ctx)
+    finally:
+        if measures is not None:
+            measures.Finish()
+    return result(output, [diagnostic('warning', w) for w in warnings],
+                  measures)
@@ -35,6 +35,10 @@
 # The JSON functions have been separated to their own module.
 
 import re
+import struct
+import threading
+from array import array
+from collections import OrderedDict
 from lslopt.lslcommon import *
 from lslopt import lslcommon
 from ctypes import c_float
@@ -160,6 +164,14 @@ Types = {
 
 # Utility functions
 
+# Packing and unpacking single precision floats is the fastest way to round
+# them (faster than c_float or array). The structs for tuples are
+# created as needed, by length.
+F32Struct = struct.Struct('f')
+F32Pack = F32Struct.pack
+F32Unpack = F32Struct.unpack
+F32TupleStructs = {3: struct.Struct('3f'), 4: struct.Struct('4f')}
+
 def F32(f, f32=True):
     """Truncate a float to have a precision equivalent to IEEE single"""
 
@@ -167,7 +179,13 @@ def F32(f, f32=True):
         return f
 
     if isinstance(f, tuple):  # vector, quaternion
-        return f.__class__(F32(i) for i in f)
+        return F32Tuple(f)
+
+    try:
+        return F32Unpack(F32Pack(f))[0]
+    except (OverflowError, struct.error):
+        # struct refuses to round to infinity; c_float doesn't.
+        pass
 
     # Alternative to the big blurb below. This relies on the machine using IEEE-754, though.
 
@@ -175,10 +193,6 @@ def F32(f, f32=True):
     #from array import array
     #return array('f',(f,))[0]
 
-    # Using struct:
-    #from struct import pack, unpack
-    #return unpack('f', pack('f', f))[0]
-
     # Using numpy:
     #import numpy
     #return float(numpy.float32(f))
@@ -187,6 +201,26 @@ def F32(f, f32=True):
     #from ctypes import c_float
     return c_float(f).value
 
+def F32Tuple(t):
+    """Truncate the components of a vector or quaternion (or any tuple of
+    floats) to single precision, in one go.
+    """
+    st = F32TupleStructs.get(len(t))
+    if st is None:
+        st = F32TupleStructs[len(t)] = struct.Struct('%df' % len(t))
+    try:
+        return t.__class__(st.unpack(st.pack(*t)))
+    except (OverflowError, struct.error):
+        return t.__class__(F32(i) for i in t)
+
+def F32List(L):
+    """Truncate a list of floats to single precision, in one go."""
+    try:
+        # Unlike struct, array rounds to infinity like c_float.
+        return array('f', L).tolist()
+    except TypeError:
+        return [F32(i) for i in L]
+
 # These are other approaches that are not fully debugged:
 
 # This one is tested against c_float, but not carefully verified:
@@ -286,11 +320,8 @@ def F32(f, f32=True):
 def S32(val):
     """Return a signed integer truncated to 32 bits (must deal with longs too)"""
     if -2147483648 <= val <= 2147483647:
-        return int(val)
-    val &= 0xFFFFFFFF
-    if val > 2147483647:
-        return int(val - 4294967296)
-    return int(val)
+        return val if type(val) is int else int(val)
+    return int(((val + 2147483648) & 0xFFFFFFFF) - 2147483648)
 
 def zstr(s):
     if not isinstance(s, unicode):
@@ -333,25 +364,33 @@ def fs(s):
         s = InternalTypecast(s, unicode, False, False)
     return s
 
+# Types of list elements that fl doesn't need to convert.
+ScalarTypes = frozenset((int, float, unicode, Key))
+
 def fl(L):
     """Force l to be a list, and its elements to have sane types."""
     Lorig = L
     if type(L) != list:
         raise ELSLTypeMismatch
+    types = set(map(type, L))
+    if not (types - ScalarTypes):
+        # Nothing to check element by element.
+        return L
     for i in xrange(len(L)):
         t = type(L[i])
         if t not in Types:
             raise ELSLInvalidType
         if t == Vector:
+            elem = v2f(L[i])
+        elif t == Quaternion:
+            elem = q2f(L[i])
+        else:
+            continue
+        if elem is not L[i]:
             # copy on write
             if L is Lorig:
                 L = L[:]
-            L[i] = v2f(L[i])
-        if t == Quaternion:
-            # copy on write
-            if L is Lorig:
-                L = L[:]
-            L[i] = q2f(L[i])
+            L[i] = elem
     return L
 
 def q2f(q):
@@ -368,14 +407,32 @@ def v2f(v):
         return v
     return Vector((ff(v[0]), ff(v[1]), ff(v[2])))
 
+# Memo of the results of f2s and vr2s. The keys of f2s are the value and
+# DP; only the nonzero finite values in Mono mode are stored, for which
+# equal values give equal results. The keys of vr2s are the bytes of the
+# components, DP and LSO. It's emptied when it gets full.
+F2SMemoSize = 8192
+F2SMemo = {}
+
 def f2s(val, DP=6):
     if math.isinf(val):
         return u'Infinity' if val > 0 else u'-Infinity'
     if math.isnan(val):
         return u'NaN'
-    if lslcommon.LSO or val == 0.:
+    if lslcommon.CurrentContext().LSO or val == 0.:
         return u'%.*f' % (DP, val)  # deals with -0.0 too
 
+    key = (val, DP)
+    s = F2SMemo.get(key)
+    if s is None:
+        s = InternalF2S(val, DP)
+        if len(F2SMemo) >= F2SMemoSize:
+            F2SMemo.clear()
+        F2SMemo[key] = s
+    return s
+
+def InternalF2S(val, DP):
+    """Format a nonzero finite float like Mono does."""
     # Format according to Mono rules (7 decimals after the DP, found experimentally)
     s = u'%.*f' % (DP+7, val)
 
@@ -426,9 +483,18 @@ def f2s(val, DP=6):
         return sgn + new_s + u'0' * (dot - i) + u'.' + u'0' * DP
     return sgn + new_s + u'0' * (dot + 1 + DP - i)
 
+VR2SStructs = {3: struct.Struct('<3d'), 4: struct.Struct('<4d')}
+
 def vr2s(v, DP=6):
     assert len(v) == (3 if type(v) == Vector else 4)
-    return u'<' + ', '.join(f2s(x, DP) for x in v) + u'>'
+    key = (VR2SStructs[len(v)].pack(*v), DP, lslcommon.CurrentContext().LSO)
+    s = F2SMemo.get(key)
+    if s is None:
+        s = u'<' + ', '.join(f2s(x, DP) for x in v) + u'>'
+        if len(F2SMemo) >= F2SMemoSize:
+            F2SMemo.clear()
+        F2SMemo[key] = s
+    return s
 
 def qnz(q):
     return Quaternion((0.,0.,0.,1.)) if all(x == 0. for x in q) else q
@@ -502,7 +568,7 @@ def InternalTypecast(val, out, InList, f32):
                 ret = NaN
             else:
                 ret = float(match.group(0))
-            if not lslcommon.LSO and abs(ret) < 1.1754943157898259e-38:
+            if not lslcommon.CurrentContext().LSO and abs(ret) < 1.1754943157898259e-38:
                 # Mono doesn't return denormals when using (float)"val"
                 # (but it returns them when using (vector)"<val,...>")
                 ret = 0.0
@@ -617,7 +683,7 @@ def InternalUTF8toString(s):
     invalid_length = len(s) - last
     ret += u'?' * invalid_length
     invalid_sum += invalid_length
-    if invalid_sum and lslcommon.LSO:
+    if invalid_sum and lslcommon.CurrentContext().LSO:
         raise ELSONotSupported(u"Byte strings not supported")
     return zstr(ret)
 
@@ -858,7 +924,7 @@ def compare(a, b, Eq = True):
             ret = ff(a) == ff(b)
         return int(ret == Eq)
     if ta in (unicode, Key) and tb in (unicode, Key):
-        ret = 0 if a == b else 1 if (not lslcommon.LSO
+        ret = 0 if a == b else 1 if (not lslcommon.CurrentContext().LSO
             or a.encode('utf8') > b.encode('utf8')) else -1
         return int(not ret) if Eq else ret
     if ta == tb in (Vector, Quaternion):
@@ -892,7 +958,7 @@ def cond(x):
         return bool(compare(x, ZERO_VECTOR, Eq=False))
     if tx == Quaternion:
         return bool(compare(x, ZERO_ROTATION, Eq=False))
-    if lslcommon.LSO and tx == list:
+    if lslcommon.CurrentContext().LSO and tx == list:
         # SVC-689: lists of 1 element count as false
         return len(x) > 1
     return bool(x)  # works fine for int, float, string, list
@@ -911,7 +977,7 @@ def llAbs(i):
     i = fi(i)
     if i != -2147483648:
         return abs(i)
-    if lslcommon.LSO:
+    if lslcommon.CurrentContext().LSO:
         return i
     # Mono raises an OverflowException in this case.
     raise ELSLCantCompute
@@ -1130,7 +1196,7 @@ def llChar(code):
 #    return zstr(InternalUTF8toString(bytearray(s)))
 
     # Here's an alternative, simpler implementation that only works for Mono:
-    if lslcommon.LSO:
+    if lslcommon.CurrentContext().LSO:
         raise ELSLCantCompute
     if code <= 0 or code > 0x10FFFF:
         if code == 0:
@@ -1235,7 +1301,7 @@ def llFrand(lim):
     if math.isnan(lim):
         return lim
 
-    if lslcommon.IsCalc:
+    if lslcommon.CurrentContext().IsCalc:
         import random
         val = random.random() * lim
         # Truncate, rather than rounding
@@ -1251,7 +1317,7 @@ def llFrand(lim):
     raise ELSLCantCompute
 
 def llGenerateKey():
-    if lslcommon.IsCalc:
+    if lslcommon.CurrentContext().IsCalc:
         import time
         import random
 
@@ -1364,7 +1430,7 @@ def llList2Key(lst, pos):
             return Key(elem)
     except IndexError:
         pass
-    if lslcommon.LSO:
+    if lslcommon.CurrentContext().LSO:
         return Key(NULL_KEY)
     return Key(u'')
 
@@ -1430,6 +1496,31 @@ def llList2Vector(lst, pos):
         pass
     return ZERO_VECTOR
 
+def InternalListEqual(a, b):
+    """Return whether two list elements are equal for llListFindList."""
+    t = type(a)
+    if t != type(b):
+        return False
+    if t == float:
+        # Exceptionally, NaN equals NaN
+        return a == b or math.isnan(a) and math.isnan(b)
+    if t in (Vector, Quaternion):
+        # Act as if the list's vector/quat was all floats, even if not.
+        # NaNs are considered different to themselves here as normal.
+        if t == Vector:
+            a = v2f(a)
+            b = v2f(b)
+        else:
+            a = q2f(a)
+            b = q2f(b)
+        # Unfortunately, Python fails to consider (NaN,) != (NaN,) sometimes
+        # so we need to implement our own test
+        for ae, be in zip(a, b):
+            if ae != be:
+                return False
+        return True
+    return a == b
+
 def llListFindList(lst, elems):
     lst = fl(lst)
     elems = fl(elems)
@@ -1441,43 +1532,38 @@ def llListFindList(lst, elems):
     if L2 == 0:
         # empty list is always found at position 0 in Mono,
         # and in LSO if the first list isn't empty
-        return -1 if lslcommon.LSO and L1 == 0 else 0
-    for i in xrange(L1-L2+1):
+        return -1 if lslcommon.CurrentContext().LSO and L1 == 0 else 0
+    # The candidate positions are found by searching the first element with
+    # list.index, and discarded by comparing the whole sublist, which is
+    # fast. Elements that are equal for LSL are also equal for Python,
+    # except for NaN floats, which are searched by hand. The opposite is not
+    # true (e.g. 1 == 1.0), so the candidates need to be checked anyway.
+    first = elems[0]
+    nanfirst = type(first) == float and math.isnan(first)
+    nans = any(type(elem) == float and math.isnan(elem) for elem in elems)
+    end = L1 - L2 + 1
+    i = 0
+    while True:
+        if nanfirst:
+            while i < end and not InternalListEqual(lst[i], first):
+                i += 1
+            if i == end:
+                return -1
+        else:
+            try:
+                i = lst.index(first, i, end)
+            except ValueError:
+                return -1
+            if not nans and lst[i:i+L2] != elems:
+                i += 1
+                continue
         for j in xrange(L2):
-            e1 = lst[i+j]
-            e2 = elems[j]
-            if type(e1) == type(e2) == float:
-                if e1 == e2:
-                    continue
-                # Exceptionally, NaN equals NaN
-                if math.isnan(e1) and math.isnan(e2):
-                    continue
-                # Mismatch
-                break
-            elif type(e1) == type(e2) in (Vector, Quaternion):
-                # Act as if the list's vector/quat was all floats, even if not
-                if type(e1) == Vector:
-                    e1 = v2f(e1)
-                    e2 = v2f(e2)
-                else:
-                    e1 = q2f(e1)
-                    e2 = q2f(e2)
-                # Unfortunately, Python fails to consider (NaN,) != (NaN,) sometimes
-                # so we need to implement our own test
-                for e1e,e2e in zip(e1,e2):
-                    if e1e != e2e:  # NaNs are considered different to themselves here as normal
-                        # Mismatch in vector/quaternion sub-element
-                        break
-                else:
-                    # No mismatch in any sub-element, try next list element
-                    continue
-                break  # discrepancy found
-            elif type(e1) != type(e2) or e1 != e2:
+            if not InternalListEqual(lst[i+j], elems[j]):
                 break  # mismatch
         else:
             # no mismatch
             return i
-    return -1
+        i += 1
 
 def llListInsertList(lst, elems, pos):
     lst = fl(lst)
@@ -1507,16 +1593,16 @@ def llListReplaceList(lst, elems, start, end):
     if end == -1: end += L
     return lst[:start] + elems + lst[end+1:]
 
-def llListSort(lst, stride, asc):
-    lst = fl(lst)
-    stride = fi(stride)
-    asc = fi(asc)
-    lst = lst[:]  # make a copy
+def InternalListSortExchange(lst, stride, asc):
+    """Reference implementation of llListSort: an exchange sort of the
+    strides of lst in place, like the one LSL uses. It isn't stable, and
+    its result with elements that don't compare (NaNs, different types) is
+    hard to predict, so it's used when InternalListSortKeys can't give the
+    same result.
+    """
     L = len(lst)
     broken = u'\ufb1a' > u'\U0001d41a'  # that happens on Windows
-    if stride < 1: stride = 1
-    if L % stride:
-        return lst
+    LSO = lslcommon.CurrentContext().LSO
     for i in xrange(0, L-stride, stride):
         # Optimized by caching the element in the outer loop AND after swapping.
         a = lst[i]
@@ -1524,7 +1610,7 @@ def llListSort(lst, stride, asc):
         if ta == Vector:
             a = v2f(a)  # list should contain vectors made only of floats
             a = a[0]*a[0] + a[1]*a[1] + a[2]*a[2]
-        if lslcommon.LSO:
+        if LSO and ta in (unicode, Key):
             # LSO compares bytes, not Unicode.
             a = a.encode('utf8')
         elif broken and ta in (unicode, Key):
@@ -1541,7 +1627,7 @@ def llListSort(lst, stride, asc):
                     gt = not (a <= b[0]*b[0] + b[1]*b[1] + b[2]*b[2])
                     # (note NaNs compare as > thus the reversed condition!)
                 elif tb != Quaternion:
-                    if lslcommon.LSO:
+                    if LSO and tb in (unicode, Key):
                         b = b.encode('utf8')
                     elif broken and tb in (unicode, Key):
                         b = b.encode('utf-32-be')  # pragma: no cover
@@ -1556,10 +1642,62 @@ def llListSort(lst, stride, asc):
                 if ta == Vector:
                     a = v2f(a)
                     a = a[0]*a[0] + a[1]*a[1] + a[2]*a[2]
-                if broken and ta in (unicode, Key):
+                if LSO and ta in (unicode, Key):
+                    a = a.encode('utf8')
+                elif broken and ta in (unicode, Key):
                     a = a.encode('utf-32-be')  # pragma: no cover
     return lst
 
+def InternalListSortKeys(lst, stride):
+    """Return the sort keys of the strides of lst, if sorting them by key
+    gives the same result as InternalListSortExchange, or None otherwise.
+
+    That's the case when the first elements of the strides are all of the
+    same type, which is not rotation, and they are totally ordered: no NaNs
+    (or vectors with a NaN magnitude), and no two of them compare equal
+    unless they are identical and nothing else is in the stride. The
+    exchange sort is then a selection sort, which leaves the minimum (or
+    the maximum) of the remaining strides in each position.
+    """
+    if not lst:
+        return []
+    t = type(lst[0])
+    keys = lst[::stride]
+    if any(type(a) is not t for a in keys):
+        return None
+    if t == Vector:
+        keys = [a[0]*a[0] + a[1]*a[1] + a[2]*a[2] for a in map(v2f, keys)]
+    elif t == Quaternion:
+        return None
+    elif t in (unicode, Key):
+        if lslcommon.CurrentContext().LSO:
+            keys = [a.encode('utf8') for a in keys]
+        elif u'\ufb1a' > u'\U0001d41a':  # pragma: no cover
+            keys = [a.encode('utf-32-be') for a in keys]
+    if t in (float, Vector) and any(math.isnan(a) for a in keys):
+        return None
+    # Equal keys are only allowed when they can't be told apart.
+    if stride > 1 or t in (float, Vector):
+        if len(set(keys)) != len(keys):
+            return None
+    return keys
+
+def llListSort(lst, stride, asc):
+    lst = fl(lst)
+    stride = fi(stride)
+    asc = fi(asc)
+    lst = lst[:]  # make a copy
+    if stride < 1: stride = 1
+    if len(lst) % stride:
+        return lst
+    keys = InternalListSortKeys(lst, stride)
+    if keys is None:
+        return InternalListSortExchange(lst, stride, asc)
+    order = sorted(xrange(len(keys)), key=keys.__getitem__, reverse=asc != 1)
+    if stride == 1:
+        return [lst[i] for i in order]
+    return [elem for i in order for elem in lst[i*stride:i*stride+stride]]
+
 def llListStatistics(op, lst):
     op = fi(op)
     lst = fl(lst)
@@ -1655,7 +1793,7 @@ def llModPow(base, exp, mod):
     base = fi(base)
     exp = fi(exp)
     mod = fi(mod)
-    if not lslcommon.IsCalc:
+    if not lslcommon.CurrentContext().IsCalc:
         # This function has a delay, therefore it's not safe to compute it
         # unless in calculator mode.
         raise ELSLCantCompute
@@ -1688,6 +1826,34 @@ def llOrd(val, index):
         return ord(val[index])  # we're assuming it won't ever need F32()
     return 0
 
+# Compiled patterns of llParseString2List by separators and spacers, the
+# least recently used first. It's shared by all threads.
+ParseCacheSize = 256
+ParseCache = OrderedDict()
+ParseCacheLock = threading.Lock()
+
+def InternalParsePattern(exc, inc):
+    """Return a tuple with the compiled regex that splits a string by the
+    separators and spacers of llParseString2List, or None if all of them
+    are empty, and the sets of pieces of the split to remove with and
+    without KeepNulls: the separators, and also the empty string without.
+    """
+    key = (tuple(exc), tuple(inc))
+    with ParseCacheLock:
+        if key in ParseCache:
+            # Mark it as recently used.
+            ret = ParseCache[key] = ParseCache.pop(key)
+            return ret
+    # Separators go first, so they take precedence over equal spacers.
+    regex = u'|'.join(re.escape(i) for i in exc + inc if i != u'')
+    regex = re.compile(u'(' + regex + u')') if regex else None
+    ret = (regex, frozenset(exc), frozenset(exc) | frozenset((u'',)))
+    with ParseCacheLock:
+        if len(ParseCache) >= ParseCacheSize:
+            ParseCache.popitem(last=False)
+        ParseCache[key] = ret
+    return ret
+
 def llParseString2List(s, exc, inc, KeepNulls=False):
     s = fs(s)
     exc = fl(exc)
@@ -1696,19 +1862,13 @@ def llParseString2List(s, exc, inc, KeepNulls=False):
         return [s]
     exc = exc[:8]
     inc = inc[:8]
-    regex = u''
-    for i in exc:
-        if i != u'':
-            regex += u'|' + re.escape(i)
-    for i in inc:
-        if i != u'':
-            regex += u'|' + re.escape(i)
-    if regex == u'':
-        split = [s]
-    else:
-        regex = u'(' + regex[1:] + u')'
-        split = re.split(regex, s)
-    return [i for i in split if (KeepNulls or i != u'') and i not in exc]
+    for i in exc + inc:
+        if type(i) not in (unicode, Key):
+            raise ELSLCantCompute
+    regex, seps, nulls = InternalParsePattern(exc, inc)
+    remove = seps if KeepNulls else nulls
+    split = [s] if regex is None else regex.split(s)
+    return [i for i in split if i not in remove]
 
 def llParseStringKeepNulls(s, exc, inc):
     return llParseString2List(s, exc, inc, KeepNulls=True)
@@ -1899,13 +2059,13 @@ def llTan(f):
 
 def llToLower(s):
     s = fs(s)
-    if lslcommon.LSO:
+    if lslcommon.CurrentContext().LSO:
         return zstr(s).translate(lowerLSOMap)
     return zstr(s).translate(lowerMap)
 
 def llToUpper(s):
     s = fs(s)
-    if lslcommon.LSO:
+    if lslcommon.CurrentContext().LSO:
         return zstr(s).translate(upperLSOMap)
     return zstr(s).translate(upperMap)
 
@@ -1986,7 +2146,7 @@ def llXorBase64(s, xor):
     i = 0
     ret = bytearray(b'')
 
-    Bug3763 = 3763 in Bugs
+    Bug3763 = 3763 in lslcommon.CurrentContext().Bugs
     # BUG-3763 consists of the binary string having an extra NULL every time
     # after the second repetition of the XOR pattern. For example, if the XOR
     # binary string is b'pqr' and the input string is b'12345678901234567890',
@@ -2008,7 +2168,7 @@ def llXorBase64Strings(s, xor):
     s = fs(s)
     xor = fs(xor)
 
-    if not lslcommon.IsCalc:
+    if not lslcommon.CurrentContext().IsCalc:
         # This function has a delay, therefore it's not safe to compute it
         # unless in calculator mode.
         raise ELSLCantCompute
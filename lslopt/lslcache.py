@@ -0,0 +1,156 @@
+#    (C) Copyright 2015-2021 Sei Lisa. All rights reserved.
+#
+#    This file is part of LSL PyOptimizer.
+#
+#    LSL PyOptimizer is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    LSL PyOptimizer is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with LSL PyOptimizer. If not, see <http://www.gnu.org/licenses/>.
+
+# On-disk cache of optimization results.
+#
+# Each entry is stored in its own file, named after the hash of everything
+# that can affect the result: the preprocessed source, the effective
+# options, the library and the optimizer version. The modification time of
+# the files is used as the last access time, and the least recently used
+# entries are removed when the total size exceeds the limit.
+
+import os, hashlib
+from strutil import *
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Version of the format of the entries. Bump it when it changes.
+RESULTCACHE_VERSION = 1
+
+class resultcache(object):
+
+    def __init__(self, path, maxsize = 64 * 1024 * 1024):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, *parts):
+        """Return the key for the given parts. Strings are hashed as they
+        are; anything else is hashed through its repr(), so it should have
+        a stable one (e.g. sort sets before passing them).
+        """
+        h = hashlib.sha1()
+        h.update(str2b('LSL PyOptimizer result cache %d\n'
+                       % RESULTCACHE_VERSION))
+        for part in parts:
+            if type(part) not in (str, unicode, bytes):
+                part = repr(part)
+            part = any2b(part, 'utf8')
+            h.update(str2b('%d\n' % len(part)))
+            h.update(part)
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.res')
+
+    def get(self, key):
+        """Return the data stored for the given key, or None if there's
+        none or it can't be read.
+        """
+        fname = self.filename(key)
+        try:
+            f = open(fname, 'rb')
+            try:
+                data = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # Missing, corrupt or incompatible.
+            self.misses += 1
+            return None
+        if type(data) != tuple or len(data) != 2 or data[0] != key:
+            self.misses += 1
+            return None
+        try:
+            # Mark it as recently used.
+            os.utime(fname, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data[1]
+
+    def put(self, key, data):
+        """Store data (which must be picklable) for the given key, then
+        evict entries if the cache is over its size limit. Failure to write
+        is not an error.
+        """
+        fname = self.filename(key)
+        tmpfile = fname + '.%d.tmp' % os.getpid()
+        try:
+            f = open(tmpfile, 'wb')
+            try:
+                pickle.dump((key, data), f, 2)
+            finally:
+                f.close()
+            try:
+                os.rename(tmpfile, fname)
+            except OSError:
+                # Windows doesn't overwrite on rename.
+                os.remove(fname)
+                os.rename(tmpfile, fname)
+        except (IOError, OSError):
+            try:
+                os.remove(tmpfile)
+            except OSError:
+                pass
+            return
+        self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is
+        within the limit.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.res'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        if total <= self.maxsize:
+            return
+        entries.sort()
+        for mtime, name, size in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Return a text line with the statistics."""
+        lookups = self.hits + self.misses
+        return (u"Result cache: %d hits, %d misses (%.1f%% hit rate),"
+                u" %d stored, %d evicted"
+                % (self.hits, self.misses,
+                   100. * self.hits / lookups if lookups else 0.,
+                   self.stores, self.evictions))
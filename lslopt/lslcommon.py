@@ -17,26 +17,45 @@
 
 # Classes, functions and variables for use of all modules.
 
-import sys
+import sys, threading
 from strutil import *
 strutil_used
 
 _exclusions = frozenset({'nt','t','name','value','ch', 'X','SEF'})
 
 # Node Record type. Used for AST nodes.
+#
+# The common attributes are stored in slots, and value, name and scope are
+# None when the node doesn't have them. shash is the structural hash cached
+# by the optimizer (see foldconst.StructHash), None if not taken or discarded.
+# Any other annotation (X, orig, LIR, fld...) goes to the instance dict, which
+# Python only creates when such an attribute is set.
 class nr(object):
-    nt  = None   # node type
-    t   = None   # LSL type
-    ch  = None   # children
-    SEF = False  # Side Effect-Free flag
-    def __init__(self, **kwargs):
+    __slots__ = ('nt',   # node type
+                 't',    # LSL type
+                 'ch',   # children
+                 'SEF',  # Side Effect-Free flag
+                 'value', 'name', 'scope', 'shash', '__dict__')
+
+    def __init__(self, nt = None, t = None, ch = None, SEF = False,
+                 value = None, name = None, scope = None, **kwargs):
+        self.nt = nt
+        self.t = t
+        self.ch = ch
+        self.SEF = SEF
+        self.value = value
+        self.name = name
+        self.scope = scope
+        self.shash = None
         for k in kwargs:
             setattr(self, k, kwargs[k])
 
     def copy(self):
-        new = nr()
-        for k, v in self.__dict__.items():
-            setattr(new, k, v)
+        new = nr(self.nt, self.t, self.ch, self.SEF, self.value, self.name,
+                 self.scope)
+        extra = self.__dict__
+        if extra:
+            new.__dict__.update(extra)
         return new
 
     # Debug output
@@ -44,13 +63,16 @@ class nr(object):
     def __str__(self, indent = 0):
         spaces = ' ' * (4 * indent)
         s = '\n{sp}{{ nt:{nr.nt}\n{sp}  ,t:{nr.t}'.format(sp=spaces, nr=self)
-        if hasattr(self, 'name'):
+        if self.name is not None:
             s += '\n{sp}  ,name:{nr.name}'.format(sp=spaces, nr=self)
-        if hasattr(self, 'value'):
+        if self.value is not None:
             s += '\n{sp}  ,value:{v}'.format(sp=spaces, v=repr(self.value))
-        for k in sorted(self.__dict__):
+        attrs = dict(self.__dict__)
+        if self.scope is not None:
+            attrs['scope'] = self.scope
+        for k in sorted(attrs):
             if k not in _exclusions:
-                v = self.__dict__[k]
+                v = attrs[k]
                 s += '\n{sp}  ,{k}:{v}'.format(sp=spaces, k=k, v=repr(v))
         if self.ch is not None:
             if self.ch:
@@ -67,6 +89,36 @@ class nr(object):
         s += '\n{sp}}}'.format(sp=spaces)
         return s if indent > 0 else s[1:]  # remove leading \n at level 0
 
+# Traversal of deep trees.
+#
+# Most passes are recursive, and a very long expression, like a concatenation
+# of thousands of terms, would exceed the recursion limit. To avoid it, a pass
+# can process first the nodes returned by DeepNodes, deepest first, keeping
+# the results, so that the recursion from any node stops at most
+# TraversalStep levels below it.
+TraversalStep = 64
+
+def DeepNodes(parent, index, skip = frozenset(), step = TraversalStep):
+    """Return the nodes below parent[index] whose depth is a multiple of
+    step, as tuples of (parent, index), each one after its descendants. The
+    nodes whose type is in skip are not returned nor entered.
+    """
+    ret = []
+    stack = [(parent, index, 0)]
+    while stack:
+        parent, index, depth = stack.pop()
+        node = parent[index]
+        if node.nt in skip:
+            continue
+        if depth and depth % step == 0:
+            ret.append((parent, index))
+        if node.ch:
+            depth += 1
+            stack.extend((node.ch, i, depth) for i in xrange(len(node.ch)))
+    # Pre-order puts the descendants after the node.
+    ret.reverse()
+    return ret
+
 # These types just wrap the Python types to make type() work on them.
 # There are no ops defined on them or anything.
 
@@ -98,6 +150,88 @@ IsCalc = False
 
 DataPath = ''
 
+# Settings that change how a script is processed. They are kept in a context
+# object, so that scripts with different settings can be processed at the
+# same time in different threads. The parser, optimizer and output modules
+# receive the context explicitly, and make it the active one in the current
+# thread while they run, so that the library functions, which have the same
+# parameters as their LSL counterparts, can find it with CurrentContext().
+#
+# When no context is active, the module globals above are in effect, for
+# compatibility with callers that set them directly.
+
+# If the warnings attribute of the context is a list, the warnings are
+# appended to it instead of being written to stderr. If the timings attribute
+# is an lsltimings.timings object, the phases of the processing are measured
+# in it.
+#
+# A context can also be activated with the 'with' statement.
+
+class context(object):
+    def __init__(self, LSO = False, IsCalc = False, Bugs = (6495,),
+                 warnings = None, timings = None):
+        self.LSO = LSO
+        self.IsCalc = IsCalc
+        self.Bugs = set(Bugs)
+        self.warnings = warnings
+        self.timings = timings
+
+    def __enter__(self):
+        PushContext(self)
+        return self
+
+    def __exit__(self, *exc):
+        PopContext()
+
+class globalcontext(object):
+    """Context that reflects the module globals."""
+    LSO = property(lambda self: LSO)
+    IsCalc = property(lambda self: IsCalc)
+    Bugs = property(lambda self: Bugs)
+    warnings = None
+    timings = None
+
+GlobalContext = globalcontext()
+
+_active = threading.local()
+
+def CurrentContext():
+    """Return the context active in the current thread."""
+    stack = getattr(_active, 'stack', None)
+    return stack[-1] if stack else GlobalContext
+
+def PushContext(ctx):
+    """Make ctx the active context in the current thread."""
+    if not hasattr(_active, 'stack'):
+        _active.stack = []
+    _active.stack.append(ctx)
+
+def PopContext():
+    """Restore the context that was active before the last PushContext."""
+    _active.stack.pop()
+
+def WithContext(method):
+    """Decorator for the entry points of the parser, optimizer and output
+    classes. It adds a ctx keyword parameter with the context to use, which
+    defaults to the current one, stores it in self.ctx and makes it active
+    in the current thread during the call.
+    """
+    def wrapper(self, *args, **kwargs):
+        ctx = kwargs.pop('ctx', None)
+        if ctx is None:
+            ctx = CurrentContext()
+        PushContext(ctx)
+        savectx = self.ctx
+        self.ctx = ctx
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.ctx = savectx
+            PopContext()
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
 # Language
 
 # These are hardcoded because additions or modifications imply
@@ -119,6 +253,44 @@ LSLTypeDefaults = {'integer':0, 'float':0.0, 'string':u'', 'key':Key(u''),
     'vector':Vector((0.,0.,0.)), 'rotation':Quaternion((0.,0.,0.,1.)),
     'list':[]}
 
+# Optimization objectives. By default the optimizer aims for the smallest
+# code. With the 'speed' option it aims for the fewest executed instructions,
+# and with the 'balanced' option it weighs both, counting each instruction
+# as this many bytes.
+BalancedInstrBytes = 2
+
+def Objective(options):
+    """Return the optimization objective selected by the given options:
+    'size', 'speed' or 'balanced'.
+    """
+    if 'speed' in options:
+        return 'speed'
+    if 'balanced' in options:
+        return 'balanced'
+    return 'size'
+
+def Gain(objective, size, speed):
+    """Return a value to compare transformations under the given objective;
+    the greater, the better. size and speed are the bytes of Mono code and
+    the executed instructions that a transformation saves; they are negative
+    if it adds them.
+    """
+    if objective == 'speed':
+        return (speed, size)
+    if objective == 'balanced':
+        return (size + BalancedInstrBytes * speed, speed)
+    return (size, speed)
+
+def Worth(objective, size, speed):
+    """Return whether a transformation is worth doing under the given
+    objective (see Gain).
+    """
+    return Gain(objective, size, speed) > (0, 0)
+
 def warning(txt):
     assert type(txt) == unicode
+    warnings = CurrentContext().warnings
+    if warnings is not None:
+        warnings.append(txt)
+        return
     sys.stderr.write(u"WARNING: " + txt + u"\n")
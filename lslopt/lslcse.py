@@ -0,0 +1,359 @@
+#    (C) Copyright 2015-2021 Sei Lisa. All rights reserved.
+#
+#    This file is part of LSL PyOptimizer.
+#
+#    LSL PyOptimizer is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    LSL PyOptimizer is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with LSL PyOptimizer. If not, see <http://www.gnu.org/licenses/>.
+
+# Common subexpression elimination.
+#
+# Within a run of statements with no control flow (expressions, declarations
+# and a final return), an expression that appears more than once, is SEF and
+# gives the same value every time (no unstable functions, no assignments to
+# its variables and no calls with side effects in between) is evaluated once
+# into a local variable, which is used in its place.
+
+from lslopt import lslcommon
+from lslopt.lslcommon import nr
+from strutil import xrange
+
+# Statements that can be part of a run.
+CSE_STMTS = frozenset({'EXPR', 'DECL', 'RETURN'})
+
+# Calls to functions with side effects in a statement (see CSEScan).
+CSE_NOCALLS = 0
+CSE_LAST = 1
+CSE_CALLS = 2
+
+# Statements that may contain blocks.
+CSE_CONTAINERS = frozenset({'STDEF', 'FNDEF', '{}', 'IF', 'WHILE', 'DO',
+                            'FOR'})
+
+class cse(object):
+
+    # Estimated size in bytes of the Mono code to declare a local variable
+    # and store a value in it, and to read it. They are on the high side, so
+    # that an expression is only replaced when it's sure to save memory.
+    CSEDeclCost = 4
+    CSELoadCost = 2
+
+    # Estimated instructions executed by a call to a function, including
+    # the helper functions that implement the operators of some types.
+    CSECallInstrs = 10
+
+    def ExprCost(self, node, memo):
+        """Return an estimate of the size in bytes of the Mono code that
+        evaluates the expression, which is on the low side, and of the number
+        of instructions executed, as a tuple. The results are kept in memo
+        (a dict), and reused for the subexpressions measured before, which
+        are very often the previous candidates.
+        """
+        root = node
+        cost = 0
+        instrs = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            nt = node.nt
+            if id(node) in memo:
+                known = memo[id(node)]
+                cost += known[0]
+                instrs += known[1]
+                continue
+            if nt == 'CONST':
+                if node.t == 'integer':
+                    cost += 1
+                elif node.t == 'list':
+                    cost += 5 + 5 * len(node.value)
+                elif node.t == 'vector':
+                    cost += 15
+                elif node.t == 'rotation':
+                    cost += 20
+                else:
+                    cost += 5
+            elif nt == 'IDENT':
+                # Globals are fields of the script object.
+                cost += 6 if node.scope == 0 else 1
+            elif nt == 'FNCALL':
+                cost += 5
+                instrs += self.CSECallInstrs - 1
+            elif (node.t in ('integer', 'float')
+                  and node.ch[0].t in ('integer', 'float')
+                 ):
+                # A single instruction.
+                cost += 1
+            else:
+                # A call to a helper function.
+                cost += 5
+                instrs += self.CSECallInstrs - 1
+            instrs += 1
+            if node.ch:
+                stack.extend(node.ch)
+        memo[id(root)] = (cost, instrs)
+        return cost, instrs
+
+    def CSEScan(self, stmt, stmtidx, cands):
+        """Scan the expression of a statement, appending the subexpressions
+        that are candidates for elimination to cands, as tuples of (node,
+        parent, index, stmtidx). Return a tuple with the set of variables (as
+        tuples of name and scope) written by the statement, and its calls to
+        functions with side effects: CSE_NOCALLS if there are none, CSE_LAST
+        if there's only one and it's done after evaluating the rest of the
+        statement, and CSE_CALLS otherwise.
+        """
+        written = set()
+        if stmt.nt == 'DECL':
+            written.add((stmt.name, stmt.scope))
+        if not stmt.ch:
+            return written, CSE_NOCALLS
+
+        # The call that can be done last, if any.
+        last = stmt.ch[0]
+        if last.nt in self.assign_ops:
+            last = last.ch[1]
+        calls = CSE_NOCALLS
+
+        # Post-order traversal. A node is stable if it's SEF and gives the
+        # same result every time it's evaluated with the same variables.
+        stable = {}
+        stack = [(stmt.ch, 0, False)]
+        while stack:
+            parent, index, visited = stack.pop()
+            node = parent[index]
+            if not visited:
+                stack.append((parent, index, True))
+                if node.ch:
+                    stack.extend((node.ch, i, False)
+                                 for i in xrange(len(node.ch)))
+                continue
+
+            nt = node.nt
+            ok = False
+            if nt in ('CONST', 'IDENT'):
+                ok = True
+            elif nt == 'FNCALL':
+                if not self.FnSEF(node):
+                    calls = (CSE_LAST if node is last and calls == CSE_NOCALLS
+                             else CSE_CALLS)
+                ok = (node.SEF and 'uns' not in self.symtab[0][node.name]
+                      and all(stable[id(child)] for child in node.ch))
+            elif nt in self.hashed_ops:
+                ok = node.SEF and all(stable[id(child)] for child in node.ch)
+            elif (nt in self.assign_ops
+                  or nt in ('V++', 'V--', '++V', '--V')
+                 ):
+                lvalue = node.ch[0]
+                if lvalue.nt == 'FLD':
+                    lvalue = lvalue.ch[0]
+                written.add((lvalue.name, lvalue.scope))
+            stable[id(node)] = ok
+            if ok and nt in self.hashed_ops:
+                cands.append((node, parent, index, stmtidx))
+        return written, calls
+
+    def CSEVars(self, node, memo):
+        """Return the set of variables read by an expression. Like in
+        ExprCost, the results are kept in memo and reused.
+        """
+        root = node
+        ret = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if id(node) in memo:
+                ret |= memo[id(node)]
+            elif node.nt == 'IDENT':
+                ret.add((node.name, node.scope))
+            elif node.ch:
+                stack.extend(node.ch)
+        memo[id(root)] = ret
+        return ret
+
+    def CSESegments(self, occurrences, scans, start, variables):
+        """Split the occurrences of an expression into the lists of two or
+        more of them that are sure to have the same value, because no
+        statement between them writes to the given variables or calls a
+        function with side effects, except for a final call in the last one.
+        """
+        occurrences = sorted(occurrences, key=lambda cand: cand[3])
+        ret = []
+        segment = []
+        for cand in occurrences:
+            stmtidx = cand[3]
+            if segment and segment[-1][3] != stmtidx:
+                # Check the statements from the last occurrence to this one.
+                for i in xrange(segment[-1][3], stmtidx):
+                    if (scans[i - start][1] != CSE_NOCALLS
+                        or i != segment[-1][3]
+                           and scans[i - start][0] & variables
+                       ):
+                        if len(segment) > 1:
+                            ret.append(segment)
+                        segment = []
+                        break
+            written, calls = scans[stmtidx - start]
+            if calls == CSE_CALLS or written & variables:
+                if len(segment) > 1:
+                    ret.append(segment)
+                segment = []
+                continue
+            segment.append(cand)
+        if len(segment) > 1:
+            ret.append(segment)
+        return ret
+
+    def CSEGroups(self, cands):
+        """Group the candidates with equivalent expressions. Return a list of
+        lists of them, in order of first appearance.
+        """
+        # The pairs of subtrees found equivalent, which spare walking them
+        # again in the comparisons of the larger candidates.
+        proven = set()
+        groups = {}
+        order = []
+        for cand in cands:
+            h = self.StructHash(cand[0])
+            if h not in groups:
+                groups[h] = []
+                order.append(h)
+            groups[h].append(cand)
+        ret = []
+        for h in order:
+            hashgroup = groups[h]
+            while hashgroup:
+                ref = hashgroup[0]
+                occurrences = [ref]
+                rest = []
+                for cand in hashgroup[1:]:
+                    if self.CompareTrees(ref[0], cand[0], proven):
+                        occurrences.append(cand)
+                    else:
+                        rest.append(cand)
+                hashgroup = rest
+                ret.append(occurrences)
+        return ret
+
+    def CSENewName(self, prefix = '___cse__'):
+        """Return a new name for a local variable, with the given prefix."""
+        while True:
+            self.csecount += 1
+            name = prefix + '%05d' % self.csecount
+            if not any(name in table for table in self.symtab):
+                return name
+
+    def CSERun(self, block, start, end):
+        """Eliminate the common subexpressions of the statements from start
+        to end (not included) of a block, repeating until there are no more.
+        Return the number of statements added.
+        """
+        added = 0
+        while True:
+            stmts = block.ch
+            cands = []
+            scans = [self.CSEScan(stmts[i], i, cands)
+                     for i in xrange(start, end + added)]
+
+            best = None
+            # The candidates are in post-order, so the subexpressions of
+            # each one are measured before it.
+            costs = {}
+            readvars = {}
+            for occurrences in self.CSEGroups(cands):
+                if len(occurrences) < 2:
+                    continue
+
+                expr = occurrences[0][0]
+                cost, instrs = self.ExprCost(expr, costs)
+                for segment in self.CSESegments(occurrences, scans, start,
+                        self.CSEVars(expr, readvars)):
+                    # If the first statement declares a variable with the
+                    # expression as its value, use that variable.
+                    first = segment[0][3]
+                    decl = stmts[first]
+                    reuse = (decl.nt == 'DECL' and decl.t == expr.t
+                             and any(cand[0] is decl.ch[0]
+                                     for cand in segment)
+                             and not any((decl.name, decl.scope)
+                                         in scans[i - start][0]
+                                         for i in xrange(first + 1,
+                                             segment[-1][3] + 1)))
+                    n = len(segment)
+                    if self.cseall:
+                        # Evaluating it once is always faster.
+                        gain = ((n - 1) * instrs, 0)
+                    elif reuse:
+                        # Each load replaces an evaluation.
+                        gain = lslcommon.Gain(self.objective,
+                            (n - 1) * (cost - self.CSELoadCost),
+                            (n - 1) * (instrs - 1))
+                    else:
+                        # The first evaluation also needs a store.
+                        gain = lslcommon.Gain(self.objective,
+                            (n - 1) * cost - self.CSEDeclCost
+                            - n * self.CSELoadCost,
+                            (n - 1) * instrs - n - 1)
+                    if (gain > (0, 0)
+                        and (best is None or gain > best[0])
+                       ):
+                        best = (gain, segment, first, reuse)
+
+            if best is None:
+                return added
+
+            gain, occurrences, first, reuse = best
+            expr = occurrences[0][0]
+            if reuse:
+                decl = stmts[first]
+                name, scope = decl.name, decl.scope
+            else:
+                scope = block.scope
+                name = self.CSENewName()
+                self.symtab[scope][name] = {'Kind':'v', 'Scope':scope,
+                                            'Type':expr.t}
+            for node, parent, index, stmtidx in occurrences:
+                if not reuse or node is not stmts[first].ch[0]:
+                    parent[index] = nr(nt='IDENT', t=expr.t, name=name,
+                                       scope=scope, SEF=True)
+            self.InvalidateHashes()
+            if not reuse:
+                stmts.insert(first, nr(nt='DECL', t=expr.t, name=name,
+                                       scope=scope, ch=[expr]))
+                added += 1
+
+    def EliminateCommonSubexpressions(self):
+        """Replace the repeated expressions in the function and event bodies
+        with local variables, when it's worth it under the optimization
+        objective. If cseall is set, do it always.
+        """
+        self.csecount = 0
+        # The previous passes have changed the tree.
+        self.InvalidateHashes()
+        stack = [node for node in self.tree if node.nt != 'DECL']
+        while stack:
+            node = stack.pop()
+            nt = node.nt
+            if nt not in CSE_CONTAINERS:
+                continue
+            if nt == '{}':
+                stmts = node.ch
+                i = 0
+                while i < len(stmts):
+                    if stmts[i].nt not in CSE_STMTS:
+                        i += 1
+                        continue
+                    end = i + 1
+                    while end < len(stmts) and stmts[end].nt in CSE_STMTS:
+                        end += 1
+                    i = end + self.CSERun(node, i, end)
+            if node.ch:
+                stack.extend(node.ch)
@@ -21,6 +21,10 @@ from lslopt import lslfuncs
 from lslopt.lslcommon import nr
 from strutil import xrange
 
+# Node types that MarkReferences handles apart from expressions.
+MARK_STMTS = frozenset({'STSW', 'JUMP', 'RETURN', 'IF', 'WHILE', 'DO', 'FOR',
+                        '{}', 'FNCALL', 'DECL'})
+
 class deadcode(object):
 
     def MarkReferences(self, node):
@@ -35,6 +39,30 @@ class deadcode(object):
         if hasattr(node, 'X'):
             return node.X # branch already analyzed
 
+        # The analysis of each node is a generator (see MarkNode) that
+        # yields the nodes whose analysis it needs, and receives their X.
+        # Keeping them in a stack instead of recursing allows any nesting
+        # depth of statements.
+        stack = [(self.MarkNode(node), node)]
+        value = None
+        while stack:
+            try:
+                sub = stack[-1][0].send(value)
+            except StopIteration:
+                value = stack.pop()[1].X
+                continue
+            if hasattr(sub, 'X'):
+                value = sub.X # branch already analyzed
+            else:
+                stack.append((self.MarkNode(sub), sub))
+                value = None
+        return node.X
+
+    def MarkNode(self, node):
+        """Generator that analyzes a node for MarkReferences. It yields each
+        node to analyze first, receiving its X in return, and leaves its own
+        result in the X of the node.
+        """
         nt = node.nt
         child = node.ch
 
@@ -44,9 +72,8 @@ class deadcode(object):
             node.X = False # Executed but path-breaking.
             sym = self.symtab[0][node.name]
             if not hasattr(self.tree[sym['Loc']], 'X'):
-                self.MarkReferences(self.tree[sym['Loc']])
-
-            return False
+                yield self.tree[sym['Loc']]
+            return
 
         if nt == 'JUMP':
             node.X = False # Executed but path-breaking.
@@ -55,91 +82,91 @@ class deadcode(object):
                 sym['R'] += 1
             else:
                 sym['R'] = 1
-            return False
+            return
 
         if nt == 'RETURN':
             node.X = False # Executed but path-breaking.
             if child:
-                self.MarkReferences(child[0])
-            return False
+                yield child[0]
+            return
 
         if nt == 'IF':
             # "When you get to a fork in the road, take it."
             node.X = None # provisional value, refined later
-            self.MarkReferences(child[0])
+            yield child[0]
             condnode = child[0]
             if condnode.nt == 'CONST':
                 if lslfuncs.cond(condnode.value):
                     # TRUE - 'then' branch always executed.
-                    node.X = self.MarkReferences(child[1])
-                    return node.X
+                    node.X = yield child[1]
+                    return
                 elif len(child) == 3:
                     # FALSE - 'else' branch always executed.
-                    node.X = self.MarkReferences(child[2])
-                    return node.X
+                    node.X = yield child[2]
+                    return
                 # else fall through
             else:
-                cont = self.MarkReferences(child[1])
+                cont = yield child[1]
                 if len(child) == 3:
                     if not cont:
-                        cont = self.MarkReferences(child[2])
+                        cont = yield child[2]
                         node.X = cont
-                        return cont
-                    self.MarkReferences(child[2])
+                        return
+                    yield child[2]
             node.X = True
-            return True
+            return
 
         if nt == 'WHILE':
             node.X = None # provisional value, refined later
-            self.MarkReferences(child[0])
+            yield child[0]
 
             if child[0].nt == 'CONST':
                 if lslfuncs.cond(child[0].value):
                     # Infinite loop - unless it returns, it stops
                     # execution. But it is executed itself.
-                    self.MarkReferences(child[1])
+                    yield child[1]
                     node.X = False
-                    return node.X
+                    return
                 # else the inside isn't executed at all, so don't mark it
             else:
-                self.MarkReferences(child[1])
+                yield child[1]
             node.X = True
-            return True
+            return
 
         if nt == 'DO':
             node.X = None # provisional value, refined later
-            if not self.MarkReferences(child[0]):
+            if not (yield child[0]):
                 node.X = False
-                return False
-            self.MarkReferences(child[1])
+                return
+            yield child[1]
             # It proceeds to the next statement unless it's an infinite loop
             node.X = not (child[1].nt == 'CONST' and lslfuncs.cond(child[1].value))
-            return node.X
+            return
 
         if nt == 'FOR':
             node.X = None # provisional value, refined later
-            self.MarkReferences(child[0])
-            self.MarkReferences(child[1])
+            yield child[0]
+            yield child[1]
             if child[1].nt == 'CONST':
                 if lslfuncs.cond(child[1].value):
                     # Infinite loop - unless it returns, it stops
                     # execution. But it is executed itself.
                     node.X = False
-                    self.MarkReferences(child[3])
-                    self.MarkReferences(child[2]) # this can't stop execution
-                    return node.X
+                    yield child[3]
+                    yield child[2] # this can't stop execution
+                    return
                 # else the body and the iterator aren't executed at all, so
                 # don't mark them
                 node.X = True
             else:
                 node.X = True
-                self.MarkReferences(child[3])
-                self.MarkReferences(child[2])
+                yield child[3]
+                yield child[2]
             # Mark the EXPRLIST as always executed, but not the subexpressions.
             # That forces the EXPRLIST (which is a syntactic requirement) to be
             # kept, while still simplifying the contents properly.
             child[2].X = True
-            return True
+            return
 
         if nt == '{}':
             # Go through each statement in turn. If one stops execution,
@@ -151,9 +178,9 @@ class deadcode(object):
             node.X = None # provisional
             for stmt in child:
                 if continues or stmt.nt == '@':
-                    continues = self.MarkReferences(stmt)
+                    continues = yield stmt
             node.X = continues
-            return continues
+            return
 
         if nt == 'FNCALL':
             node.X = None # provisional
@@ -166,7 +193,7 @@ class deadcode(object):
                 # writes to a and b.
                 # This has been eliminated, as it causes more trouble than
                 # it fixes.
-                self.MarkReferences(child[idx])
+                yield child[idx]
                 if fdef is not None:
                     psym = self.symtab[fdef.pscope][fdef.pnames[idx]]
                     #if 'W' in psym:
@@ -177,7 +204,7 @@ class deadcode(object):
 
             if 'Loc' in sym:
                 if not hasattr(self.tree[sym['Loc']], 'X'):
-                    self.MarkReferences(self.tree[sym['Loc']])
+                    yield self.tree[sym['Loc']]
                 node.X = self.tree[sym['Loc']].X
             else:
                 node.X = 'stop' not in sym
@@ -205,7 +232,7 @@ class deadcode(object):
             #     fn2() { fn(); x = 1; }
 
 
-            return node.X
+            return
 
         if nt == 'DECL':
             sym = self.symtab[node.scope][node.name]
@@ -219,7 +246,7 @@ class deadcode(object):
             if child is not None:
                 if hasattr(child[0], 'orig'):
                     orig = child[0].orig
-                    self.MarkReferences(orig)
+                    yield orig
                     child[0].X = orig.X
                     if orig.nt == 'LIST':
                         # Add fake writes to variables used in list elements in
@@ -240,12 +267,30 @@ class deadcode(object):
                                         sym['W'] = False
                                         self.tree[sym['Loc']].X = True
                 else:
-                    self.MarkReferences(child[0])
-            return True
+                    yield child[0]
+            return
 
         # ---- Starting here, all node types return through the bottom
         #      (except '=').
 
+        # The descendants of these types are processed in this same loop, so
+        # that long expressions don't recurse.
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if hasattr(node, 'X'):
+                continue
+            if node.nt in MARK_STMTS:
+                yield node
+            else:
+                self.MarkExprReferences(node, stack)
+
+    def MarkExprReferences(self, node, stack):
+        """Mark an expression as MarkReferences does, except for its
+        children, which are added to the stack in reverse order.
+        """
+        nt = node.nt
+        child = node.ch
         node.X = None # provisional
         if nt in self.assign_ops or nt in ('--V', '++V', 'V++', 'V--'):
             ident = node.ch[0]
@@ -263,9 +308,9 @@ class deadcode(object):
             if nt == '=':
                 # Prevent the first node from being mistaken as a read, by
                 # recursing only on the RHS node.
-                self.MarkReferences(child[1])
                 node.X = True
-                return True
+                stack.append(child[1])
+                return
 
         elif nt == 'FLD':
             # Mark this variable as referenced by a Field (recursing will mark
@@ -285,10 +330,7 @@ class deadcode(object):
 
         node.X = True
         if child is not None:
-            for subnode in child:
-                self.MarkReferences(subnode)
-
-        return True
+            stack.extend(reversed(child))
 
     def OKtoRemoveSymbol(self, curnode):
         """If the given node's name must be simplified, that is, replaced or
@@ -391,15 +433,25 @@ class deadcode(object):
         """Recursively checks if the children are used, deleting those that are
         not.
         """
-        if curnode.ch is None or (curnode.nt == 'DECL'
-                                  and curnode.scope == 0):
-            return
         # NOTE: Should not depend on 'Loc', since the nodes that are the
         # destination of 'Loc' are renumbered as we delete stuff from globals.
 
-        index = int(curnode.nt in self.assign_ops) # don't recurse into lvalues
-
-        while index < len(curnode.ch):
+        # The recursion is done with an explicit stack of frames, so that
+        # long expressions don't exceed the recursion limit. Each frame holds
+        # a node, the index of its next child and the isFnDef flag.
+        frames = []
+        if curnode.ch is not None and not (curnode.nt == 'DECL'
+                                           and curnode.scope == 0):
+            # don't recurse into lvalues
+            frames.append([curnode, int(curnode.nt in self.assign_ops),
+                           isFnDef])
+
+        while frames:
+            frame = frames[-1]
+            curnode, index, isFnDef = frame
+            if index >= len(curnode.ch):
+                frames.pop()
+                continue
             node = curnode.ch[index]
 
             if not hasattr(node, 'X'):
@@ -496,9 +548,29 @@ class deadcode(object):
                     child[1] = nr(nt='CONST', X=True, SEF=True, t='integer',
                         value=0)
 
-            self.CleanNode(node, isFnDef = (curnode.nt == 'FNDEF'))
-            index += 1
+            frame[1] = index + 1
+            if node.ch is not None and not (node.nt == 'DECL'
+                                            and node.scope == 0):
+                frames.append([node, int(node.nt in self.assign_ops),
+                               curnode.nt == 'FNDEF'])
+
 
+    def ClearDeadCodeMarks(self):
+        """Remove the annotations left by a previous RemoveDeadCode in the
+        tree (X) and in the symbol table (R, W), so that it can run again.
+        """
+        stack = list(self.tree)
+        while stack:
+            node = stack.pop()
+            if hasattr(node, 'X'):
+                del node.X
+            if node.ch:
+                stack.extend(node.ch)
+        for scope in self.symtab:
+            for sym in scope.values():
+                if type(sym) == dict:
+                    sym.pop('R', None)
+                    sym.pop('W', None)
 
     def RemoveDeadCode(self):
         """Simple reference-based dead code removal. It also performs a
@@ -520,7 +592,7 @@ class deadcode(object):
 
         # TODO: Inlining of functions that are a single 'return' line.
 
-        if lslfuncs.lslcommon.IsCalc:
+        if self.ctx.IsCalc:
             # Do nothing if in calculator mode (there's no default event
             # and it crashes without this)
             return
@@ -22,13 +22,106 @@ from lslopt.lslcommon import Vector, Quaternion, warning, nr
 from lslopt import lslfuncs
 from lslopt.lslfuncs import ZERO_VECTOR, ZERO_ROTATION
 import math
-from lslopt.lslfuncopt import OptimizeFunc, OptimizeArgs, FuncOptSetup
+from collections import OrderedDict
+from lslopt.lslfuncopt import OptimizeFunc, OptimizeArgs
 from strutil import xrange, unicode
 
 # TODO: Remove special handling of @ within IF,WHILE,FOR,DO
 
 class foldconst(object):
 
+    # explicitly exclude assignments
+    binary_ops = frozenset({'+','-','*','/','%','<<','>>','<','<=','>','>=',
+        '==','!=','|','^','&','||','&&'})
+    assign_ops = frozenset({'=','+=','-=','*=','/=','%=','&=','|=','^=','<<=','>>='})
+
+    # Node types whose structural hash depends on their children, and the
+    # subset of them that CompareTrees considers commutative.
+    hashed_ops = binary_ops | frozenset({'FNCALL','CAST','!','~','NEG'})
+    commutative_ops = frozenset({'*','^','&','|','=='})
+
+    # Generation of the structural hashes cached in the nodes. Hashes from
+    # older generations are recomputed.
+    shashgen = 0
+
+    # Optimization objective (see lslcommon.Objective).
+    objective = 'size'
+
+    # Maximum number of results of library function calls remembered by
+    # CallLibFunc, and the number of calls and of hits since the last reset.
+    FoldMemoSize = 2048
+    foldmemo = None
+    foldcalls = foldhits = 0
+
+    # Deep nodes folded in advance by the outermost FoldTree call and not yet
+    # reached from their parents, or None when there's no call in progress.
+    folded = None
+
+    def Worth(self, size, speed):
+        """Return whether a transformation that saves the given bytes of
+        Mono code and executed instructions is worth doing.
+        """
+        return lslcommon.Worth(self.objective, size, speed)
+
+    def MemoKey(self, value):
+        """Return a hashable value that identifies an LSL value and its
+        type. Lists are turned into tuples, and the sign of zero is kept.
+        """
+        t = type(value)
+        if t == float:
+            return (t, value, math.copysign(1., value))
+        if t in (list, Vector, Quaternion):
+            return (t, tuple(self.MemoKey(elem) for elem in value))
+        return (t, value)
+
+    def CallLibFunc(self, name, fn, args, evsym, unstable = False):
+        """Return the result of calling the implementation of a library
+        function, remembering it for the next calls with the same arguments,
+        including the ELSLCantCompute exceptions, unless it's unstable. evsym
+        is the symbol of the current event, for the detection functions, or
+        False for the rest.
+        """
+        if unstable:
+            self.foldcalls += 1
+            if evsym is False:
+                return fn(*args)
+            return fn(*args, evsym=evsym)
+        ctx = self.ctx
+        key = (name, tuple(self.MemoKey(arg) for arg in args), ctx.LSO,
+               frozenset(ctx.Bugs), None if evsym is False else self.CurEvent)
+        memo = self.foldmemo
+        if memo is None:
+            memo = self.foldmemo = OrderedDict()
+        self.foldcalls += 1
+        if key in memo:
+            # Mark it as recently used.
+            value = memo[key] = memo.pop(key)
+            self.foldhits += 1
+        else:
+            try:
+                if evsym is False:
+                    value = fn(*args)
+                else:
+                    value = fn(*args, evsym=evsym)
+            except lslfuncs.ELSLCantCompute:
+                value = lslfuncs.ELSLCantCompute
+            if len(memo) >= self.FoldMemoSize:
+                memo.popitem(last=False)
+            memo[key] = value
+        if value is lslfuncs.ELSLCantCompute:
+            raise lslfuncs.ELSLCantCompute()
+        # The caller may modify a list.
+        return list(value) if type(value) == list else value
+
+    def EqWorth(self, value):
+        """Return whether a == value should be transformed into a negation
+        (!a, !~a or !~-a). Only 0, -1 and 1 can be. The second saves 3 bytes
+        and executes one more instruction; the third saves 2 bytes and
+        executes 2 more instructions.
+        """
+        return (value == 0 or value == -1 and self.Worth(3, -1)
+                or value == 1 and self.Worth(2, -2))
+
     def isLocalVar(self, node):
         name = node.name
         scope = node.scope
@@ -108,56 +201,142 @@ class foldconst(object):
             else:
                 idx += 1
 
-    def CompareTrees(self, node1, node2):
+    def InvalidateHashes(self):
+        """Discard the structural hashes cached in the nodes. Must be called
+        after changing a subtree whose hash may have been taken, other than
+        through FoldTree. A stale hash can only make an equivalence go
+        unnoticed, never report a false one.
+        """
+        self.shashgen += 1
+
+    def HashValue(self, value):
+        """Return a hash of a constant that is equal for equal constants."""
+        if type(value) == list:
+            return hash(tuple(value))
+        return hash(value)
+
+    def StructHash(self, node):
+        """Return a hash of the subtree, such that subtrees considered
+        equivalent by CompareTrees have the same hash. Subtrees with different
+        hashes are therefore never equivalent, which makes it a quick way for
+        any pass to discard most mismatches before a full comparison.
+
+        The hashes of the inner nodes are cached in the nodes (attribute
+        shash). FoldTree discards the hashes of the nodes it folds, and
+        InvalidateHashes discards all of them, which the passes do before
+        and after changing the trees by other means.
+
+        Like SameTrees, the hashes take into account the type of every node,
+        and for constants, their value.
+        """
+        nt = node.nt
+        if nt == 'CONST':
+            return hash((nt, node.t, self.HashValue(node.value)))
+        if nt == 'IDENT':
+            return hash((nt, node.t, node.name, node.scope))
+        if nt not in self.hashed_ops:
+            # Never equivalent to any other node.
+            return hash((nt, id(node)))
+
+        gen = self.shashgen
+        cached = node.shash
+        if cached is not None and cached[0] == gen:
+            return cached[1]
+        # Find the inner nodes without a hash, and compute theirs deepest
+        # first, so that the hash of each child is known when needed. Deep
+        # trees would exceed the recursion limit otherwise.
+        pending = []
+        stack = [node]
+        while stack:
+            inner = stack.pop()
+            pending.append(inner)
+            for child in inner.ch:
+                if child.nt in self.hashed_ops:
+                    cached = child.shash
+                    if cached is None or cached[0] != gen:
+                        stack.append(child)
+        for inner in reversed(pending):
+            chh = [self.StructHash(child) for child in inner.ch]
+            if (inner.nt in self.commutative_ops
+                or inner.nt == '+' and inner.ch[0].t not in ('list', 'string')
+               ):
+                chh.sort()
+            inner.shash = (gen, hash((inner.nt, inner.t, inner.name,
+                                      tuple(chh))))
+        return node.shash[1]
+
+    def CompareTrees(self, node1, node2, proven = None):
         """Try to compare two subtrees to see if they are equivalent.
 
-        Returns True if they are."""
-        # They MUST be SEF and stable.
-        if not node1.SEF or not node2.SEF:
-            return False
-        if node1.t != node2.t:
+        Returns True if they are. If proven is given, it's a set of the pairs
+        of ids of the subtrees known to be equivalent, which is updated and
+        can be passed to the next comparisons while the trees don't change.
+        """
+        # The hashes discard most of the remaining mismatches, and tell which
+        # way the operands of commutative operators can match.
+        if (node1.nt != node2.nt or node1.t != node2.t
+            or self.StructHash(node1) != self.StructHash(node2)
+           ):
             return False
-        # It's not complete yet.
-        nt1 = node1.nt
-        if nt1 == node2.nt:
-            if (nt1 == 'IDENT'
-                and node1.name == node2.name
-                and node1.scope == node2.scope
-               ):
-                return True
-            if (nt1 == 'FNCALL'
-                and node1.name == node2.name
-                and 'uns' not in self.symtab[0][node1.name]
-                and all(self.CompareTrees(node1.ch[i],
-                                          node2.ch[i])
-                        for i in xrange(len(node1.ch)))
-               ):
-                return True
-            if (nt1 == 'CAST'
-                and self.CompareTrees(node1.ch[0], node2.ch[0])
-               ):
-                return True
-            if nt1 == 'CONST' and node1.value == node2.value:
-                return True
-            if (nt1 in ('!', '~', 'NEG')
-                and self.CompareTrees(node1.ch[0], node2.ch[0])
-               ):
-                return True
-            if (nt1 in self.binary_ops
-                and self.CompareTrees(node1.ch[0], node2.ch[0])
-                and self.CompareTrees(node1.ch[1], node2.ch[1])
-               ):
-                return True
-            if ((nt1 in ('*', '^', '&', '|', '==')  # commutative
-                 or nt1 == '+'
-                 and node1.ch[0].t not in ('list', 'string')
-                 and node2.ch[0].t not in ('list', 'string')
-                )
-                and self.CompareTrees(node1.ch[0], node2.ch[1])
-                and self.CompareTrees(node1.ch[1], node2.ch[0])
-               ):
-                return True
-        return False
+        return self.SameTrees(node1, node2, proven)
+
+    def SameTrees(self, node1, node2, proven = None):
+        """Iterative part of CompareTrees. The hashes of the inner nodes must
+        be known.
+        """
+        visited = []
+        stack = [(node1, node2)]
+        while stack:
+            node1, node2 = stack.pop()
+            if proven is not None:
+                pair = (id(node1), id(node2))
+                if pair in proven:
+                    continue
+                if node1.ch:
+                    visited.append(pair)
+            # They MUST be SEF and stable.
+            if not node1.SEF or not node2.SEF:
+                return False
+            if node1.t != node2.t or node1.nt != node2.nt:
+                return False
+            nt = node1.nt
+            if nt in self.hashed_ops and node1.shash != node2.shash:
+                return False
+            if nt == 'CONST':
+                if node1.value != node2.value:
+                    return False
+            elif nt == 'IDENT':
+                if node1.name != node2.name or node1.scope != node2.scope:
+                    return False
+            elif nt == 'FNCALL':
+                if (node1.name != node2.name
+                    or 'uns' in self.symtab[0][node1.name]
+                   ):
+                    return False
+                stack.extend(zip(node1.ch, node2.ch))
+            elif nt in ('CAST', '!', '~', 'NEG'):
+                stack.append((node1.ch[0], node2.ch[0]))
+            elif nt in self.binary_ops:
+                a1, b1 = node1.ch
+                a2, b2 = node2.ch
+                if ((nt in self.commutative_ops
+                     or nt == '+'
+                     and a1.t not in ('list', 'string')
+                     and a2.t not in ('list', 'string')
+                    )
+                    and not (self.StructHash(a1) == self.StructHash(a2)
+                             and self.StructHash(b1) == self.StructHash(b2))
+                   ):
+                    # They can only match with the operands swapped.
+                    a2, b2 = b2, a2
+                stack.append((a1, a2))
+                stack.append((b1, b2))
+            else:
+                return False
+        if proven is not None:
+            # All the pairs compared are equivalent.
+            proven.update(visited)
+        return True
 
     def FnSEF(self, node):
         '''Applied to function call nodes, return whether the node corresponds
@@ -217,7 +396,7 @@ class foldconst(object):
         # Under LSO, this would break the fact that 1-element lists count as
         # false, so we don't do it for LSO lists.
         if (ctyp in ('float', 'vector', 'rotation', 'string')
-            or ctyp == 'list' and not lslcommon.LSO
+            or ctyp == 'list' and not self.ctx.LSO
            ):
             parent[index] = nr(nt='!=', t='integer', ch=[parent[index],
                 nr(nt='CONST', t=ctyp, value=0.0 if ctyp == 'float'
@@ -359,8 +538,8 @@ class foldconst(object):
 
         if nt in self.binary_ops and child[0].t == child[1].t == 'integer':
             if nt == '==':
-                if (child[0].nt == 'CONST' and -1 <= child[0].value <= 1
-                    or child[1].nt == 'CONST' and -1 <= child[1].value <= 1
+                if (child[0].nt == 'CONST' and self.EqWorth(child[0].value)
+                    or child[1].nt == 'CONST' and self.EqWorth(child[1].value)
                    ):
                     # Transform a==b into !(a-b) if either a or b are in [-1,1]
                     parent[index] = nr(nt='!', t='integer', ch=[node])
@@ -610,8 +789,12 @@ class foldconst(object):
     def CopyNode(self, node):
         '''Deep copy of a node'''
         ret = node.copy()
-        if ret.ch:
-            ret.ch = [self.CopyNode(subnode) for subnode in ret.ch]
+        stack = [ret]
+        while stack:
+            node = stack.pop()
+            if node.ch:
+                node.ch = [subnode.copy() for subnode in node.ch]
+                stack.extend(node.ch)
         return ret
 
     def FoldTree(self, parent, index):
@@ -619,1377 +802,1513 @@ class foldconst(object):
         place.
 
         Also optimizes away IF, WHILE, etc.
+
+        The work is done by the method registered in FoldHandlers for the
+        node type.
         """
+        if self.folded is None:
+            # Outermost call. Fold the deep nodes first (see DeepNodes). The
+            # events and functions set the state for their bodies, so the
+            # traversal starts in them. Nodes without a handler, like the
+            # EXPRLIST of a FOR, are folded by their parents' handlers.
+            if parent[index].nt not in ('STDEF', 'FNDEF'):
+                self.folded = set()
+                try:
+                    for deepparent, deepindex in lslcommon.DeepNodes(parent,
+                                                                     index):
+                        if deepparent[deepindex].nt not in self.FoldHandlers:
+                            continue
+                        self.FoldTree(deepparent, deepindex)
+                        self.folded.add(deepparent[deepindex])
+                    self.FoldTree(parent, index)
+                finally:
+                    self.folded = None
+                return
+        elif parent[index] in self.folded:
+            # Only skip the descent from the parent; later passes over the
+            # node fold it again, as usual.
+            self.folded.discard(parent[index])
+            return
+        handler = self.FoldHandlers.get(parent[index].nt)
+        assert handler is not None, ('Internal error: This should not'
+            ' happen, node type = ' + parent[index].nt) # pragma: no cover
         node = parent[index]
-        nt = node.nt
-        child = node.ch
+        handler(self, parent, index)
+        # The handler may have changed the node in place, replaced it or
+        # removed it. The hashes of its ancestors are discarded as their
+        # handlers finish, and the rest of the tree keeps them.
+        node.shash = None
+        if index < len(parent):
+            parent[index].shash = None
+
+    def FoldConst(self, parent, index):
+        """Mark a constant as side-effect free."""
+        node = parent[index]
+        # Job already done. But mark as side-effect free.
+        node.SEF = True
 
-        if nt == 'CONST':
-            # Job already done. But mark as side-effect free.
-            node.SEF = True
-            return
+    def FoldCast(self, parent, index):
+        """Fold a type cast."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0)
+        node.SEF = child[0].SEF
+        if child[0].nt == 'CONST':
+            # Enable key constants. We'll typecast them back on output, but
+            # this enables some optimizations.
+            #if node.t != 'key': # key constants not possible
+
+                parent[index] = nr(nt='CONST', t=node.t, SEF=True,
+                    value=lslfuncs.typecast(
+                        child[0].value, lslcommon.LSLType2Python[node.t]))
+
+        # Remove casts of a type to the same type (NOP in Mono)
+        # This is not an optimization by itself, but it simplifies the job,
+        # by not needing to look into nested casts like (key)((key)...)
+        while node.nt == 'CAST' and child[0].t == node.t:
+            parent[index] = node = child[0]
+            if node.ch is None:
+                break
+            child = node.ch
 
-        if nt == 'CAST':
-            self.FoldTree(child, 0)
-            node.SEF = child[0].SEF
-            if child[0].nt == 'CONST':
-                # Enable key constants. We'll typecast them back on output, but
-                # this enables some optimizations.
-                #if node.t != 'key': # key constants not possible
-
-                    parent[index] = nr(nt='CONST', t=node.t, SEF=True,
-                        value=lslfuncs.typecast(
-                            child[0].value, lslcommon.LSLType2Python[node.t]))
-
-            # Remove casts of a type to the same type (NOP in Mono)
-            # This is not an optimization by itself, but it simplifies the job,
-            # by not needing to look into nested casts like (key)((key)...)
-            while node.nt == 'CAST' and child[0].t == node.t:
-                parent[index] = node = child[0]
-                if node.ch is None:
-                    break
-                child = node.ch
+    def FoldNeg(self, parent, index):
+        """Fold a unary minus."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0)
+        node.SEF = child[0].SEF
 
+        if child[0].nt == '+' and any(child[0].ch[i].nt == 'NEG'
+                                      for i in (0, 1)):
+            node = parent[index] = child[0]
+            child = node.ch
+            for a in (0, 1):
+                if child[a].nt == 'NEG':
+                    child[a] = child[a].ch[0]
+                else:
+                    child[a] = nr(nt='NEG', t=child[a].t, ch=[child[a]],
+                        SEF=child[a].SEF)
+                    self.FoldTree(child, a)
             return
 
-        if nt == 'NEG':
-            self.FoldTree(child, 0)
-            node.SEF = child[0].SEF
-
-            if child[0].nt == '+' and any(child[0].ch[i].nt == 'NEG'
-                                          for i in (0, 1)):
-                node = parent[index] = child[0]
-                child = node.ch
-                for a in (0, 1):
-                    if child[a].nt == 'NEG':
-                        child[a] = child[a].ch[0]
-                    else:
-                        child[a] = nr(nt='NEG', t=child[a].t, ch=[child[a]],
-                            SEF=child[a].SEF)
-                        self.FoldTree(child, a)
-                return
-
-            if child[0].nt == 'NEG':
-                # Double negation: - - expr  ->  expr
-                node = parent[index] = child[0].ch[0]
-                child = node.ch
-            elif child[0].nt == 'CONST':
-                node = parent[index] = child[0]
-                node.value = lslfuncs.neg(node.value)
-                child = None
-
-            if child and node.nt == 'NEG' and child[0].nt == '~':
-                track = child[0].ch[0]
-                const = 1
-                while track.nt == 'NEG' and track.ch[0].nt == '~':
-                    const += 1
-                    track = track.ch[0].ch[0]
-                if const > 2:
-                    # -~-~-~expr  ->  expr+3
-                    node = nr(nt='CONST', t='integer', SEF=True, value=const)
-                    node = nr(nt='+', t='integer', ch=[node, track],
-                        SEF=track.SEF)
-                    parent[index] = node
+        if child[0].nt == 'NEG':
+            # Double negation: - - expr  ->  expr
+            node = parent[index] = child[0].ch[0]
+            child = node.ch
+        elif child[0].nt == 'CONST':
+            node = parent[index] = child[0]
+            node.value = lslfuncs.neg(node.value)
+            child = None
+
+        if child and node.nt == 'NEG' and child[0].nt == '~':
+            track = child[0].ch[0]
+            const = 1
+            while track.nt == 'NEG' and track.ch[0].nt == '~':
+                const += 1
+                track = track.ch[0].ch[0]
+            if const > 2:
+                # -~-~-~expr  ->  expr+3
+                node = nr(nt='CONST', t='integer', SEF=True, value=const)
+                node = nr(nt='+', t='integer', ch=[node, track],
+                    SEF=track.SEF)
+                parent[index] = node
 
+    def FoldNot(self, parent, index):
+        """Fold a logical NOT."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0)
+        self.FoldAsBool(child, 0, True)
+        # !! does *not* cancel out (unless in cond)
+        subexpr = child[0]
+        snt = subexpr.nt
+
+        node.SEF = subexpr.SEF
+        if snt == 'CONST':
+            node = parent[index] = subexpr
+            node.value = int(not node.value)
             return
-
-        if nt == '!':
-            self.FoldTree(child, 0)
-            self.FoldAsBool(child, 0, True)
-            # !! does *not* cancel out (unless in cond)
-            subexpr = child[0]
-            snt = subexpr.nt
-
-            node.SEF = subexpr.SEF
-            if snt == 'CONST':
-                node = parent[index] = subexpr
-                node.value = int(not node.value)
+        if snt == '<':
+            lop = subexpr.ch[0]
+            rop = subexpr.ch[1]
+            if (lop.nt == 'CONST' and lop.t == rop.t == 'integer'
+                and lop.value < 2147483647
+               ):
+                lop.value += 1
+                subexpr.ch[0], subexpr.ch[1] = subexpr.ch[1], subexpr.ch[0]
+                parent[index] = subexpr # remove the !
                 return
-            if snt == '<':
-                lop = subexpr.ch[0]
-                rop = subexpr.ch[1]
-                if (lop.nt == 'CONST' and lop.t == rop.t == 'integer'
-                    and lop.value < 2147483647
-                   ):
-                    lop.value += 1
-                    subexpr.ch[0], subexpr.ch[1] = subexpr.ch[1], subexpr.ch[0]
-                    parent[index] = subexpr # remove the !
-                    return
-                if (rop.nt == 'CONST' and lop.t == rop.t == 'integer'
-                    and rop.value > int(-2147483648)
-                   ):
-                    rop.value -= 1
-                    subexpr.ch[0], subexpr.ch[1] = subexpr.ch[1], subexpr.ch[0]
-                    parent[index] = subexpr # remove the !
-                    return
-            if snt == '&':
-                a, b = 0, 1
-                if subexpr.ch[b].nt != 'CONST':
-                    a, b = 1, 0
-                if (subexpr.ch[b].nt == 'CONST'
-                    and subexpr.ch[b].value == int(-2147483648)
-                   ):
-                    # !(i & 0x80000000)  ->  -1 < i (because one of our
-                    # optimizations can be counter-productive, see FoldAsBool)
-                    subexpr.nt = '<'
-                    subexpr.ch[b].value = -1
-                    subexpr.ch = [subexpr.ch[b], subexpr.ch[a]]
-                    parent[index] = subexpr
-                    return
-            if snt == '!=' or snt == '^' or snt == '-' or snt == '+':
-                if snt == '+':
-                    # Change !(x + y) -> -x == y, and make another pass
-                    # to get rid of the signs where possible
-                    subexpr.ch[0] = nr(nt='NEG', t='integer',
-                        ch=[subexpr.ch[0]], SEF=subexpr.ch[0].SEF)
-
-                subexpr.nt = '=='
+            if (rop.nt == 'CONST' and lop.t == rop.t == 'integer'
+                and rop.value > int(-2147483648)
+               ):
+                rop.value -= 1
+                subexpr.ch[0], subexpr.ch[1] = subexpr.ch[1], subexpr.ch[0]
+                parent[index] = subexpr # remove the !
+                return
+        if snt == '&':
+            a, b = 0, 1
+            if subexpr.ch[b].nt != 'CONST':
+                a, b = 1, 0
+            if (subexpr.ch[b].nt == 'CONST'
+                and subexpr.ch[b].value == int(-2147483648)
+               ):
+                # !(i & 0x80000000)  ->  -1 < i (because one of our
+                # optimizations can be counter-productive, see FoldAsBool)
+                subexpr.nt = '<'
+                subexpr.ch[b].value = -1
+                subexpr.ch = [subexpr.ch[b], subexpr.ch[a]]
                 parent[index] = subexpr
+                return
+        if snt == '!=' or snt == '^' or snt == '-' or snt == '+':
+            if snt == '+':
+                # Change !(x + y) -> -x == y, and make another pass
+                # to get rid of the signs where possible
+                subexpr.ch[0] = nr(nt='NEG', t='integer',
+                    ch=[subexpr.ch[0]], SEF=subexpr.ch[0].SEF)
+
+            subexpr.nt = '=='
+            parent[index] = subexpr
+            self.FoldTree(parent, index)
+            return
+
+    def FoldBitNot(self, parent, index):
+        """Fold a bitwise NOT."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0)
+        subexpr = child[0]
+        node.SEF = subexpr.SEF
+
+        if child[0].nt == 'NEG':
+            track = child[0].ch[0]
+            const = -1
+            while track.nt == '~' and track.ch[0].nt == 'NEG':
+                const -= 1
+                track = track.ch[0].ch[0]
+            if const < -2:
+                # ~-~-~-expr  ->  expr + (-3)
+                node = nr(nt='CONST', t='integer', SEF=True, value=const)
+                node = nr(nt='+', t='integer', ch=[node, track],
+                    SEF=track.SEF)
+                parent[index] = node
                 self.FoldTree(parent, index)
                 return
 
-            return
+        if subexpr.nt == '~':
+            # Double negation: ~~expr
+            parent[index] = subexpr.ch[0]
+        elif subexpr.nt == 'CONST':
+            node = parent[index] = child[0]
+            node.value = ~node.value
 
-        if nt == '~':
-            self.FoldTree(child, 0)
-            subexpr = child[0]
-            node.SEF = subexpr.SEF
-
-            if child[0].nt == 'NEG':
-                track = child[0].ch[0]
-                const = -1
-                while track.nt == '~' and track.ch[0].nt == 'NEG':
-                    const -= 1
-                    track = track.ch[0].ch[0]
-                if const < -2:
-                    # ~-~-~-expr  ->  expr + (-3)
-                    node = nr(nt='CONST', t='integer', SEF=True, value=const)
-                    node = nr(nt='+', t='integer', ch=[node, track],
-                        SEF=track.SEF)
-                    parent[index] = node
-                    self.FoldTree(parent, index)
+    def FoldBinaryOp(self, parent, index):
+        """Fold a binary operator."""
+        node = parent[index]
+        nt = node.nt
+        child = node.ch
+        # RTL evaluation
+        self.FoldTree(child, 1)
+        self.FoldTree(child, 0)
+        # Node is SEF if both sides are side-effect free.
+        node.SEF = child[0].SEF and child[1].SEF
+
+        optype = node.t
+        lval = child[0]
+        ltype = lval.t
+        lnt = lval.nt
+        rval = child[1]
+        rtype = rval.t
+        rnt = rval.nt
+
+        if lnt == rnt == 'CONST':
+            op1 = lval.value
+            op2 = rval.value
+            if nt == '+':
+                if ltype == rtype == 'string' and not self.addstrings:
                     return
-
-            if subexpr.nt == '~':
-                # Double negation: ~~expr
-                parent[index] = subexpr.ch[0]
-            elif subexpr.nt == 'CONST':
-                node = parent[index] = child[0]
-                node.value = ~node.value
+                result = lslfuncs.add(op1, op2)
+            elif nt == '-':
+                result = lslfuncs.sub(op1, op2)
+            elif nt == '*':
+                result = lslfuncs.mul(op1, op2)
+            elif nt == '/':
+                try:
+                    result = lslfuncs.div(op1, op2)
+                except lslfuncs.ELSLMathError:
+                    return
+            elif nt == '%':
+                try:
+                    result = lslfuncs.mod(op1, op2)
+                except lslfuncs.ELSLMathError:
+                    return
+            elif nt == '<<':
+                result = lslfuncs.S32(op1 << (op2 & 31))
+            elif nt == '>>':
+                result = lslfuncs.S32(op1 >> (op2 & 31))
+            elif nt == '==' or nt == '!=':
+                result = lslfuncs.compare(op1, op2, Eq = (nt == '=='))
+            elif nt in ('<', '<=', '>', '>='):
+                if nt in ('>', '<='):
+                    result = lslfuncs.less(op2, op1)
+                else:
+                    result = lslfuncs.less(op1, op2)
+                if nt in ('>=', '<='):
+                    result = 1 - result
+            elif nt == '|':
+                result = op1 | op2
+            elif nt == '^':
+                result = op1 ^ op2
+            elif nt == '&':
+                result = op1 & op2
+            elif nt == '||':
+                result = int(bool(op1) or bool(op2))
+            elif nt == '&&':
+                result = int(bool(op1) and bool(op2))
+            else:
+                assert False, 'Internal error: Operator not found: ' + nt # pragma: no cover
+            parent[index] = nr(nt='CONST', t=node.t, SEF=True, value=result)
             return
 
-        if nt in self.binary_ops:
-            # RTL evaluation
-            self.FoldTree(child, 1)
-            self.FoldTree(child, 0)
-            # Node is SEF if both sides are side-effect free.
-            node.SEF = child[0].SEF and child[1].SEF
-
-            optype = node.t
-            lval = child[0]
-            ltype = lval.t
-            lnt = lval.nt
-            rval = child[1]
-            rtype = rval.t
-            rnt = rval.nt
-
-            if lnt == rnt == 'CONST':
-                op1 = lval.value
-                op2 = rval.value
-                if nt == '+':
-                    if ltype == rtype == 'string' and not self.addstrings:
-                        return
-                    result = lslfuncs.add(op1, op2)
-                elif nt == '-':
-                    result = lslfuncs.sub(op1, op2)
-                elif nt == '*':
-                    result = lslfuncs.mul(op1, op2)
-                elif nt == '/':
-                    try:
-                        result = lslfuncs.div(op1, op2)
-                    except lslfuncs.ELSLMathError:
-                        return
-                elif nt == '%':
-                    try:
-                        result = lslfuncs.mod(op1, op2)
-                    except lslfuncs.ELSLMathError:
-                        return
-                elif nt == '<<':
-                    result = lslfuncs.S32(op1 << (op2 & 31))
-                elif nt == '>>':
-                    result = lslfuncs.S32(op1 >> (op2 & 31))
-                elif nt == '==' or nt == '!=':
-                    result = lslfuncs.compare(op1, op2, Eq = (nt == '=='))
-                elif nt in ('<', '<=', '>', '>='):
-                    if nt in ('>', '<='):
-                        result = lslfuncs.less(op2, op1)
-                    else:
-                        result = lslfuncs.less(op1, op2)
-                    if nt in ('>=', '<='):
-                        result = 1 - result
-                elif nt == '|':
-                    result = op1 | op2
-                elif nt == '^':
-                    result = op1 ^ op2
-                elif nt == '&':
-                    result = op1 & op2
-                elif nt == '||':
-                    result = int(bool(op1) or bool(op2))
-                elif nt == '&&':
-                    result = int(bool(op1) and bool(op2))
-                else:
-                    assert False, 'Internal error: Operator not found: ' + nt # pragma: no cover
-                parent[index] = nr(nt='CONST', t=node.t, SEF=True, value=result)
+        # Simplifications for particular operands
+        if nt == '-':
+            if optype in ('vector', 'rotation'):
+                if lnt == 'CONST' and all(component == 0
+                        for component in lval.value):
+                    # Change <0,0,0[,0]>-expr  ->  -expr
+                    parent[index] = nr(nt='NEG', t=node.t, ch=[rval],
+                        SEF=rval.SEF)
+                elif rnt == 'CONST' and all(component == 0
+                        for component in rval.value):
+                    # Change expr-<0,0,0[,0]>  ->  expr
+                    parent[index] = lval
                 return
 
-            # Simplifications for particular operands
-            if nt == '-':
-                if optype in ('vector', 'rotation'):
-                    if lnt == 'CONST' and all(component == 0
-                            for component in lval.value):
-                        # Change <0,0,0[,0]>-expr  ->  -expr
-                        parent[index] = nr(nt='NEG', t=node.t, ch=[rval],
-                            SEF=rval.SEF)
-                    elif rnt == 'CONST' and all(component == 0
-                            for component in rval.value):
-                        # Change expr-<0,0,0[,0]>  ->  expr
-                        parent[index] = lval
-                    return
+            # Change - to + - for int/float
+            nt = node.nt = '+'
+            if child[1].nt == 'CONST':
+                rval.value = lslfuncs.neg(rval.value)
+            else:
+                rnt = 'NEG'
+                rval = child[1] = nr(nt=rnt, t=rval.t, ch=[rval],
+                    SEF=rval.SEF)
+                self.FoldTree(child, 1)
+                # rtype unchanged
 
-                # Change - to + - for int/float
-                nt = node.nt = '+'
-                if child[1].nt == 'CONST':
-                    rval.value = lslfuncs.neg(rval.value)
-                else:
-                    rnt = 'NEG'
-                    rval = child[1] = nr(nt=rnt, t=rval.t, ch=[rval],
-                        SEF=rval.SEF)
-                    self.FoldTree(child, 1)
-                    # rtype unchanged
+            # Fall through to simplify it as '+'
 
-                # Fall through to simplify it as '+'
+        if nt == '+':
+            # Tough one. Remove neutral elements for the various types,
+            # and more.
 
-            if nt == '+':
-                # Tough one. Remove neutral elements for the various types,
-                # and more.
-
-                # expr + -expr  ->  0
-                # -expr + expr  ->  0
-                if (child[0].nt == 'NEG'
-                    and self.CompareTrees(child[0].ch[0], child[1])
-                    or child[1].nt == 'NEG'
-                    and self.CompareTrees(child[1].ch[0], child[0])
-                   ):
-                    parent[index] = nr(nt='CONST', t='integer', value=0,
+            # expr + -expr  ->  0
+            # -expr + expr  ->  0
+            if (child[0].nt == 'NEG'
+                and self.CompareTrees(child[0].ch[0], child[1])
+                or child[1].nt == 'NEG'
+                and self.CompareTrees(child[1].ch[0], child[0])
+               ):
+                parent[index] = nr(nt='CONST', t='integer', value=0,
+                    SEF=True)
+                return
+
+            # Addition of integers, strings, and lists is associative.
+            # Addition of floats, vectors and rotations would be, except
+            # for FP precision.
+            # TODO: associative addition of lists
+            # Associative lists are trickier, because unlike the others,
+            # the types of the operands may not be lists
+            # so e.g. list+(integer+integer) != (list+integer)+integer.
+            if optype == 'integer' or optype == 'string' and self.addstrings:
+                if lnt == '+' and rnt == 'CONST' and lval.ch[1].nt == 'CONST':
+                    # (var + ct1) + ct2  ->  var + (ct1 + ct2)
+                    child[1] = nr(nt='+', t=optype, ch=[lval.ch[1], rval],
                         SEF=True)
-                    return
+                    lval = child[0] = lval.ch[0]
+                    lnt = lval.nt
+                    ltype = lval.t
+                    rtype = optype
+                    # Fold the RHS again now that we have it constant
+                    self.FoldTree(child, 1)
+                    rval = child[1]
+                    rnt = rval.nt
+
+            if optype == 'list' and not (ltype == rtype == 'list'):
+                if lnt == 'CONST' and ltype == 'list' and not lval.value:
+                    # [] + nonlist  ->  (list)nonlist
+                    parent[index] = self.Cast(rval, optype)
+                    # node is SEF if rval is
+                    parent[index].SEF = rval.SEF
+                return
 
-                # Addition of integers, strings, and lists is associative.
-                # Addition of floats, vectors and rotations would be, except
-                # for FP precision.
-                # TODO: associative addition of lists
-                # Associative lists are trickier, because unlike the others,
-                # the types of the operands may not be lists
-                # so e.g. list+(integer+integer) != (list+integer)+integer.
-                if optype == 'integer' or optype == 'string' and self.addstrings:
-                    if lnt == '+' and rnt == 'CONST' and lval.ch[1].nt == 'CONST':
-                        # (var + ct1) + ct2  ->  var + (ct1 + ct2)
-                        child[1] = nr(nt='+', t=optype, ch=[lval.ch[1], rval],
-                            SEF=True)
-                        lval = child[0] = lval.ch[0]
-                        lnt = lval.nt
-                        ltype = lval.t
-                        rtype = optype
-                        # Fold the RHS again now that we have it constant
-                        self.FoldTree(child, 1)
-                        rval = child[1]
-                        rnt = rval.nt
-
-                if optype == 'list' and not (ltype == rtype == 'list'):
-                    if lnt == 'CONST' and ltype == 'list' and not lval.value:
-                        # [] + nonlist  ->  (list)nonlist
-                        parent[index] = self.Cast(rval, optype)
-                        # node is SEF if rval is
-                        parent[index].SEF = rval.SEF
-                    return
+            if optype in ('vector', 'rotation'):
+                # not much to do with vectors or quaternions either
+                if lnt == 'CONST' and all(x == 0 for x in lval.value):
+                    # Change <0,0,0[,0]>+expr  ->  expr
+                    parent[index] = rval
+                elif rnt == 'CONST' and all(x == 0 for x in rval.value):
+                    # Change expr+<0,0,0[,0]>  ->  expr
+                    parent[index] = lval
+                return
 
-                if optype in ('vector', 'rotation'):
-                    # not much to do with vectors or quaternions either
-                    if lnt == 'CONST' and all(x == 0 for x in lval.value):
-                        # Change <0,0,0[,0]>+expr  ->  expr
-                        parent[index] = rval
-                    elif rnt == 'CONST' and all(x == 0 for x in rval.value):
-                        # Change expr+<0,0,0[,0]>  ->  expr
-                        parent[index] = lval
+            # Can't be key, as no combo of addition operands returns key
+            assert optype != 'key'
+
+            if optype in ('string', 'float', 'list'):
+                # All these types evaluate to boolean False when they are
+                # the neutral addition element.
+                if lnt == 'CONST' and not lval.value and (ltype == rtype
+                   or ltype == 'integer' and rtype == 'float'
+                   or ltype == 'float' and rtype == 'integer'):
+                    # 0  + fval  ->  fval
+                    # 0. + fval  ->  fval
+                    # 0. + ival  ->  fval
+                    # "" + sval  ->  sval
+                    # [] + lval  ->  lval
+                    parent[index] = self.Cast(rval, optype)
+                    # node is SEF if rval is
+                    parent[index].SEF = rval.SEF
+                    return
+                if rnt == 'CONST' and not rval.value and (rtype == ltype
+                   or rtype == 'integer' and ltype == 'float'
+                   or rtype == 'float' and ltype == 'integer'):
+                    # fval + 0   ->  fval
+                    # fval + 0.  ->  fval
+                    # ival + 0.  ->  fval
+                    # sval + ""  ->  sval
+                    # lval + []  ->  lval
+                    parent[index] = self.Cast(lval, optype)
+                    # node is SEF if lval is
+                    parent[index].SEF = lval.SEF
                     return
 
-                # Can't be key, as no combo of addition operands returns key
-                assert optype != 'key'
-
-                if optype in ('string', 'float', 'list'):
-                    # All these types evaluate to boolean False when they are
-                    # the neutral addition element.
-                    if lnt == 'CONST' and not lval.value and (ltype == rtype
-                       or ltype == 'integer' and rtype == 'float'
-                       or ltype == 'float' and rtype == 'integer'):
-                        # 0  + fval  ->  fval
-                        # 0. + fval  ->  fval
-                        # 0. + ival  ->  fval
-                        # "" + sval  ->  sval
-                        # [] + lval  ->  lval
-                        parent[index] = self.Cast(rval, optype)
-                        # node is SEF if rval is
-                        parent[index].SEF = rval.SEF
-                        return
-                    if rnt == 'CONST' and not rval.value and (rtype == ltype
-                       or rtype == 'integer' and ltype == 'float'
-                       or rtype == 'float' and ltype == 'integer'):
-                        # fval + 0   ->  fval
-                        # fval + 0.  ->  fval
-                        # ival + 0.  ->  fval
-                        # sval + ""  ->  sval
-                        # lval + []  ->  lval
-                        parent[index] = self.Cast(lval, optype)
-                        # node is SEF if lval is
-                        parent[index].SEF = lval.SEF
-                        return
-
-                    if ltype == rtype == 'list':
+                if ltype == rtype == 'list':
 
+                    if (rnt == 'LIST' and len(rval.ch) == 1
+                        or rnt == 'CONST' and len(rval.value) == 1
+                        or rnt == 'CAST'
+                       ):
+                        # list + (list)element  ->  list + element
+                        # list + [element]  ->  list + element
+                        while rnt == 'CAST' and rval.t == 'list':
+                            # Remove nested typecasts
+                            # e.g. list + (list)((list)x)  ->  list + x
+                            rval = parent[index].ch[1] = rval.ch[0]
+                            rnt = rval.nt
                         if (rnt == 'LIST' and len(rval.ch) == 1
-                            or rnt == 'CONST' and len(rval.value) == 1
-                            or rnt == 'CAST'
-                           ):
-                            # list + (list)element  ->  list + element
-                            # list + [element]  ->  list + element
-                            while rnt == 'CAST' and rval.t == 'list':
-                                # Remove nested typecasts
-                                # e.g. list + (list)((list)x)  ->  list + x
-                                rval = parent[index].ch[1] = rval.ch[0]
-                                rnt = rval.nt
-                            if (rnt == 'LIST' and len(rval.ch) == 1
-                               and rval.ch[0].t != 'list'):
-                                # Finally, remove [] wrapper if it's not
-                                # list within list
-                                rval = child[1] = rval.ch[0]
-                                rnt = rval.nt
-                            if rnt == 'CONST' and len(rval.value) == 1:
-                                # list + [constant]  ->  list + constant
-                                rval.value = rval.value[0]
-                                rtype = rval.t = lslcommon.PythonType2LSL[
-                                    type(rval.value)]
-                            return
-
-                        if (lnt == 'LIST' and len(lval.ch) == 1
-                            or lnt == 'CONST' and len(lval.value) == 1
-                            or lnt == 'CAST'
-                           ):
-                            # (list)element + list  ->  element + list
-                            # [element] + list  ->  element + list
-                            # (list)[element] + list  ->  element + list
-                            while lnt == 'CAST' and lval.t == 'list':
-                                # Remove nested typecasts
-                                # e.g. (list)((list)x) + list  ->  x + list
-                                lval = parent[index].ch[0] = lval.ch[0]
-                                lnt = lval.nt
-                            if (lnt == 'LIST' and len(lval.ch) == 1
-                               and lval.ch[0].t != 'list'):
-                                # Finally, remove [] wrapper if it's not
-                                # list within list
-                                lval = child[0] = lval.ch[0]
-                                lnt = lval.nt
-                            if lnt == 'CONST' and len(lval.value) == 1:
-                                # [constant] + list  ->  constant + list
-                                lval.value = lval.value[0]
-                                ltype = lval.t = lslcommon.PythonType2LSL[
-                                    type(lval.value)]
-                            return
-
-                    if optype == 'float' and rnt == 'CONST':
-                        # Addition of floats is commutative.
-                        # Put the constant first. May reduce stack.
-                        lval, rval = child[0], child[1] = child[1], child[0]
-                        lnt, rnt = rnt, lnt
-                        ltype, rtype = rtype, ltype
+                           and rval.ch[0].t != 'list'):
+                            # Finally, remove [] wrapper if it's not
+                            # list within list
+                            rval = child[1] = rval.ch[0]
+                            rnt = rval.nt
+                        if rnt == 'CONST' and len(rval.value) == 1:
+                            # list + [constant]  ->  list + constant
+                            rval.value = rval.value[0]
+                            rtype = rval.t = lslcommon.PythonType2LSL[
+                                type(rval.value)]
+                        return
 
-                    if (self.addstrings and optype == 'string' and rnt == '+'
-                        and rval.ch[0].nt == 'CONST' and lnt == 'CONST'
+                    if (lnt == 'LIST' and len(lval.ch) == 1
+                        or lnt == 'CONST' and len(lval.value) == 1
+                        or lnt == 'CAST'
                        ):
-                        # We have CONST + (CONST + expr) of strings.
-                        # Apply associativity to merge both constants.
-
-                        # Add the constants
-                        child[0].value = lslfuncs.add(child[0].value,
-                            rval.ch[0].value)
-                        # Prune the expr and graft it as RHS
-                        child[1] = rval.ch[1]
-                        # Re-optimize this node to apply it recursively
-                        return self.FoldTree(parent, index)
-
-                    # Nothing else to do with addition of float, string or list
-                    return
-
-                # Must be two integers. This allows for a number of
-                # optimizations. First the most obvious ones.
-                assert optype == 'integer'  # just to make sure
+                        # (list)element + list  ->  element + list
+                        # [element] + list  ->  element + list
+                        # (list)[element] + list  ->  element + list
+                        while lnt == 'CAST' and lval.t == 'list':
+                            # Remove nested typecasts
+                            # e.g. (list)((list)x) + list  ->  x + list
+                            lval = parent[index].ch[0] = lval.ch[0]
+                            lnt = lval.nt
+                        if (lnt == 'LIST' and len(lval.ch) == 1
+                           and lval.ch[0].t != 'list'):
+                            # Finally, remove [] wrapper if it's not
+                            # list within list
+                            lval = child[0] = lval.ch[0]
+                            lnt = lval.nt
+                        if lnt == 'CONST' and len(lval.value) == 1:
+                            # [constant] + list  ->  constant + list
+                            lval.value = lval.value[0]
+                            ltype = lval.t = lslcommon.PythonType2LSL[
+                                type(lval.value)]
+                        return
 
-                # Commutativity: place the constant first; may save stack and
-                # it helps simplifying
-                if rnt == 'CONST':
+                if optype == 'float' and rnt == 'CONST':
+                    # Addition of floats is commutative.
+                    # Put the constant first. May reduce stack.
                     lval, rval = child[0], child[1] = child[1], child[0]
                     lnt, rnt = rnt, lnt
                     ltype, rtype = rtype, ltype
 
-                if lnt == 'CONST' and lval.value == 0:
-                    # 0 + x = x
-                    parent[index] = rval
-                    return
-
-                if lnt == 'CONST' and rnt == '+' and rval.ch[0].nt == 'CONST':
-                    # We have CONST + (CONST + expr)
+                if (self.addstrings and optype == 'string' and rnt == '+'
+                    and rval.ch[0].nt == 'CONST' and lnt == 'CONST'
+                   ):
+                    # We have CONST + (CONST + expr) of strings.
                     # Apply associativity to merge both constants.
 
                     # Add the constants
-                    lval.value = lslfuncs.add(lval.value, rval.ch[0].value)
+                    child[0].value = lslfuncs.add(child[0].value,
+                        rval.ch[0].value)
                     # Prune the expr and graft it as RHS
                     child[1] = rval.ch[1]
-
-                    # Re-optimize the result, to possibly apply -~ or ~- if
-                    # appropriate.
+                    # Re-optimize this node to apply it recursively
                     return self.FoldTree(parent, index)
 
-                while lnt == 'CONST' and rnt == 'NEG' and rval.ch[0].nt == '~':
-                    lval.value += 1
-                    child[1] = rval.ch[0].ch[0]
-                    # rtype doesn't change
-                    assert child[1].t == 'integer'
-                    self.FoldTree(parent, index)
-                    node = parent[index]
-                    nt, child = node.nt, node.ch
-                    if nt != '+':
-                        return
-                    lval, rval = child[0], child[1]
-                    lnt, rnt = lval.nt, rval.nt
-                    ltype, rtype = lval.t, rval.t
-
-                while lnt == 'CONST' and rnt == '~' and rval.ch[0].nt == 'NEG':
-                    lval.value -= 1
-                    child[1] = rval.ch[0].ch[0]
-                    # rtype doesn't change
-                    assert child[1].t == 'integer'
-                    self.FoldTree(parent, index)
-                    node = parent[index]
-                    nt, child = node.nt, node.ch
-                    if nt != '+':
-                        return
-                    lval, rval = child[0], child[1]
-                    lnt, rnt = lval.nt, rval.nt
-                    ltype, rtype = lval.t, rval.t
-
-                if lnt != 'CONST':
-                    # Neither is const.
-                    # The case expr - expr  ->  0 has been handled earlier
-                    # because it's more general and applies to floats as well.
-
-                    # -expr + -expr  ->  -(expr + expr) (saves 1 byte)
-                    if lnt == rnt == 'NEG':
-                        node = nr(nt='+', t=optype, ch=[lval.ch[0], rval.ch[0]],
-                            SEF=lval.ch[0].SEF and rval.ch[0].SEF)
-                        node = nr(nt='NEG', t=optype, ch=[node], SEF=node.SEF)
-                        parent[index] = node
-                        return
-
-                    return
+                # Nothing else to do with addition of float, string or list
+                return
 
-                RSEF = rval.SEF
-
-                if lval.value == -1 or lval.value == -2:
-                    if rnt == 'NEG': # Cancel the NEG
-                        node = nr(nt='~', t=optype, ch=rval.ch, SEF=RSEF)
-                    else: # Add the NEG
-                        node = nr(nt='NEG', t=optype, ch=[rval], SEF=RSEF)
-                        node = nr(nt='~', t=optype, ch=[node], SEF=RSEF)
-                    if lval.value == -2:
-                        node = nr(nt='NEG', t=optype, ch=[node], SEF=RSEF)
-                        node = nr(nt='~', t=optype, ch=[node], SEF=RSEF)
-                    parent[index] = node
-                    return
+            # Must be two integers. This allows for a number of
+            # optimizations. First the most obvious ones.
+            assert optype == 'integer'  # just to make sure
 
-                if lval.value == 1 or lval.value == 2:
-                    if rnt == '~': # Cancel the ~
-                        node = nr(nt='NEG', t=optype, ch=rval.ch, SEF=RSEF)
-                    else:
-                        node = nr(nt='~', t=optype, ch=[rval], SEF=RSEF)
-                        node = nr(nt='NEG', t=optype, ch=[node], SEF=RSEF)
-                    if lval.value == 2:
-                        node = nr(nt='~', t=optype, ch=[node], SEF=RSEF)
-                        node = nr(nt='NEG', t=optype, ch=[node], SEF=RSEF)
-                    parent[index] = node
-                    return
-
-                # More than 2 becomes counter-productive.
+            # Commutativity: place the constant first; may save stack and
+            # it helps simplifying
+            if rnt == 'CONST':
+                lval, rval = child[0], child[1] = child[1], child[0]
+                lnt, rnt = rnt, lnt
+                ltype, rtype = rtype, ltype
 
+            if lnt == 'CONST' and lval.value == 0:
+                # 0 + x = x
+                parent[index] = rval
                 return
 
-            if nt == '<<' and child[1].nt == 'CONST':
-                # Transforming << into multiply saves some bytes.
-                if child[1].value & 31:
-                    # x << 3  -->  x * 8
+            if lnt == 'CONST' and rnt == '+' and rval.ch[0].nt == 'CONST':
+                # We have CONST + (CONST + expr)
+                # Apply associativity to merge both constants.
 
-                    # we have {<<, something, {CONST n}}
-                    # we transform it into {*, something, {CONST n}}
-                    nt = node.nt = '*'
-                    child[1].value = lslfuncs.S32(1 << (child[1].value & 31))
+                # Add the constants
+                lval.value = lslfuncs.add(lval.value, rval.ch[0].value)
+                # Prune the expr and graft it as RHS
+                child[1] = rval.ch[1]
 
-                    # Fall through to optimize product
+                # Re-optimize the result, to possibly apply -~ or ~- if
+                # appropriate.
+                return self.FoldTree(parent, index)
 
-                else: # x << 0  -->  x
-                    parent[index] = child[0]
+            while lnt == 'CONST' and rnt == 'NEG' and rval.ch[0].nt == '~':
+                lval.value += 1
+                child[1] = rval.ch[0].ch[0]
+                # rtype doesn't change
+                assert child[1].t == 'integer'
+                self.FoldTree(parent, index)
+                node = parent[index]
+                nt, child = node.nt, node.ch
+                if nt != '+':
                     return
-
-            if (nt == '%' and child[1].nt == 'CONST'
-                          and child[1].t == 'integer'
-                          and abs(child[1].value) == 1):
-                # a%1  ->  a&0
-                # a%-1  ->  a&0
-                # (SEF analysis performed below)
-                nt = node.nt = '&'
-                child[1].value = 0
+                lval, rval = child[0], child[1]
+                lnt, rnt = lval.nt, rval.nt
+                ltype, rtype = lval.t, rval.t
+
+            while lnt == 'CONST' and rnt == '~' and rval.ch[0].nt == 'NEG':
+                lval.value -= 1
+                child[1] = rval.ch[0].ch[0]
+                # rtype doesn't change
+                assert child[1].t == 'integer'
                 self.FoldTree(parent, index)
+                node = parent[index]
+                nt, child = node.nt, node.ch
+                if nt != '+':
+                    return
+                lval, rval = child[0], child[1]
+                lnt, rnt = lval.nt, rval.nt
+                ltype, rtype = lval.t, rval.t
+
+            if lnt != 'CONST':
+                # Neither is const.
+                # The case expr - expr  ->  0 has been handled earlier
+                # because it's more general and applies to floats as well.
+
+                # -expr + -expr  ->  -(expr + expr) (saves 1 byte)
+                if lnt == rnt == 'NEG':
+                    node = nr(nt='+', t=optype, ch=[lval.ch[0], rval.ch[0]],
+                        SEF=lval.ch[0].SEF and rval.ch[0].SEF)
+                    node = nr(nt='NEG', t=optype, ch=[node], SEF=node.SEF)
+                    parent[index] = node
+                    return
+
                 return
 
-            if nt in ('*', '/'):
-                # TODO: <0,0,0,1>*rot, rot*<0,0,0,1>, rot/<0,0,0,1>  ->  rot
-                #       <0,0,0,1>/<x,y,z,s>  ->  <-x,-y,-z, s>
-                #       <0,0,0>*vec  ->  0 if SEF
-                #       <0,0,0>*rot  ->  <0,0,0> if SEF
-                # Extract signs outside
-                if child[0].nt == 'NEG' or child[1].nt == 'NEG':
-                    a, b = 0, 1
-                    if child[b].nt == 'NEG':
-                        a, b = 1, 0
-                    child[a] = child[a].ch[0]
-                    parent[index] = node = nr(nt='NEG', t=node.t, ch=[node],
-                        SEF = node.SEF)
-                    # Fold the new expression
-                    self.FoldTree(parent, index)
-                    return
+            RSEF = rval.SEF
 
-                # Deal with operands in any order
-                a, b = 0, 1
-                if child[a].nt == 'CONST' and child[a].t in ('float', 'integer'):
-                    a, b = 1, 0
+            # x + 1  ->  -~x saves 4 bytes; x + 2  ->  -~-~x saves 2 bytes
+            # but executes 2 more instructions.
+            if lval.value in (-2, 2) and not self.Worth(2, -2):
+                return
 
-                if child[b].nt == 'CONST':
-                    val = child[b].value
-
-                    # Optimize out signs if possible.
-                    # Note that (-intvar)*floatconst needs cornermath because
-                    # -intvar could equal intvar if intvar = -2147483648,
-                    # so the sign is a no-op and pushing it to floatconst would
-                    # make the result be different.
-                    if (child[a].nt == 'NEG'
-                        and (self.cornermath
-                            or child[a].t != 'integer'
-                            or child[b].t != 'float')
-                       ):
-                        # Expression is of the form (-float)*const or (-float)/const or const/(-float)
-                        if val != int(-2147483648) or child[a].t == 'integer': # can't be optimized otherwise
-                            child[a] = child[a].ch[0] # remove NEG
-                            child[b].value = val = -val
-
-                    # Five optimizations corresponding to -2, -1, 0, 1, 2
-                    # for product, and two for division:
-                    # expr * 1  ->  expr
-                    # expr * 0  ->  0  if side-effect free
-                    # expr * -1  -> -expr
-                    # ident * 2  ->  ident + ident (only if ident is local)
-                    # ident * -2  ->  -(ident + ident) (only if ident is local)
-                    # expr/1  ->  expr
-                    # expr/-1  ->  -expr
-                    if (nt == '*' and child[b].t in ('float', 'integer')
-                           and val in (-2, -1, 0, 1, 2)
-                        or nt == '/'
-                           and b == 1 and val in (-1, 1)
-                       ):
-                        if val == 1:
-                            parent[index] = self.Cast(child[a], optype)
-                            self.FoldTree(parent, index)
-                            return
-                        if val == 0:
-                            if child[a].SEF:
-                                parent[index] = self.Cast(child[b], optype)
-                                self.FoldTree(parent, index)
-                            return
-                        if val == -1:
-                            # Note 0.0*-1 equals -0.0 in LSL, so this is safe
-                            node = parent[index] = nr(nt='NEG', t=node.t,
-                                ch=[self.Cast(child[a], optype)],
-                                SEF=child[a].SEF)
-                            self.FoldTree(parent, index)
-                            return
-                        # only -2, 2 remain
-                        if child[a].nt == 'IDENT' and self.isLocalVar(child[a]):
-                            child[b] = self.Cast(child[a].copy(), optype)
-                            node.nt = '+'
-                            if val == -2:
-                                parent[index] = nr(nt='NEG', t=optype,
-                                    ch=[node], SEF=node.SEF)
-                            self.FoldTree(parent, index)
-                            return
+            if lval.value == -1 or lval.value == -2:
+                if rnt == 'NEG': # Cancel the NEG
+                    node = nr(nt='~', t=optype, ch=rval.ch, SEF=RSEF)
+                else: # Add the NEG
+                    node = nr(nt='NEG', t=optype, ch=[rval], SEF=RSEF)
+                    node = nr(nt='~', t=optype, ch=[node], SEF=RSEF)
+                if lval.value == -2:
+                    node = nr(nt='NEG', t=optype, ch=[node], SEF=RSEF)
+                    node = nr(nt='~', t=optype, ch=[node], SEF=RSEF)
+                parent[index] = node
                 return
 
-            if nt == '==':
-                if child[0].t == child[1].t == 'integer':
-                    # Deal with operands in any order
-                    a, b = 0, 1
-                    if child[b].nt != 'CONST':
-                        a, b = 1, 0
-
-                    # a == -1 (in any order)  ->  !~a,
-                    # a == 0  ->  !a
-                    # a == 1  ->  !~-a
-                    if child[b].nt == 'CONST':
-                        if child[b].value in (-1, 0, 1):
-                            node = child[a]
-                            if child[b].value == -1:
-                                node = nr(nt='~', t='integer', ch=[node],
-                                    SEF=node.SEF)
-                            elif child[b].value == 1:
-                                node = nr(nt='NEG', t='integer', ch=[node],
-                                    SEF=node.SEF)
-                                node = nr(nt='~', t='integer', ch=[node],
-                                    SEF=node.SEF)
-                            node = parent[index] = nr(nt='!', t='integer',
-                                ch=[node], SEF=node.SEF)
-                            # Can't delete
-                # See https://docs.python.org/2/reference/simple_stmts.html#del
-                            child = None
-                            self.FoldTree(parent, index)
-                            return
+            if lval.value == 1 or lval.value == 2:
+                if rnt == '~': # Cancel the ~
+                    node = nr(nt='NEG', t=optype, ch=rval.ch, SEF=RSEF)
+                else:
+                    node = nr(nt='~', t=optype, ch=[rval], SEF=RSEF)
+                    node = nr(nt='NEG', t=optype, ch=[node], SEF=RSEF)
+                if lval.value == 2:
+                    node = nr(nt='~', t=optype, ch=[node], SEF=RSEF)
+                    node = nr(nt='NEG', t=optype, ch=[node], SEF=RSEF)
+                parent[index] = node
+                return
 
-                    # -a == -b  ->  a == b with const variations.
-                    # Note this changes the sign of two CONSTs but that case
-                    # should not reach here, as those are resolved earlier.
-                    if ((child[0].nt == 'NEG' or child[0].nt == 'CONST')
-                        and
-                        (child[1].nt == 'NEG' or child[1].nt == 'CONST')
-                       ):
-                        for a in (0, 1):
-                            if child[a].nt == 'NEG':
-                                child[a] = child[a].ch[0]  # remove sign
-                            else:
-                                child[a].value = lslfuncs.neg(
-                                    child[a].value)
+            # More than 2 becomes counter-productive.
 
+            return
 
-                if self.CompareTrees(child[0], child[1]):
-                    # expr == expr  ->  1
-                    # FIXME: not true if NaN
-                    parent[index] = nr(nt='CONST', t='integer', value=1,
-                        SEF=True)
-                    return
-                # TODO: Simplify if ((x & y) == y) for constant y to if (!(~x & y))
+        if nt == '<<' and child[1].nt == 'CONST':
+            # Transforming << into multiply saves some bytes.
+            if child[1].value & 31:
+                # x << 3  -->  x * 8
+
+                # we have {<<, something, {CONST n}}
+                # we transform it into {*, something, {CONST n}}
+                nt = node.nt = '*'
+                child[1].value = lslfuncs.S32(1 << (child[1].value & 31))
+
+                # Fall through to optimize product
+
+            else: # x << 0  -->  x
+                parent[index] = child[0]
                 return
 
-            if nt in ('<=', '>=') or nt == '!=' and child[0].t != 'list':
-                # Except for list != list, all these comparisons are compiled
-                # as !(a>b) etc. so we transform them here in order to reduce
-                # the number of cases to check.
-                # a<=b  -->  !(a>b);  a>=b  -->  !(a<b);  a!=b  -->  !(a==b)
-                node.nt = {'<=':'>', '>=':'<', '!=':'=='}[nt]
-                parent[index] = nr(nt='!', t=node.t, ch=[node])
+        if (nt == '%' and child[1].nt == 'CONST'
+                      and child[1].t == 'integer'
+                      and abs(child[1].value) == 1):
+            # a%1  ->  a&0
+            # a%-1  ->  a&0
+            # (SEF analysis performed below)
+            nt = node.nt = '&'
+            child[1].value = 0
+            self.FoldTree(parent, index)
+            return
+
+        if nt in ('*', '/'):
+            # TODO: <0,0,0,1>*rot, rot*<0,0,0,1>, rot/<0,0,0,1>  ->  rot
+            #       <0,0,0,1>/<x,y,z,s>  ->  <-x,-y,-z, s>
+            #       <0,0,0>*vec  ->  0 if SEF
+            #       <0,0,0>*rot  ->  <0,0,0> if SEF
+            # Extract signs outside
+            if child[0].nt == 'NEG' or child[1].nt == 'NEG':
+                a, b = 0, 1
+                if child[b].nt == 'NEG':
+                    a, b = 1, 0
+                child[a] = child[a].ch[0]
+                parent[index] = node = nr(nt='NEG', t=node.t, ch=[node],
+                    SEF = node.SEF)
+                # Fold the new expression
                 self.FoldTree(parent, index)
                 return
 
-            if nt == '>' and (child[0].SEF and child[1].SEF
-                or child[0].nt == 'CONST'
-                or child[1].nt == 'CONST'
-               ):
-                # Invert the inequalities to avoid doubling the cases to check.
-                # a>b  ->  b<a
-                nt = node.nt = '<'
-                child[1], child[0] = child[0], child[1]
-                # fall through to check for '<'
-
-            if nt == '<':
-                # expr < expr  ->  0
-                if self.CompareTrees(child[0], child[1]):
-                    parent[index] = nr(nt='CONST', t='integer', value=0,
-                        SEF=True)
-                    return
-                if child[0].t == child[1].t in ('integer', 'float'):
-                    if (child[0].nt == 'CONST'
-                        and child[1].nt == 'FNCALL'
-                        and self.FnSEF(child[1])
-                       ):
-                        # CONST < FNCALL aka FNCALL > CONST
-                        # when FNCALL.max <= CONST: always false
-                        # when CONST < FNCALL.min: always true
-                        if ('max' in self.symtab[0][child[1].name]
-                            and not lslfuncs.less(child[0].value,
-                                self.symtab[0][child[1].name]['max'])
-                           ):
-                            parent[index] = nr(nt='CONST', t='integer',
-                                value=0, SEF=True)
-                            return
-                        if ('min' in self.symtab[0][child[1].name]
-                            and lslfuncs.less(child[0].value,
-                                self.symtab[0][child[1].name]['min'])
-                           ):
-                            parent[index] = nr(nt='CONST', t='integer',
-                                value=1, SEF=True)
-                            return
-                    if (child[1].nt == 'CONST'
-                        and child[0].nt == 'FNCALL'
-                        and self.FnSEF(child[0])
-                       ):
-                        # FNCALL < CONST
-                        # when CONST > FNCALL.max: always true
-                        # when CONST <= FNCALL.min: always false
-                        if ('max' in self.symtab[0][child[0].name]
-                            and lslfuncs.less(
-                                self.symtab[0][child[0].name]['max']
-                                , child[1].value)
-                           ):
-                            parent[index] = nr(nt='CONST', t='integer',
-                                value=1, SEF=True)
-                            return
-                        if ('min' in self.symtab[0][child[0].name]
-                            and not lslfuncs.less(
-                                self.symtab[0][child[0].name]['min'],
-                                child[1].value)
-                           ):
-                            parent[index] = nr(nt='CONST', t='integer',
-                                value=0, SEF=True)
-                            return
-
-                # Convert 2147483647<i and i<-2147483648 to i&0
-                if (child[0].t == child[1].t == 'integer'
-                    and (child[0].nt == 'CONST'
-                           and child[0].value == 2147483647
-                        or child[1].nt == 'CONST'
-                           and child[1].value == int(-2147483648))
+            # Deal with operands in any order
+            a, b = 0, 1
+            if child[a].nt == 'CONST' and child[a].t in ('float', 'integer'):
+                a, b = 1, 0
+
+            if child[b].nt == 'CONST':
+                val = child[b].value
+
+                # Optimize out signs if possible.
+                # Note that (-intvar)*floatconst needs cornermath because
+                # -intvar could equal intvar if intvar = -2147483648,
+                # so the sign is a no-op and pushing it to floatconst would
+                # make the result be different.
+                if (child[a].nt == 'NEG'
+                    and (self.cornermath
+                        or child[a].t != 'integer'
+                        or child[b].t != 'float')
                    ):
-                    a, b = 0, 1
-                    # Put the constant in child[b]
-                    if child[a].nt == 'CONST':
-                        a, b = b, a
-                    nt = node.nt = '&'
-                    child[b].value = 0
-                    # fall through to check for '&'
-                else:
-                    return
-
-            if nt in ('&', '|'):
-                # expr & expr  ->  expr
-                # expr | expr  ->  expr
-                if self.CompareTrees(child[0], child[1]):
-                    parent[index] = child[0]
-                    return
+                    # Expression is of the form (-float)*const or (-float)/const or const/(-float)
+                    if val != int(-2147483648) or child[a].t == 'integer': # can't be optimized otherwise
+                        child[a] = child[a].ch[0] # remove NEG
+                        child[b].value = val = -val
+
+                # Five optimizations corresponding to -2, -1, 0, 1, 2
+                # for product, and two for division:
+                # expr * 1  ->  expr
+                # expr * 0  ->  0  if side-effect free
+                # expr * -1  -> -expr
+                # ident * 2  ->  ident + ident (only if ident is local)
+                # ident * -2  ->  -(ident + ident) (only if ident is local)
+                # expr/1  ->  expr
+                # expr/-1  ->  -expr
+                if (nt == '*' and child[b].t in ('float', 'integer')
+                       and val in (-2, -1, 0, 1, 2)
+                    or nt == '/'
+                       and b == 1 and val in (-1, 1)
+                   ):
+                    if val == 1:
+                        parent[index] = self.Cast(child[a], optype)
+                        self.FoldTree(parent, index)
+                        return
+                    if val == 0:
+                        if child[a].SEF:
+                            parent[index] = self.Cast(child[b], optype)
+                            self.FoldTree(parent, index)
+                        return
+                    if val == -1:
+                        # Note 0.0*-1 equals -0.0 in LSL, so this is safe
+                        node = parent[index] = nr(nt='NEG', t=node.t,
+                            ch=[self.Cast(child[a], optype)],
+                            SEF=child[a].SEF)
+                        self.FoldTree(parent, index)
+                        return
+                    # only -2, 2 remain
+                    if child[a].nt == 'IDENT' and self.isLocalVar(child[a]):
+                        child[b] = self.Cast(child[a].copy(), optype)
+                        node.nt = '+'
+                        if val == -2:
+                            parent[index] = nr(nt='NEG', t=optype,
+                                ch=[node], SEF=node.SEF)
+                        self.FoldTree(parent, index)
+                        return
+            return
 
+        if nt == '==':
+            if child[0].t == child[1].t == 'integer':
                 # Deal with operands in any order
                 a, b = 0, 1
-                # Put constant in child[b]
                 if child[b].nt != 'CONST':
                     a, b = 1, 0
 
+                # a == -1 (in any order)  ->  !~a,
+                # a == 0  ->  !a
+                # a == 1  ->  !~-a
                 if child[b].nt == 'CONST':
-                    val = child[b].value
-                    if (nt == '|' and val == 0
-                        or nt == '&'
-                           and (val == -1
-                                or val == 1 and self.IsBool(child[a]))
-                       ):
-                        # a|0  ->  a
-                        # a&-1  ->  a
-                        # a&1  ->  a if a is boolean
-                        parent[index] = child[a]
+                    if self.EqWorth(child[b].value):
+                        node = child[a]
+                        if child[b].value == -1:
+                            node = nr(nt='~', t='integer', ch=[node],
+                                SEF=node.SEF)
+                        elif child[b].value == 1:
+                            node = nr(nt='NEG', t='integer', ch=[node],
+                                SEF=node.SEF)
+                            node = nr(nt='~', t='integer', ch=[node],
+                                SEF=node.SEF)
+                        node = parent[index] = nr(nt='!', t='integer',
+                            ch=[node], SEF=node.SEF)
+                        # Can't delete
+            # See https://docs.python.org/2/reference/simple_stmts.html#del
+                        child = None
+                        self.FoldTree(parent, index)
                         return
-                    if (nt == '|'
-                        and (val == -1
-                             or (val & 1) == 1 and self.IsBool(child[a]))
-                        or nt == '&' and val == 0
-                       ):
-                        # a|-1  ->  -1 if a is SEF
-                        # a|C  ->  C if bit 0 of C is 1 and a is bool and SEF
-                        # a&0  ->  0 if a is SEF
-                        if child[a].SEF:
-                            parent[index] = child[b]
-
-                # Apply boolean distributivity
-                applied = False
-                opposite = '&' if nt == '|' else '|'
-                if child[0].nt == child[1].nt == opposite:
-                    left = child[0].ch
-                    right = child[1].ch
-                    # Can't loop individually because we must break out of both
-                    for c, d in ((0, 0), (0, 1), (1, 0), (1, 1)):
-                        if self.CompareTrees(left[c], right[d]):
-                            child[1].nt = nt
-                            nt = node.nt = opposite
-                            opposite = child[1].nt
-                            right[d] = left[1 - c]
-                            child[0] = left[c]
-                            applied = True
-                            break
 
-                # Apply absorption, possibly after distributivity
-                if child[0].nt == opposite or child[1].nt == opposite:
-                    c = 0 if child[1].nt == opposite else 1
-                    for d in (0, 1):
-                        if (self.CompareTrees(child[c], child[1 - c].ch[d])
-                            and child[1 - c].ch[1 - d].SEF
-                           ):
-                            node = parent[index] = child[c]
-                            nt = node.nt
-                            child = node.ch
-                            applied = True
-                            break
+                # -a == -b  ->  a == b with const variations.
+                # Note this changes the sign of two CONSTs but that case
+                # should not reach here, as those are resolved earlier.
+                if ((child[0].nt == 'NEG' or child[0].nt == 'CONST')
+                    and
+                    (child[1].nt == 'NEG' or child[1].nt == 'CONST')
+                   ):
+                    for a in (0, 1):
+                        if child[a].nt == 'NEG':
+                            child[a] = child[a].ch[0]  # remove sign
+                        else:
+                            child[a].value = lslfuncs.neg(
+                                child[a].value)
+
+
+            if self.CompareTrees(child[0], child[1]):
+                # expr == expr  ->  1
+                # FIXME: not true if NaN
+                parent[index] = nr(nt='CONST', t='integer', value=1,
+                    SEF=True)
+                return
+            # TODO: Simplify if ((x & y) == y) for constant y to if (!(~x & y))
+            return
 
-                if applied:
-                    # Re-fold
-                    self.FoldTree(parent, index)
+        if nt in ('<=', '>=') or nt == '!=' and child[0].t != 'list':
+            # Except for list != list, all these comparisons are compiled
+            # as !(a>b) etc. so we transform them here in order to reduce
+            # the number of cases to check.
+            # a<=b  -->  !(a>b);  a>=b  -->  !(a<b);  a!=b  -->  !(a==b)
+            node.nt = {'<=':'>', '>=':'<', '!=':'=='}[nt]
+            parent[index] = nr(nt='!', t=node.t, ch=[node])
+            self.FoldTree(parent, index)
+            return
 
+        if nt == '>' and (child[0].SEF and child[1].SEF
+            or child[0].nt == 'CONST'
+            or child[1].nt == 'CONST'
+           ):
+            # Invert the inequalities to avoid doubling the cases to check.
+            # a>b  ->  b<a
+            nt = node.nt = '<'
+            child[1], child[0] = child[0], child[1]
+            # fall through to check for '<'
+
+        if nt == '<':
+            # expr < expr  ->  0
+            if self.CompareTrees(child[0], child[1]):
+                parent[index] = nr(nt='CONST', t='integer', value=0,
+                    SEF=True)
                 return
+            if child[0].t == child[1].t in ('integer', 'float'):
+                if (child[0].nt == 'CONST'
+                    and child[1].nt == 'FNCALL'
+                    and self.FnSEF(child[1])
+                   ):
+                    # CONST < FNCALL aka FNCALL > CONST
+                    # when FNCALL.max <= CONST: always false
+                    # when CONST < FNCALL.min: always true
+                    if ('max' in self.symtab[0][child[1].name]
+                        and not lslfuncs.less(child[0].value,
+                            self.symtab[0][child[1].name]['max'])
+                       ):
+                        parent[index] = nr(nt='CONST', t='integer',
+                            value=0, SEF=True)
+                        return
+                    if ('min' in self.symtab[0][child[1].name]
+                        and lslfuncs.less(child[0].value,
+                            self.symtab[0][child[1].name]['min'])
+                       ):
+                        parent[index] = nr(nt='CONST', t='integer',
+                            value=1, SEF=True)
+                        return
+                if (child[1].nt == 'CONST'
+                    and child[0].nt == 'FNCALL'
+                    and self.FnSEF(child[0])
+                   ):
+                    # FNCALL < CONST
+                    # when CONST > FNCALL.max: always true
+                    # when CONST <= FNCALL.min: always false
+                    if ('max' in self.symtab[0][child[0].name]
+                        and lslfuncs.less(
+                            self.symtab[0][child[0].name]['max']
+                            , child[1].value)
+                       ):
+                        parent[index] = nr(nt='CONST', t='integer',
+                            value=1, SEF=True)
+                        return
+                    if ('min' in self.symtab[0][child[0].name]
+                        and not lslfuncs.less(
+                            self.symtab[0][child[0].name]['min'],
+                            child[1].value)
+                       ):
+                        parent[index] = nr(nt='CONST', t='integer',
+                            value=0, SEF=True)
+                        return
 
-            if nt == '^':
-                # expr ^ expr  ->  0
-                if self.CompareTrees(child[0], child[1]):
-                    parent[index] = nr(nt='CONST', t='integer', value=0,
-                        SEF=True)
-                    return
+            # Convert 2147483647<i and i<-2147483648 to i&0
+            if (child[0].t == child[1].t == 'integer'
+                and (child[0].nt == 'CONST'
+                       and child[0].value == 2147483647
+                    or child[1].nt == 'CONST'
+                       and child[1].value == int(-2147483648))
+               ):
                 a, b = 0, 1
+                # Put the constant in child[b]
                 if child[a].nt == 'CONST':
-                    a, b = 1, 0
-                if child[b].nt == 'CONST' and child[b].value in (0, -1):
-                    if child[b].value == 0:
-                        parent[index] = child[a]
-                    else:
-                        node.nt = '~'
-                        node.ch = [child[a]]
+                    a, b = b, a
+                nt = node.nt = '&'
+                child[b].value = 0
+                # fall through to check for '&'
+            else:
                 return
 
-            if nt == '||':
-                # Expand to its equivalent a || b  ->  !!(a | b)
-                node = nr(nt='|', t='integer', ch=[child[0], child[1]],
-                    SEF=child[0].SEF and child[1].SEF)
-                node = nr(nt='!', t='integer', ch=[node], SEF=node.SEF)
-                node = nr(nt='!', t='integer', ch=[node], SEF=node.SEF)
-                parent[index] = node
-                # Make another pass with the substitution
-                self.FoldTree(parent, index)
-            elif nt == '&&':
-                # Expand to its equivalent a && b  ->  !(!a | !b)
-                orchildren = [
-                    nr(nt='!', t='integer', ch=[child[0]], SEF=child[0].SEF),
-                    nr(nt='!', t='integer', ch=[child[1]], SEF=child[1].SEF)
-                ]
-                node = nr(nt='|', t='integer', ch=orchildren,
-                    SEF=child[0].SEF and child[1].SEF)
-                node = nr(nt='!', t='integer', ch=[node], SEF=node.SEF)
-                parent[index] = node
-                # Make another pass with the substitution
-                self.FoldTree(parent, index)
+        if nt in ('&', '|'):
+            # expr & expr  ->  expr
+            # expr | expr  ->  expr
+            if self.CompareTrees(child[0], child[1]):
+                parent[index] = child[0]
+                return
 
-            return
+            # Deal with operands in any order
+            a, b = 0, 1
+            # Put constant in child[b]
+            if child[b].nt != 'CONST':
+                a, b = 1, 0
+
+            if child[b].nt == 'CONST':
+                val = child[b].value
+                if (nt == '|' and val == 0
+                    or nt == '&'
+                       and (val == -1
+                            or val == 1 and self.IsBool(child[a]))
+                   ):
+                    # a|0  ->  a
+                    # a&-1  ->  a
+                    # a&1  ->  a if a is boolean
+                    parent[index] = child[a]
+                    return
+                if (nt == '|'
+                    and (val == -1
+                         or (val & 1) == 1 and self.IsBool(child[a]))
+                    or nt == '&' and val == 0
+                   ):
+                    # a|-1  ->  -1 if a is SEF
+                    # a|C  ->  C if bit 0 of C is 1 and a is bool and SEF
+                    # a&0  ->  0 if a is SEF
+                    if child[a].SEF:
+                        parent[index] = child[b]
+
+            # Apply boolean distributivity
+            applied = False
+            opposite = '&' if nt == '|' else '|'
+            if child[0].nt == child[1].nt == opposite:
+                left = child[0].ch
+                right = child[1].ch
+                # Can't loop individually because we must break out of both
+                for c, d in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                    if self.CompareTrees(left[c], right[d]):
+                        child[1].nt = nt
+                        nt = node.nt = opposite
+                        opposite = child[1].nt
+                        right[d] = left[1 - c]
+                        child[0] = left[c]
+                        applied = True
+                        break
+
+            # Apply absorption, possibly after distributivity
+            if child[0].nt == opposite or child[1].nt == opposite:
+                c = 0 if child[1].nt == opposite else 1
+                for d in (0, 1):
+                    if (self.CompareTrees(child[c], child[1 - c].ch[d])
+                        and child[1 - c].ch[1 - d].SEF
+                       ):
+                        node = parent[index] = child[c]
+                        nt = node.nt
+                        child = node.ch
+                        applied = True
+                        break
+
+            if applied:
+                # Re-fold
+                self.FoldTree(parent, index)
 
-        if nt in self.assign_ops:
-            # Transform the whole thing into a regular assignment, as there are
-            # no gains and it simplifies the optimization.
-
-            # An assignment has no side effects only if it's of the form x = x.
-
-            if nt != '=':
-                # Replace the node with the expression alone...
-                # e.g. a += b  ->  a + b
-                node.nt = nt[:-1]
-
-                # Linden Craziness: int *= float; is valid (but no other
-                # int op= float is). It's actually performed as
-                #    i = (integer)(i + (f));
-                # This breaks equivalence of x op= y as x = x op (y) so we add
-                # the explicit type cast here.
-                if (nt == '*=' and child[0].t == 'integer'
-                               and child[1].t == 'float'):
-                    node.t = 'float' # Addition shall return float.
-                    node = self.Cast(node, 'integer')
-
-                # ... and wrap it in an assignment.
-                child = [child[0].copy(), node]
-                node = parent[index] = nr(nt='=', t=child[0].t, ch=child)
-
-            # We have a regular assignment either way now. Simplify the RHS.
-            self.FoldTree(node.ch, 1)
-            chkequal = child[1].ch[0] if child[1].nt == '=' else child[1]
-            if (child[0].nt == chkequal.nt == 'IDENT'
-                  and chkequal.name == child[0].name
-                  and chkequal.scope == child[0].scope
-               or child[0].nt == chkequal.nt == 'FLD'
-                  and chkequal.ch[0].name == child[0].ch[0].name
-                  and chkequal.ch[0].scope == child[0].ch[0].scope
-                  and chkequal.fld == child[0].fld
-               ):
-                parent[index] = child[1]
             return
 
-        if nt == 'IDENT' or nt == 'FLD':
-            node.SEF = True
-            if self.globalmode:
-                ident = child[0] if nt == 'FLD' else node
-                # Resolve constant values so they can be optimized
-                sym = self.symtab[ident.scope][ident.name]
-
-                defn = self.tree[sym['Loc']]
-                assert defn.name == ident.name
-
-                # Assume we already were there
-                if defn.ch:
-                    val = defn.ch[0]
-                    if val.nt != 'CONST' or ident.t == 'key':
-                        return
-                    val = val.copy()
+        if nt == '^':
+            # expr ^ expr  ->  0
+            if self.CompareTrees(child[0], child[1]):
+                parent[index] = nr(nt='CONST', t='integer', value=0,
+                    SEF=True)
+                return
+            a, b = 0, 1
+            if child[a].nt == 'CONST':
+                a, b = 1, 0
+            if child[b].nt == 'CONST' and child[b].value in (0, -1):
+                if child[b].value == 0:
+                    parent[index] = child[a]
                 else:
-                    val = nr(nt='CONST', t=defn.t,
-                        value=self.DefaultValues[defn.t], SEF=True)
-                if nt == 'FLD':
-                    val = nr(nt='CONST', t='float',
-                        value=val.value['xyzs'.index(node.fld)], SEF=True)
-                parent[index] = val
+                    node.nt = '~'
+                    node.ch = [child[a]]
             return
 
-        if nt == 'FNCALL':
-            name = node.name
-
-            SEFargs = True
-            CONSTargs = True
-            for idx in xrange(len(child)-1, -1, -1):
-                self.FoldTree(child, idx)
-                # Function is not SEF if any argument is not SEF
-                SEFargs = SEFargs and child[idx].SEF
-                # Function is not a constant if any argument is not a constant
-                CONSTargs = CONSTargs and child[idx].nt == 'CONST'
-
-            sym = self.symtab[0][name]
-            OptimizeArgs(node, sym)
-            try:
-                if 'Fn' in sym and (self.FnSEF(node) or lslcommon.IsCalc):
-                    # It's side-effect free if the children are and the function
-                    # is marked as SEF.
-                    if SEFargs:
-                        node.SEF = True
-                    if CONSTargs:
-                        # Call it
-                        fn = sym['Fn']
-                        args = [arg.value for arg in child]
-                        assert len(args) == len(sym['ParamTypes'])
-
-                        try:
-                            # May raise ELSLCantCompute
-                            if 'detect' in self.symtab[0][name]:
-                                value = fn(*args,
-                                           evsym=None if self.CurEvent is None
-                                           else self.events[self.CurEvent])
-                            else:
-                                value = fn(*args)
-                        finally:
-                            del args
-
-                        if not self.foldtabs:
-                            generatesTabs = (
-                                isinstance(value, unicode) and u'\t' in value
-                                or type(value) == list
-                                   and any(isinstance(x, unicode)
-                                           and u'\t' in x for x in value)
-                                )
-                            if generatesTabs:
-                                if self.warntabs:
-                                    warning(u"Can't optimize call to %s"
-                                        u" because it would generate a tab"
-                                        u" character (you can force the "
-                                        u" optimization with the 'foldtabs'"
-                                        u" option, or disable this warning by"
-                                        u" disabling the 'warntabs' option)."
-                                        % name.decode('utf8'))
-                                raise lslfuncs.ELSLCantCompute()
-                        # Replace with a constant
-                        parent[index] = nr(nt='CONST', t=node.t, value=value,
-                            SEF=True)
-                        return
+        if nt == '||':
+            # Expand to its equivalent a || b  ->  !!(a | b)
+            node = nr(nt='|', t='integer', ch=[child[0], child[1]],
+                SEF=child[0].SEF and child[1].SEF)
+            node = nr(nt='!', t='integer', ch=[node], SEF=node.SEF)
+            node = nr(nt='!', t='integer', ch=[node], SEF=node.SEF)
+            parent[index] = node
+            # Make another pass with the substitution
+            self.FoldTree(parent, index)
+        elif nt == '&&':
+            # Expand to its equivalent a && b  ->  !(!a | !b)
+            orchildren = [
+                nr(nt='!', t='integer', ch=[child[0]], SEF=child[0].SEF),
+                nr(nt='!', t='integer', ch=[child[1]], SEF=child[1].SEF)
+            ]
+            node = nr(nt='|', t='integer', ch=orchildren,
+                SEF=child[0].SEF and child[1].SEF)
+            node = nr(nt='!', t='integer', ch=[node], SEF=node.SEF)
+            parent[index] = node
+            # Make another pass with the substitution
+            self.FoldTree(parent, index)
 
-                elif SEFargs and 'SEF' in self.symtab[0][name]:
-                    # The function is marked as SEF in the symbol table, and the
-                    # arguments are all side-effect-free. The result is SEF.
-                    node.SEF = True
+    def FoldAssignOp(self, parent, index):
+        """Fold an assignment operator."""
+        node = parent[index]
+        nt = node.nt
+        child = node.ch
+        # Transform the whole thing into a regular assignment, as there are
+        # no gains and it simplifies the optimization.
+
+        # An assignment has no side effects only if it's of the form x = x.
+
+        if nt != '=':
+            # Replace the node with the expression alone...
+            # e.g. a += b  ->  a + b
+            node.nt = nt[:-1]
+
+            # Linden Craziness: int *= float; is valid (but no other
+            # int op= float is). It's actually performed as
+            #    i = (integer)(i + (f));
+            # This breaks equivalence of x op= y as x = x op (y) so we add
+            # the explicit type cast here.
+            if (nt == '*=' and child[0].t == 'integer'
+                           and child[1].t == 'float'):
+                node.t = 'float' # Addition shall return float.
+                node = self.Cast(node, 'integer')
+
+            # ... and wrap it in an assignment.
+            child = [child[0].copy(), node]
+            node = parent[index] = nr(nt='=', t=child[0].t, ch=child)
+
+        # We have a regular assignment either way now. Simplify the RHS.
+        self.FoldTree(node.ch, 1)
+        chkequal = child[1].ch[0] if child[1].nt == '=' else child[1]
+        if (child[0].nt == chkequal.nt == 'IDENT'
+              and chkequal.name == child[0].name
+              and chkequal.scope == child[0].scope
+           or child[0].nt == chkequal.nt == 'FLD'
+              and chkequal.ch[0].name == child[0].ch[0].name
+              and chkequal.ch[0].scope == child[0].ch[0].scope
+              and chkequal.fld == child[0].fld
+           ):
+            parent[index] = child[1]
 
-            except lslfuncs.ELSLCantCompute:
-                # Don't transform the tree if function is not computable
-                pass
+    def FoldIdent(self, parent, index):
+        """Fold a variable or field reference."""
+        node = parent[index]
+        nt = node.nt
+        child = node.ch
+        node.SEF = True
+        if self.globalmode:
+            ident = child[0] if nt == 'FLD' else node
+            # Resolve constant values so they can be optimized
+            sym = self.symtab[ident.scope][ident.name]
+
+            defn = self.tree[sym['Loc']]
+            assert defn.name == ident.name
+
+            # Assume we already were there
+            if defn.ch:
+                val = defn.ch[0]
+                if val.nt != 'CONST' or ident.t == 'key':
+                    return
+                val = val.copy()
+            else:
+                val = nr(nt='CONST', t=defn.t,
+                    value=self.DefaultValues[defn.t], SEF=True)
+            if nt == 'FLD':
+                val = nr(nt='CONST', t='float',
+                    value=val.value['xyzs'.index(node.fld)], SEF=True)
+            parent[index] = val
+
+    def FoldFnCall(self, parent, index):
+        """Fold a function call."""
+        node = parent[index]
+        child = node.ch
+        name = node.name
 
-            # At this point, we have resolved whether the function is SEF,
-            # or whether the function resolves to a constant.
-            OptimizeFunc(self, parent, index)
+        SEFargs = True
+        CONSTargs = True
+        for idx in xrange(len(child)-1, -1, -1):
+            self.FoldTree(child, idx)
+            # Function is not SEF if any argument is not SEF
+            SEFargs = SEFargs and child[idx].SEF
+            # Function is not a constant if any argument is not a constant
+            CONSTargs = CONSTargs and child[idx].nt == 'CONST'
+
+        sym = self.symtab[0][name]
+        OptimizeArgs(node, sym)
+
+        # Apply the conditional SEF and return rules of the function data.
+        if SEFargs and ('SEFPred' in sym or 'RetPred' in sym):
+            args = [arg.value if arg.nt == 'CONST' else None for arg in child]
+            event = self.CurEvent or ''
+            if 'SEFPred' in sym and sym['SEFPred'](args, event):
+                node.SEF = True
+            if 'RetPred' in sym and (node.SEF or self.FnSEF(node)):
+                value = sym['RetPred'](args, event)
+                if value is not None:
+                    parent[index] = nr(nt='CONST', t=node.t, value=value,
+                                       SEF=True)
+                    return
 
-            return
+        try:
+            if 'Fn' in sym and (self.FnSEF(node) or self.ctx.IsCalc):
+                # It's side-effect free if the children are and the function
+                # is marked as SEF.
+                if SEFargs:
+                    node.SEF = True
+                if CONSTargs:
+                    # Call it
+                    fn = sym['Fn']
+                    args = [arg.value for arg in child]
+                    assert len(args) == len(sym['ParamTypes'])
 
-        if nt == 'PRINT':
-            self.FoldTree(child, 0)
-            # PRINT is considered to have side effects. If it's there, assume
-            # there's a reason.
-            return
+                    try:
+                        # May raise ELSLCantCompute
+                        if 'detect' in sym:
+                            value = self.CallLibFunc(name, fn, args,
+                                None if self.CurEvent is None
+                                else self.events[self.CurEvent],
+                                'uns' in sym)
+                        else:
+                            value = self.CallLibFunc(name, fn, args, False,
+                                                     'uns' in sym)
+                    finally:
+                        del args
+
+                    if not self.foldtabs:
+                        generatesTabs = (
+                            isinstance(value, unicode) and u'\t' in value
+                            or type(value) == list
+                               and any(isinstance(x, unicode)
+                                       and u'\t' in x for x in value)
+                            )
+                        if generatesTabs:
+                            if self.warntabs:
+                                warning(u"Can't optimize call to %s"
+                                    u" because it would generate a tab"
+                                    u" character (you can force the "
+                                    u" optimization with the 'foldtabs'"
+                                    u" option, or disable this warning by"
+                                    u" disabling the 'warntabs' option)."
+                                    % name.decode('utf8'))
+                            raise lslfuncs.ELSLCantCompute()
+                    # Replace with a constant
+                    parent[index] = nr(nt='CONST', t=node.t, value=value,
+                        SEF=True)
+                    return
 
-        if nt == 'EXPR':
-            self.FoldTree(child, 0)
-            node.SEF = child[0].SEF
-            return
+            elif SEFargs and 'SEF' in self.symtab[0][name]:
+                # The function is marked as SEF in the symbol table, and the
+                # arguments are all side-effect-free. The result is SEF.
+                node.SEF = True
 
-        if nt == 'FNDEF':
-            # FIXME: Fix SEFness of UDFs
-            # A return statement does have side effects for the current
-            # function, as removing it would change its behaviour drastically.
-            # However, when seen from the outside, that does not make the
-            # function as a whole have side effects: if all nodes except
-            # return statements are SEF, the function is SEF.
-
-            # CurEvent is needed when folding llDetected* function calls
-            if hasattr(node, 'scope'):
-                # function definition
-                self.CurEvent = None
-            else:
-                # event definition
-                self.CurEvent = node.name
-            self.FoldTree(child, 0)
+        except lslfuncs.ELSLCantCompute:
+            # Don't transform the tree if function is not computable
+            pass
 
-            # Test if the event is SEF and does nothing, and remove it if so.
-            if (not hasattr(node, 'scope') and child[0].SEF
-                and 'SEF' in self.events[node.name]
-               ):
-                # Delete ourselves.
-                del parent[index]
-                return
+        # At this point, we have resolved whether the function is SEF,
+        # or whether the function resolves to a constant.
+        OptimizeFunc(self, parent, index)
 
-            # Delete trailing bare RETURNs.
-            # TODO: This works, but analysis of code paths is DCR's thing
-            # and this is incomplete, e.g. x(){{return;}} is not detected.
-            while child[0].ch:
-                last = child[0].ch[-1]
-                if last.nt != 'RETURN' or last.ch:
-                    break
-                del child[0].ch[-1]
-            if child[0].SEF:
-                node.SEF = True
-                if node.name in self.symtab[0]:
-                    # Mark the symbol table entry if it's not an event.
-                    self.symtab[0][node.name]['SEF'] = True
-            return
+    def FoldPrint(self, parent, index):
+        """Fold a print statement."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0)
+        # PRINT is considered to have side effects. If it's there, assume
+        # there's a reason.
 
-        if nt in ('VECTOR', 'ROTATION', 'LIST'):
-            isconst = True
-            issef = True
-            for idx in xrange(len(child)):
-                self.FoldTree(child, idx)
-                isconst = isconst and child[idx].nt == 'CONST'
-                issef = issef and child[idx].SEF
-
-            if isconst:
-                value = [x.value for x in child]
-                if nt == 'VECTOR':
-                    value = Vector([lslfuncs.ff(x) for x in value])
-                elif nt == 'ROTATION':
-                    value = Quaternion([lslfuncs.ff(x) for x in value])
-                parent[index] = nr(nt='CONST', t=node.t, value=value, SEF=True)
-                return
-            node.SEF = issef
-            return
+    def FoldExpr(self, parent, index):
+        """Fold an expression statement."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0)
+        node.SEF = child[0].SEF
 
-        if nt == 'STDEF':
-            for idx in xrange(len(child) - 1, -1, -1):
-                self.FoldTree(child, idx)
-            if not child:
-                # All events removed - add a dummy timer()
-                scope = len(self.symtab)
-                self.symtab.append({})
-                child.append(nr(nt='FNDEF', t=None, name='timer',
-                              pscope=scope, ptypes=[], pnames=[],
-                              ch=[nr(nt='{}', t=None, scope=scope, ch=[])]
-                             ))
+    def FoldFnDef(self, parent, index):
+        """Fold a function or event definition."""
+        node = parent[index]
+        child = node.ch
+        # FIXME: Fix SEFness of UDFs
+        # A return statement does have side effects for the current
+        # function, as removing it would change its behaviour drastically.
+        # However, when seen from the outside, that does not make the
+        # function as a whole have side effects: if all nodes except
+        # return statements are SEF, the function is SEF.
+
+        # CurEvent is needed when folding llDetected* function calls
+        if node.scope is not None:
+            # function definition
+            self.CurEvent = None
+        else:
+            # event definition
+            self.CurEvent = node.name
+        self.FoldTree(child, 0)
+
+        # Test if the event is SEF and does nothing, and remove it if so.
+        if (node.scope is None and child[0].SEF
+            and 'SEF' in self.events[node.name]
+           ):
+            # Delete ourselves.
+            del parent[index]
             return
 
-        if nt == '{}':
-            # Remove SEF statements, and mark as SEF if it ends up empty
-            idx = 0
-            nchild = len(child)
-            while idx < nchild:
-                self.FoldTree(child, idx)
-                self.FoldStmt(child, idx)
-                if child[idx].SEF:
-                    # SEF statements can be removed
-                    del child[idx]
-                    nchild -= 1
-                else:
-                    idx += 1
-            # Make another pass to remove JUMPs to the next statement
-            changed = True  # Allow entering the loop
-            while changed:
-                changed = False
-                idx = 0
-                while idx < nchild:
-                    advance = 1
-                    if child[idx].nt == 'JUMP':
-                        idx2 = idx + 1
-                        while idx2 < nchild:
-                            # Search for a label that is the destination of
-                            # this JUMP, skipping other labels
-                            if child[idx2].nt != '@':
-                                break
-                            if (child[idx].scope == child[idx2].scope
-                                and child[idx].name == child[idx2].name
-                               ):
-                                sym = self.symtab[child[idx].scope]
-                                sym = sym[child[idx].name]
-                                # remove the JUMP
-                                del child[idx]
-                                advance = 0
-                                changed = True
-                                idx2 -= 1  # it has scrolled
-                                nchild -= 1
-                                # remove reference to label
-                                assert(sym['ref'])
-                                sym['ref'] -= 1
-                                if sym['ref'] == 0:
-                                    # No longer referenced - delete label too
-                                    del child[idx2]
-                                    nchild -= 1
-                                    break
-                            idx2 += 1
-                        del idx2
-                    idx += advance
-
-            # We're SEF if we're empty, as we've removed all SEF statements
-            node.SEF = nchild == 0
+        # Delete trailing bare RETURNs.
+        # TODO: This works, but analysis of code paths is DCR's thing
+        # and this is incomplete, e.g. x(){{return;}} is not detected.
+        while child[0].ch:
+            last = child[0].ch[-1]
+            if last.nt != 'RETURN' or last.ch:
+                break
+            del child[0].ch[-1]
+        if child[0].SEF:
+            node.SEF = True
+            if node.name in self.symtab[0]:
+                # Mark the symbol table entry if it's not an event.
+                self.symtab[0][node.name]['SEF'] = True
+
+    def FoldVectorRotList(self, parent, index):
+        """Fold a vector, rotation or list constructor."""
+        node = parent[index]
+        nt = node.nt
+        child = node.ch
+        isconst = True
+        issef = True
+        for idx in xrange(len(child)):
+            self.FoldTree(child, idx)
+            isconst = isconst and child[idx].nt == 'CONST'
+            issef = issef and child[idx].SEF
+
+        if isconst:
+            value = [x.value for x in child]
+            if nt == 'VECTOR':
+                value = Vector([lslfuncs.ff(x) for x in value])
+            elif nt == 'ROTATION':
+                value = Quaternion([lslfuncs.ff(x) for x in value])
+            parent[index] = nr(nt='CONST', t=node.t, value=value, SEF=True)
             return
+        node.SEF = issef
 
-        if nt == 'IF':
-            self.ExpandCondition(child, 0)
-            self.FoldTree(child, 0)
-            self.FoldAsBool(child, 0)
-            if child[0].nt == 'CONST':
-                # We might be able to remove one of the branches.
-                if lslfuncs.cond(child[0].value):
-                    self.FoldTree(child, 1)
-                    self.FoldStmt(child, 1)
-                    parent[index] = child[1]
-                    return
-                elif len(child) == 3:
-                    self.FoldTree(child, 2)
-                    self.FoldStmt(child, 2)
-                    parent[index] = child[2]
-                    return
-                else:
-                    # No ELSE branch, replace the statement with an empty one.
-                    parent[index] = nr(nt=';', t=None, SEF=True)
-                    return
+    def FoldStDef(self, parent, index):
+        """Fold a state definition."""
+        node = parent[index]
+        child = node.ch
+        for idx in xrange(len(child) - 1, -1, -1):
+            self.FoldTree(child, idx)
+        if not child:
+            # All events removed - add a dummy timer()
+            scope = len(self.symtab)
+            self.symtab.append({})
+            child.append(nr(nt='FNDEF', t=None, name='timer',
+                          pscope=scope, ptypes=[], pnames=[],
+                          ch=[nr(nt='{}', t=None, scope=scope, ch=[])]
+                         ))
+
+    def FoldBlock(self, parent, index):
+        """Fold a code block."""
+        node = parent[index]
+        child = node.ch
+        # Remove SEF statements, and mark as SEF if it ends up empty
+        idx = 0
+        nchild = len(child)
+        while idx < nchild:
+            self.FoldTree(child, idx)
+            self.FoldStmt(child, idx)
+            if child[idx].SEF:
+                # SEF statements can be removed
+                del child[idx]
+                nchild -= 1
             else:
-                self.FoldTree(child, 1)
-                self.FoldStmt(child, 1)
-                if len(child) > 2:
-                    self.FoldTree(child, 2)
-                    self.FoldStmt(child, 2)
-                    # Check if it makes sense to swap if and else branches
-                    if not child[2].SEF:
-                        # Check if we can gain something by negating the
-                        # expression.
-                        # Swap 'if' and 'else' branch when the condition has
-                        # a '!' prefix
-                        if child[0].nt == '!':
-                            child[0] = child[0].ch[0]
-                            child[1], child[2] = child[2], child[1]
-                        # Swap them if condition is '==' with integer operands
-                        if (child[0].nt == '=='
-                            and child[0].ch[0].t
-                                == child[0].ch[1].t == 'integer'
+                idx += 1
+        # Make another pass to remove JUMPs to the next statement
+        changed = True  # Allow entering the loop
+        while changed:
+            changed = False
+            idx = 0
+            while idx < nchild:
+                advance = 1
+                if child[idx].nt == 'JUMP':
+                    idx2 = idx + 1
+                    while idx2 < nchild:
+                        # Search for a label that is the destination of
+                        # this JUMP, skipping other labels
+                        if child[idx2].nt != '@':
+                            break
+                        if (child[idx].scope == child[idx2].scope
+                            and child[idx].name == child[idx2].name
                            ):
-                            child[0].nt = '^'
-                            child[1], child[2] = child[2], child[1]
-                    # Re-test just in case we swapped in the previous check.
-                    if child[2].SEF:
-                        # no point in "... else ;" - remove else branch
-                        del child[2]
-                if child[1].SEF:
-                    # if (X) ;  ->  X;
-                    if len(child) == 2:
-                        parent[index] = nr(nt='EXPR', t=child[0].t,
-                            ch=[child[0]])
-                        # It has been promoted to statement. Fold it as such.
-                        # (Will remove it if SEF)
-                        self.FoldStmt(parent, index)
-                        return
-
-                    # If type(X) != Key, then:
-                    # if (X) ; else {stuff}  ->  if (!X) {stuff}
-                    if child[0].t != 'key':
-                        # We've already converted all other types to equivalent
-                        # comparisons
-                        assert child[0].t == 'integer'
-                        child[0] = nr(nt='!', t='integer', ch=[child[0]])
-                        del child[1]
-                        self.FoldTree(child, 0)
-                        self.FoldAsBool(child, 0)
-
-            if all(subnode.SEF for subnode in child):
-                node.SEF = True
-            return
-
-        if nt == 'WHILE':
-            # Loops are not considered side-effect free. If the expression is
-            # TRUE, it's definitely not SEF. If it's FALSE, it will be optimized
-            # out anyway. Otherwise we just don't know if it may be infinite,
-            # even if every component is SEF.
+                            sym = self.symtab[child[idx].scope]
+                            sym = sym[child[idx].name]
+                            # remove the JUMP
+                            del child[idx]
+                            advance = 0
+                            changed = True
+                            idx2 -= 1  # it has scrolled
+                            nchild -= 1
+                            # remove reference to label
+                            assert(sym['ref'])
+                            sym['ref'] -= 1
+                            if sym['ref'] == 0:
+                                # No longer referenced - delete label too
+                                del child[idx2]
+                                nchild -= 1
+                                break
+                        idx2 += 1
+                    del idx2
+                idx += advance
 
-            if not child[1].SEF:
+        # We're SEF if we're empty, as we've removed all SEF statements
+        node.SEF = nchild == 0
 
-                self.ExpandCondition(child, 0)
-                self.FoldTree(child, 0)
-                self.FoldAsBool(child, 0)
-                if child[0].nt == 'CONST':
-                    # See if the whole WHILE can be eliminated.
-                    if not lslfuncs.cond(child[0].value):
-                        # Whole statement can be removed.
-                        parent[index] = nr(nt=';', t=None, SEF=True)
-                        return
+    def FoldIf(self, parent, index):
+        """Fold an if statement."""
+        node = parent[index]
+        child = node.ch
+        self.ExpandCondition(child, 0)
+        self.FoldTree(child, 0)
+        self.FoldAsBool(child, 0)
+        if child[0].nt == 'CONST':
+            # We might be able to remove one of the branches.
+            if lslfuncs.cond(child[0].value):
                 self.FoldTree(child, 1)
                 self.FoldStmt(child, 1)
+                parent[index] = child[1]
+                return
+            elif len(child) == 3:
+                self.FoldTree(child, 2)
+                self.FoldStmt(child, 2)
+                parent[index] = child[2]
                 return
+            else:
+                # No ELSE branch, replace the statement with an empty one.
+                parent[index] = nr(nt=';', t=None, SEF=True)
+                return
+        else:
+            self.FoldTree(child, 1)
+            self.FoldStmt(child, 1)
+            if len(child) > 2:
+                self.FoldTree(child, 2)
+                self.FoldStmt(child, 2)
+                # Check if it makes sense to swap if and else branches
+                if not child[2].SEF:
+                    # Check if we can gain something by negating the
+                    # expression.
+                    # Swap 'if' and 'else' branch when the condition has
+                    # a '!' prefix
+                    if child[0].nt == '!':
+                        child[0] = child[0].ch[0]
+                        child[1], child[2] = child[2], child[1]
+                    # Swap them if condition is '==' with integer operands
+                    if (child[0].nt == '=='
+                        and child[0].ch[0].t
+                            == child[0].ch[1].t == 'integer'
+                       ):
+                        child[0].nt = '^'
+                        child[1], child[2] = child[2], child[1]
+                # Re-test just in case we swapped in the previous check.
+                if child[2].SEF:
+                    # no point in "... else ;" - remove else branch
+                    del child[2]
+            if child[1].SEF:
+                # if (X) ;  ->  X;
+                if len(child) == 2:
+                    parent[index] = nr(nt='EXPR', t=child[0].t,
+                        ch=[child[0]])
+                    # It has been promoted to statement. Fold it as such.
+                    # (Will remove it if SEF)
+                    self.FoldStmt(parent, index)
+                    return
 
-            # It does nothing - Turn it into a do..while
-            nt = node.nt = 'DO'
-            child[0], child[1] = child[1], child[0]
+                # If type(X) != Key, then:
+                # if (X) ; else {stuff}  ->  if (!X) {stuff}
+                if child[0].t != 'key':
+                    # We've already converted all other types to equivalent
+                    # comparisons
+                    assert child[0].t == 'integer'
+                    child[0] = nr(nt='!', t='integer', ch=[child[0]])
+                    del child[1]
+                    self.FoldTree(child, 0)
+                    self.FoldAsBool(child, 0)
 
-            # Fall through to optimize as DO..WHILE
+        if all(subnode.SEF for subnode in child):
+            node.SEF = True
 
-        if nt == 'DO':
-            self.FoldTree(child, 0) # This one is always executed.
-            self.FoldStmt(child, 0)
-            self.ExpandCondition(child, 1)
-            self.FoldTree(child, 1)
-            self.FoldAsBool(child, 1)
-            # See if the latest part is a constant.
-            if child[1].nt == 'CONST':
-                if not lslfuncs.cond(child[1].value):
-                    # Only one go. Replace with the statement(s).
-                    parent[index] = child[0]
-            return
+    def FoldWhile(self, parent, index):
+        """Fold a while loop."""
+        node = parent[index]
+        child = node.ch
+        # Loops are not considered side-effect free. If the expression is
+        # TRUE, it's definitely not SEF. If it's FALSE, it will be optimized
+        # out anyway. Otherwise we just don't know if it may be infinite,
+        # even if every component is SEF.
 
-        if nt == 'FOR':
-            assert child[0].nt == 'EXPRLIST'
-            assert child[2].nt == 'EXPRLIST'
-            self.FoldAndRemoveEmptyStmts(child[0].ch)
+        if not child[1].SEF:
 
-            self.ExpandCondition(child, 1) # Condition.
-            self.FoldTree(child, 1)
-            self.FoldAsBool(child, 1)
-            if child[1].nt == 'CONST':
-                # FOR is delicate. It can have multiple expressions at start.
-                # And if there is more than one, these expressions will need a
-                # new block, which means new scope. They are expressions, no
-                # declarations or labels allowed, thus no new identifiers may
-                # be created in the new scope.
-                if lslfuncs.cond(child[1].value):
-                    # Endless loop. Traverse the loop and the iterator.
-                    self.FoldTree(child, 3)
-                    self.FoldStmt(child, 3)
-                    self.FoldAndRemoveEmptyStmts(child[2].ch)
-                else:
-                    # Loop never executes.
-                    # Convert expression list to code block.
-                    exprlist = []
-                    for expr in child[0].ch:
-                        # Fold into expression statements.
-                        exprlist.append(nr(nt='EXPR', t=expr.t, ch=[expr]))
-
-                    # returns type None, as FOR does
-                    if exprlist:
-                        # We're in the case where there are expressions. If any
-                        # remain, they are not SEF (or they would have been
-                        # removed earlier) so don't mark this node as SEF.
-                        scope = len(self.symtab)
-                        self.symtab.append({})
-                        parent[index] = nr(nt='{}', t=None, scope=scope,
-                                           ch=exprlist)
-                    else:
-                        parent[index] = nr(nt=';', t=None, SEF=True)
+            self.ExpandCondition(child, 0)
+            self.FoldTree(child, 0)
+            self.FoldAsBool(child, 0)
+            if child[0].nt == 'CONST':
+                # See if the whole WHILE can be eliminated.
+                if not lslfuncs.cond(child[0].value):
+                    # Whole statement can be removed.
+                    parent[index] = nr(nt=';', t=None, SEF=True)
                     return
-            else:
-                self.FoldTree(child, 3)
-                self.FoldStmt(child, 3)
-                self.FoldAndRemoveEmptyStmts(child[2].ch)
-            return
-
-        if nt == 'RETURN':
-            if child:
-                self.FoldTree(child, 0)
+            self.FoldTree(child, 1)
+            self.FoldStmt(child, 1)
             return
 
-        if nt == 'DECL':
-            if child:
-                # Check if child is a simple_expr. If it is, then we keep the
-                # original attached to the folded node to use it in the output.
-                if getattr(child[0], 'Simple', False):
-                    orig = self.CopyNode(child[0])
-                    del orig.Simple  # presence of orig in child will be enough
-                    self.FoldTree(child, 0)
-                    child[0].orig = orig
-                else:
-                    self.FoldTree(child, 0)
-                # Remove assignment if integer zero.
-                if (node.t == 'integer' and child[0].nt == 'CONST'
-                    and not child[0].value
-                   ):
-                    node.ch = None
-                    return
-            else:
-                # Add assignment if vector, rotation or float.
-                if node.t in ('float', 'vector', 'rotation'):
-                    typ = node.t
-                    node.ch = [nr(nt='CONST', t=typ, SEF=True,
-                        value=0.0 if typ == 'float'
-                            else ZERO_VECTOR if typ == 'vector'
-                            else ZERO_ROTATION)]
-            # Declarations always have side effects.
-            return
+        # It does nothing - Turn it into a do..while
+        node.nt = 'DO'
+        child[0], child[1] = child[1], child[0]
 
-        if nt == 'STSW':
-            # State switch always has side effects.
-            return
+        # Optimize as DO..WHILE
+        self.FoldDo(parent, index)
 
-        if nt == 'SUBIDX':
-            # Recurse to every child. It's SEF if all children are.
-            idx = 0
-            issef = True
-            while idx < len(child):
-                self.FoldTree(child, idx)
-                issef = issef and child[idx].SEF
-                idx += 1
-            node.SEF = issef
-            return
+    def FoldDo(self, parent, index):
+        """Fold a do...while loop."""
+        node = parent[index]
+        child = node.ch
+        self.FoldTree(child, 0) # This one is always executed.
+        self.FoldStmt(child, 0)
+        self.ExpandCondition(child, 1)
+        self.FoldTree(child, 1)
+        self.FoldAsBool(child, 1)
+        # See if the latest part is a constant.
+        if child[1].nt == 'CONST':
+            if not lslfuncs.cond(child[1].value):
+                # Only one go. Replace with the statement(s).
+                parent[index] = child[0]
 
-        if nt == ';':
-            node.SEF = True
-            return
+    def FoldFor(self, parent, index):
+        """Fold a for loop."""
+        node = parent[index]
+        child = node.ch
+        assert child[0].nt == 'EXPRLIST'
+        assert child[2].nt == 'EXPRLIST'
+        self.FoldAndRemoveEmptyStmts(child[0].ch)
+
+        self.ExpandCondition(child, 1) # Condition.
+        self.FoldTree(child, 1)
+        self.FoldAsBool(child, 1)
+        if child[1].nt == 'CONST':
+            # FOR is delicate. It can have multiple expressions at start.
+            # And if there is more than one, these expressions will need a
+            # new block, which means new scope. They are expressions, no
+            # declarations or labels allowed, thus no new identifiers may
+            # be created in the new scope.
+            if lslfuncs.cond(child[1].value):
+                # Endless loop. Traverse the loop and the iterator.
+                self.FoldTree(child, 3)
+                self.FoldStmt(child, 3)
+                self.FoldAndRemoveEmptyStmts(child[2].ch)
+            else:
+                # Loop never executes.
+                # Convert expression list to code block.
+                exprlist = []
+                for expr in child[0].ch:
+                    # Fold into expression statements.
+                    exprlist.append(nr(nt='EXPR', t=expr.t, ch=[expr]))
+
+                # returns type None, as FOR does
+                if exprlist:
+                    # We're in the case where there are expressions. If any
+                    # remain, they are not SEF (or they would have been
+                    # removed earlier) so don't mark this node as SEF.
+                    scope = len(self.symtab)
+                    self.symtab.append({})
+                    parent[index] = nr(nt='{}', t=None, scope=scope,
+                                       ch=exprlist)
+                else:
+                    parent[index] = nr(nt=';', t=None, SEF=True)
+                return
+        else:
+            self.FoldTree(child, 3)
+            self.FoldStmt(child, 3)
+            self.FoldAndRemoveEmptyStmts(child[2].ch)
 
-        if nt == '@':
-            # SEF if there are no JUMPs jumping to it
-            node.SEF = not self.symtab[node.scope][node.name]['ref']
-            return
+    def FoldReturn(self, parent, index):
+        """Fold a return statement."""
+        node = parent[index]
+        child = node.ch
+        if child:
+            self.FoldTree(child, 0)
 
-        if nt in ('JUMP', 'V++', 'V--', '--V', '++V', 'LAMBDA'):
-            # Except LAMBDA, these all have side effects, as in, can't be
-            # eliminated as statements.
-            # LAMBDA can't be eliminated without scrolling Loc's.
-            return
+    def FoldDecl(self, parent, index):
+        """Fold a variable declaration."""
+        node = parent[index]
+        child = node.ch
+        if child:
+            # Check if child is a simple_expr. If it is, then we keep the
+            # original attached to the folded node to use it in the output.
+            if getattr(child[0], 'Simple', False):
+                orig = self.CopyNode(child[0])
+                del orig.Simple  # presence of orig in child will be enough
+                self.FoldTree(child, 0)
+                child[0].orig = orig
+            else:
+                self.FoldTree(child, 0)
+            # Remove assignment if integer zero.
+            if (node.t == 'integer' and child[0].nt == 'CONST'
+                and not child[0].value
+               ):
+                node.ch = None
+                return
+        else:
+            # Add assignment if vector, rotation or float.
+            if node.t in ('float', 'vector', 'rotation'):
+                typ = node.t
+                node.ch = [nr(nt='CONST', t=typ, SEF=True,
+                    value=0.0 if typ == 'float'
+                        else ZERO_VECTOR if typ == 'vector'
+                        else ZERO_ROTATION)]
+        # Declarations always have side effects.
+
+    def FoldStSw(self, parent, index):
+        """Fold a state switch."""
+        # State switch always has side effects.
+
+    def FoldSubIdx(self, parent, index):
+        """Fold a subindex."""
+        node = parent[index]
+        child = node.ch
+        # Recurse to every child. It's SEF if all children are.
+        idx = 0
+        issef = True
+        while idx < len(child):
+            self.FoldTree(child, idx)
+            issef = issef and child[idx].SEF
+            idx += 1
+        node.SEF = issef
+
+    def FoldEmpty(self, parent, index):
+        """Mark an empty statement as side-effect free."""
+        node = parent[index]
+        node.SEF = True
 
-        assert False, 'Internal error: This should not happen, node type = ' \
-            + nt # pragma: no cover
+    def FoldLabel(self, parent, index):
+        """Fold a label."""
+        node = parent[index]
+        # SEF if there are no JUMPs jumping to it
+        node.SEF = not self.symtab[node.scope][node.name]['ref']
+
+    def FoldNothing(self, parent, index):
+        """Nothing to fold."""
+        # Except LAMBDA, these all have side effects, as in, can't be
+        # eliminated as statements.
+        # LAMBDA can't be eliminated without scrolling Loc's.
+
+    # Handlers of FoldTree, by node type.
+    FoldHandlers = {
+        'CONST': FoldConst,
+        'CAST': FoldCast,
+        'NEG': FoldNeg,
+        '!': FoldNot,
+        '~': FoldBitNot,
+        'IDENT': FoldIdent,
+        'FLD': FoldIdent,
+        'FNCALL': FoldFnCall,
+        'PRINT': FoldPrint,
+        'EXPR': FoldExpr,
+        'FNDEF': FoldFnDef,
+        'VECTOR': FoldVectorRotList,
+        'ROTATION': FoldVectorRotList,
+        'LIST': FoldVectorRotList,
+        'STDEF': FoldStDef,
+        '{}': FoldBlock,
+        'IF': FoldIf,
+        'WHILE': FoldWhile,
+        'DO': FoldDo,
+        'FOR': FoldFor,
+        'RETURN': FoldReturn,
+        'DECL': FoldDecl,
+        'STSW': FoldStSw,
+        'SUBIDX': FoldSubIdx,
+        ';': FoldEmpty,
+        '@': FoldLabel,
+        'JUMP': FoldNothing,
+        'V++': FoldNothing,
+        'V--': FoldNothing,
+        '--V': FoldNothing,
+        '++V': FoldNothing,
+        'LAMBDA': FoldNothing,
+        }
+    FoldHandlers.update(dict.fromkeys(binary_ops, FoldBinaryOp))
+    FoldHandlers.update(dict.fromkeys(assign_ops, FoldAssignOp))
 
     def IsValidGlobalIdOrConst(self, node):
         # nan can't be represented as a simple constant; all others are valid
@@ -2008,19 +2327,25 @@ class foldconst(object):
                    and self.IsValidGlobalIdOrConst(elem)
                    for elem in expr.ch)
 
-    def FoldScript(self, warningpass = True):
+    def FoldScript(self, warningpass = True, only = None):
         """Optimize the symbolic table symtab in place. Requires a table of
         predefined functions for folding constants.
+
+        If only is given, it's a set with the ids of the top level nodes to
+        fold; the rest are left alone.
         """
         self.globalmode = False
 
         tree = self.tree
         self.CurEvent = None
 
-        FuncOptSetup()
+        # The previous passes may have changed the tree.
+        self.InvalidateHashes()
 
         # Constant folding pass. It does some other optimizations along the way.
         for idx in xrange(len(tree)):
+            if only is not None and id(tree[idx]) not in only:
+                continue
             if tree[idx].nt == 'DECL':
                 self.globalmode = True
                 self.FoldTree(tree, idx)
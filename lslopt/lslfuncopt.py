@@ -120,11 +120,18 @@ listCompat = frozenset({'ss', 'sk', 'si', 'sf', 'sv', 'sr', 'ks', 'kk',
 
 defaultListVals = {'llList2Integer':0, 'llList2Float':0.0,
     'llList2String':u'',
-    # llList2Key is set programmatically in FuncOptSetup
-    #'llList2Key':Key(u''),
+    'llList2Key':Key(u''),  # not under LSO, see DefaultListVal
     'llList2Vector':Vector((0.,0.,0.)),
     'llList2Rot':Quaternion((0.,0.,0.,1.))}
 
+def DefaultListVal(self, name):
+    """Return the value of the list extraction function 'name' for an out
+    of range index.
+    """
+    if name == 'llList2Key' and self.ctx.LSO:
+        return Key(lslfuncs.NULL_KEY)
+    return defaultListVals[name]
+
 # Auxiliary function for llDumpList2String optimization
 def CastDL2S(self, node, index):
     """Cast a list element to string, wrapping it in a list if it's a vector or
@@ -171,7 +178,7 @@ def OptimizeFunc(self, parent, index):
             # Convert llDumpList2String(expr, "") to (string)(expr)
             node.nt = 'CAST'
             del child[1]
-            del node.name
+            node.name = None
             return
 
         list_len = self.GetListNodeLength(child[0])
@@ -273,7 +280,7 @@ def OptimizeFunc(self, parent, index):
                     lslcommon.LSLType2Python[node.t],
                     InList=True, f32=True)
             else:
-                const = defaultListVals[name]
+                const = DefaultListVal(self, name)
 
             parent[index] = nr(nt='CONST', t=node.t, value=const, SEF=True)
             return
@@ -292,7 +299,7 @@ def OptimizeFunc(self, parent, index):
                     # turn the node into a cast of arg 0 to string
                     node.nt = 'CAST'
                     del child[1]
-                    del node.name
+                    node.name = None
                     return
                 # The other ones that support cast to string then to
                 # the final type in some cases (depending on the
@@ -308,7 +315,7 @@ def OptimizeFunc(self, parent, index):
                     # or (integer)((string)llGetObjectDetails...)
                     node.nt = 'CAST'
                     del child[1]
-                    del node.name
+                    node.name = None
                     child[0] = self.Cast(child[0], 'string')
                     return
 
@@ -320,7 +327,7 @@ def OptimizeFunc(self, parent, index):
                        not in listCompat
                ) and node.SEF:
                 parent[index] = nr(nt='CONST', t=node.t,
-                    value=defaultListVals[name], SEF=True)
+                    value=DefaultListVal(self, name), SEF=True)
 
         elif listarg.nt == 'FNCALL' and listarg.name in (
              'llGetPrimitiveParams', 'llGetLinkPrimitiveParams'):
@@ -364,7 +371,7 @@ def OptimizeFunc(self, parent, index):
                         if name == 'llList2String':
                             node.nt = 'CAST'
                             del child[1]
-                            del node.name
+                            node.name = None
                             return
                         if ((name == 'llList2Key'
                              or name == 'llList2Integer'
@@ -377,7 +384,7 @@ def OptimizeFunc(self, parent, index):
                            ):
                             node.nt = 'CAST'
                             del child[1]
-                            del node.name
+                            node.name = None
                             child[0] = nr(nt='CAST', t='string',
                                 ch=[child[0]], SEF=child[0].SEF)
                             return
@@ -399,7 +406,7 @@ def OptimizeFunc(self, parent, index):
                                 not in listCompat
                                 and node.SEF):
                             parent[index] = nr(nt='CONST', t=node.t,
-                                value=defaultListVals[name], SEF=True)
+                                value=DefaultListVal(self, name), SEF=True)
                             return
 
                 del returntypes
@@ -428,10 +435,3 @@ def OptimizeFunc(self, parent, index):
            ):
             parent[index] = nr(nt='CONST', t='list', value=[], SEF=True)
             return
-
-def FuncOptSetup():
-    # Patch the default values list for LSO
-    if lslcommon.LSO:
-        defaultListVals['llList2Key'] = Key(lslfuncs.NULL_KEY)
-    else:
-        defaultListVals['llList2Key'] = Key(u"")
@@ -19,6 +19,7 @@
 # would obfuscate the source too much.
 
 from lslopt.lslcommon import nr
+from types import GeneratorType
 
 # Statement-level nodes that have at most 1 child and are of type expression
 SINGLE_OPT_EXPR_CHILD_NODES = frozenset({'DECL', 'EXPR', 'RETURN',
@@ -238,25 +239,33 @@ class inliner(object):
         return fns
 
     def RecurseExpression(self, parent, index, scope):
-        node = parent[index]
-        nt = node.nt
         fns = []
 
-        if nt == 'FNCALL' and self.symtab[0][node.name].get('Inline', False):
-            fns.extend(self.ConvertFunction(parent, index, scope))
-        elif node.ch:
-            for i in range(len(node.ch)):
-                fns.extend(self.RecurseExpression(node.ch, i, scope))
+        # Use an explicit stack, so that long expressions don't exceed the
+        # recursion limit.
+        stack = [(parent, index)]
+        while stack:
+            parent, index = stack.pop()
+            node = parent[index]
+            nt = node.nt
+            if (nt == 'FNCALL'
+                and self.symtab[0][node.name].get('Inline', False)
+               ):
+                fns.extend(self.ConvertFunction(parent, index, scope))
+            elif node.ch:
+                stack.extend((node.ch, i)
+                             for i in range(len(node.ch) - 1, -1, -1))
         return fns
 
     def RecurseSingleStatement(self, parent, index, scope):
+        # Part of InlineStatement.
         # Synthesize a block node whose child is the statement.
         newscope = self.newSymtab()
         node = nr(nt='{}', t=None, scope=newscope, ch=[parent[index]],
             SEF=parent[index].SEF)
 
         # Recurse into that node, so that any additions are made right there.
-        self.RecurseStatement(node.ch, 0, newscope)
+        yield (node.ch, 0, newscope)
 
         # If it's no longer a single statement, promote it to a block.
         if len(node.ch) != 1:
@@ -268,6 +277,24 @@ class inliner(object):
             parent[index] = node.ch[0]
 
     def RecurseStatement(self, parent, index, scope):
+        # The processing of each statement is a generator (see
+        # InlineStatement) that yields the (parent, index, scope) of the
+        # statements it contains, or RecurseSingleStatement generators, to
+        # have them processed before it continues. Keeping them in a stack
+        # instead of recursing allows any nesting depth of statements.
+        stack = [self.InlineStatement(parent, index, scope)]
+        while stack:
+            try:
+                sub = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            if isinstance(sub, GeneratorType):
+                stack.append(sub)
+            else:
+                stack.append(self.InlineStatement(*sub))
+
+    def InlineStatement(self, parent, index, scope):
         node = parent[index]
         nt = node.nt
         child = node.ch
@@ -284,14 +311,14 @@ class inliner(object):
         elif nt == '{}':
             i = -len(child)
             while i:
-                self.RecurseStatement(child, len(child)+i, node.scope)
+                yield (child, len(child)+i, node.scope)
                 i += 1
 
         elif nt == 'IF':
             fns = self.RecurseExpression(child, 0, scope)
-            self.RecurseSingleStatement(child, 1, scope)
+            yield self.RecurseSingleStatement(child, 1, scope)
             if len(child) > 2:
-                self.RecurseSingleStatement(child, 2, scope)
+                yield self.RecurseSingleStatement(child, 2, scope)
 
         # Loop handling is tricky.
         #
@@ -371,7 +398,7 @@ class inliner(object):
         #
 
         elif nt == 'DO':
-            self.RecurseSingleStatement(child, 0, scope)
+            yield self.RecurseSingleStatement(child, 0, scope)
             fns = self.RecurseExpression(child, 1, scope)
             if fns:
                 # Need to do some plumbing to move the bodies into the loop
@@ -400,7 +427,7 @@ class inliner(object):
                               scope=self.newSymtab())
             child[1].ch.append(nr(nt='JUMP', t=None, name=lbl, scope=scope))
             fns = self.RecurseExpression(child, 0, scope)
-            self.RecurseSingleStatement(child, 1, scope)
+            yield self.RecurseSingleStatement(child, 1, scope)
 
         elif nt == 'FOR':
             assert child[0].nt == 'EXPRLIST'
@@ -428,7 +455,7 @@ class inliner(object):
             del child[0]
             child[1].ch.append(nr(nt='JUMP', t=None, name=lbl, scope=scope))
             fns = self.RecurseExpression(child, 0, scope)
-            self.RecurseSingleStatement(child, 1, scope)
+            yield self.RecurseSingleStatement(child, 1, scope)
 
         else:
             assert False, u"Unexpected node type: %s" % nt.decode('utf8')
@@ -237,7 +237,7 @@ def InternalElement2Json(elem, ParseNumbers = True):
             return elem
 
         if ParseNumbers:
-            match = (jsonnumbug_re if 6466 in Bugs else jsonnum_re).match(elem)
+            match = (jsonnumbug_re if 6466 in CurrentContext().Bugs else jsonnum_re).match(elem)
             if match and match.end() == len(elem):
                 return elem
 
@@ -258,7 +258,7 @@ def InternalElement2Json(elem, ParseNumbers = True):
 def InternalJsonGetToken(json, idx):
 
     #start = idx
-    num_re = jsonnumbug_re if 6466 in Bugs else jsonnum_re
+    num_re = jsonnumbug_re if 6466 in CurrentContext().Bugs else jsonnum_re
 
     L = len(json)
     while idx < L:
@@ -487,7 +487,7 @@ def InternalJson2Elem(json):
     if json == u'true':
         return JSON_TRUE
 
-    match = (jsonnumbug_re if 6466 in Bugs else jsonnum_re).match(json)
+    match = (jsonnumbug_re if 6466 in CurrentContext().Bugs else jsonnum_re).match(json)
     if match and match.end() == len(json):
         # HACK: Use our RE to know if the number is an integer
         if not match.group(1) and not match.group(2):
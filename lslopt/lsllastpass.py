@@ -33,6 +33,11 @@ class rec:
             setattr(self, i, init[i])
 
 class lastpass(object):
+    # Estimated bytes of Mono code and executed instructions saved by each
+    # element converted to an addition by the listadd option.
+    ListAddSize = 2
+    ListAddSpeed = -10
+
     def visible(self, scope):
         return scope in self.scopeStack
     def LastPassPreOrder(self, parent, index):
@@ -56,6 +61,9 @@ class lastpass(object):
             return
 
         if (self.optlistadd and not self.globalmode
+            # Each addition is a call that copies the list, so it's only
+            # done when optimizing for size.
+            and self.Worth(self.ListAddSize, self.ListAddSpeed)
             and (nt == 'CONST' and node.t == 'list' or nt == 'LIST'
                  or nt == '+' and child[0].t == 'list' and
                  (child[1].nt == 'CONST' and child[1].t == 'list'
@@ -101,7 +109,7 @@ class lastpass(object):
             # where state changes are considered bad.
             # BadStCh will be True if at least one state change statement
             # is found while monitoring state changes.
-            self.subinfo['StChAreBad'] = hasattr(node, 'scope')
+            self.subinfo['StChAreBad'] = node.scope is not None
             self.BadStCh = False
             return
 
@@ -166,7 +174,7 @@ class lastpass(object):
         child = node.ch
 
         if nt == 'FNDEF':
-            if hasattr(node, 'scope') and self.BadStCh:
+            if node.scope is not None and self.BadStCh:
                 # There is at least one bad state change statement in the
                 # function (must be the result of optimization).
                 # Insert dummy IF(1){...} statement covering the whole function
@@ -203,19 +211,26 @@ class lastpass(object):
             self.lastStmt = rec(node=node, parent=parent, index=index)
 
     def RecursiveLastPass(self, parent, index):
-        subinfo = self.subinfo
-        self.subinfo = subinfo.copy()
-        self.LastPassPreOrder(parent, index)
+        # The traversal uses an explicit stack, so that long expressions
+        # don't exceed the recursion limit. The entries with the subinfo to
+        # restore are the pending post-order visits.
+        stack = [(parent, index, None)]
+        while stack:
+            parent, index, subinfo = stack.pop()
+            if subinfo is not None:
+                self.LastPassPostOrder(parent, index)
+                self.subinfo = subinfo
+                continue
+
+            subinfo = self.subinfo
+            self.subinfo = subinfo.copy()
+            self.LastPassPreOrder(parent, index)
+            stack.append((parent, index, subinfo))
 
-        if parent[index].ch is not None:
             child = parent[index].ch
-            idx = 0
-            while idx < len(child):
-                self.RecursiveLastPass(child, idx)
-                idx += 1
-
-        self.LastPassPostOrder(parent, index)
-        self.subinfo = subinfo
+            if child is not None:
+                stack.extend((child, idx, None)
+                             for idx in xrange(len(child) - 1, -1, -1))
 
     def LastPass(self):
         """Last optimizations pass"""
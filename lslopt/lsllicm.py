@@ -0,0 +1,196 @@
+#    (C) Copyright 2015-2021 Sei Lisa. All rights reserved.
+#
+#    This file is part of LSL PyOptimizer.
+#
+#    LSL PyOptimizer is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    LSL PyOptimizer is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with LSL PyOptimizer. If not, see <http://www.gnu.org/licenses/>.
+
+# Loop-invariant code motion.
+#
+# An expression inside a loop that calls a library function, is SEF and
+# gives the same value in every iteration (only functions whose result
+# depends on nothing but their arguments, and no assignments to its
+# variables within the loop) is evaluated once, before the loop, into a
+# local variable, which is used in its place. Functions like llGetTime are
+# SEF and stable, but their result changes between iterations of a loop
+# that waits for them to change.
+
+from lslopt import lslextrafuncs
+from lslopt.lslcommon import nr
+from lslopt.lslcse import CSE_CONTAINERS
+from strutil import xrange
+
+# Loop statements, and the index of their condition.
+LICM_LOOPS = {'WHILE': 0, 'DO': 1, 'FOR': 1}
+
+class licm(object):
+
+    def FnStateless(self, node):
+        """Return whether the result of a library function call depends on
+        nothing but its arguments. The functions in lslextrafuncs only
+        compute some special cases of functions that depend on the state
+        of the world.
+        """
+        return ('Fn' in self.symtab[0][node.name]
+                and not hasattr(lslextrafuncs, node.name))
+
+    def LoopScan(self, loop):
+        """Scan a loop. Return None if it contains labels, since a jump to
+        them would skip the hoisted declarations. Otherwise return a tuple
+        with the set of variables (as tuples of name and scope) that are
+        written or declared in the loop, and whether it calls a user function
+        with side effects.
+        """
+        written = set()
+        usercalls = False
+        stack = [loop]
+        while stack:
+            node = stack.pop()
+            nt = node.nt
+            if nt == '@':
+                return None
+            if nt == 'FNCALL':
+                if not self.FnSEF(node):
+                    usercalls = usercalls or 'Loc' in self.symtab[0][node.name]
+            elif (nt in self.assign_ops
+                  or nt in ('V++', 'V--', '++V', '--V')
+                 ):
+                lvalue = node.ch[0]
+                if lvalue.nt == 'FLD':
+                    lvalue = lvalue.ch[0]
+                written.add((lvalue.name, lvalue.scope))
+            elif nt == 'DECL':
+                written.add((node.name, node.scope))
+            if node.ch:
+                stack.extend(node.ch)
+        return written, usercalls
+
+    def LoopInvariants(self, loop, written, usercalls):
+        """Return the largest invariant subexpressions of a loop that call a
+        function, given the results of LoopScan, as tuples of (node, parent,
+        index).
+        """
+        cands = []
+        # The condition of a WHILE is evaluated before anything else in the
+        # loop, and so is the one of a FOR if its initialization is SEF. The
+        # body of a DO may return, jump out or change state first.
+        condidx = LICM_LOOPS[loop.nt]
+        if (loop.nt == 'DO'
+            or loop.nt == 'FOR' and not all(expr.SEF
+                                            for expr in loop.ch[0].ch)
+           ):
+            condidx = None
+
+        # Post-order traversal. For each node, keep whether it's invariant,
+        # whether it calls a function and whether it may raise a math error.
+        invariant = {}
+        hascall = {}
+        traps = {}
+        stack = [(loop, i, False, i == condidx)
+                 for i in xrange(len(loop.ch))]
+        while stack:
+            owner, index, visited, incond = stack.pop()
+            node = owner.ch[index]
+            if not visited:
+                stack.append((owner, index, True, incond))
+                if node.ch:
+                    stack.extend((node, i, False, incond)
+                                 for i in xrange(len(node.ch)))
+                continue
+
+            nt = node.nt
+            ok = call = trap = False
+            if nt == 'CONST':
+                ok = True
+            elif nt == 'IDENT':
+                # A user function with side effects can change a global.
+                ok = ((node.name, node.scope) not in written
+                      and not (usercalls and node.scope == 0))
+            elif nt == 'FNCALL':
+                # Only the functions that depend on nothing but their
+                # parameters give the same result in every iteration.
+                ok = (node.SEF and 'uns' not in self.symtab[0][node.name]
+                      and self.FnStateless(node)
+                      and all(invariant[id(child)] for child in node.ch))
+                call = True
+            elif nt in self.hashed_ops:
+                ok = node.SEF and all(invariant[id(child)]
+                                      for child in node.ch)
+                trap = nt in ('/', '%')
+            if node.ch:
+                call = call or any(hascall[id(child)] for child in node.ch)
+                trap = trap or any(traps[id(child)] for child in node.ch)
+            invariant[id(node)] = ok
+            hascall[id(node)] = call
+            traps[id(node)] = trap
+
+            if ok and call and nt in self.hashed_ops:
+                cands.append((node, owner, index, incond))
+
+        # Keep only the largest ones. Also, only the expressions in a
+        # condition evaluated first are sure to be evaluated before anything
+        # else, and an expression that is not must not raise an error.
+        return [(node, owner.ch, index)
+                for node, owner, index, incond in cands
+                if not invariant.get(id(owner), False)
+                   and (incond or not traps[id(node)])]
+
+    def HoistInvariants(self, block, index):
+        """Move the invariant expressions of the loop at the given index of
+        the block before it. Return the number of statements added.
+        """
+        loop = block.ch[index]
+        scan = self.LoopScan(loop)
+        if scan is None:
+            return 0
+        cands = self.LoopInvariants(loop, *scan)
+
+        added = 0
+        for occurrences in self.CSEGroups(cands):
+            expr = occurrences[0][0]
+            scope = block.scope
+            name = self.CSENewName('___licm__')
+            self.symtab[scope][name] = {'Kind':'v', 'Scope':scope,
+                                        'Type':expr.t}
+            for node, parent, idx in occurrences:
+                parent[idx] = nr(nt='IDENT', t=expr.t, name=name,
+                                 scope=scope, SEF=True)
+            block.ch.insert(index, nr(nt='DECL', t=expr.t, name=name,
+                                      scope=scope, ch=[expr]))
+            index += 1
+            added += 1
+        if added:
+            self.InvalidateHashes()
+        return added
+
+    def HoistLoopInvariants(self):
+        """Move the loop-invariant expressions that call functions out of
+        the loops that are statements of a block.
+        """
+        self.csecount = 0
+        # The previous passes have changed the tree.
+        self.InvalidateHashes()
+        stack = [node for node in self.tree if node.nt != 'DECL']
+        while stack:
+            node = stack.pop()
+            if node.nt not in CSE_CONTAINERS:
+                continue
+            if node.nt == '{}':
+                stmts = node.ch
+                i = 0
+                while i < len(stmts):
+                    if stmts[i].nt in LICM_LOOPS:
+                        i += self.HoistInvariants(node, i)
+                    i += 1
+            if node.ch:
+                stack.extend(node.ch)
@@ -17,14 +17,375 @@
 
 # Load the builtins and function properties.
 
-import sys, re
-from lslopt.lslcommon import types, warning, Vector, Quaternion
+import sys, os, re, hashlib
+from lslopt.lslcommon import types, Vector, Quaternion
 from lslopt import lslcommon, lslfuncs
 from strutil import *
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
-def LoadLibrary(builtins = None, fndata = None):
+# Version of the format of the library tables. Bump it whenever the tables
+# returned by ParseLibrary change in any way, so that the existing caches are
+# discarded.
+LIBCACHE_VERSION = 2
+
+# Entries of the function table that are not stored in the cache, because
+# they are Python functions. LinkLibrary creates them.
+LIBCACHE_LINKED = frozenset({'Fn', 'SEFPred', 'RetPred'})
+
+def LibCacheFile(builtins):
+    """Return the name of the cache file for the given builtins file."""
+    return builtins + '.cache'
+
+def LibCacheKey(builtins, fndata):
+    """Return the key that identifies a cache as valid for the given
+    files. It depends on their contents, the cache format version and the
+    Python version.
+    """
+    h = hashlib.sha1()
+    h.update(str2b('LSL PyOptimizer library cache %d Python %d.%d\n'
+                   % ((LIBCACHE_VERSION,) + tuple(sys.version_info[:2]))))
+    for fname in (builtins, fndata):
+        f = open(fname, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        h.update(str2b('%d\n' % len(data)))
+        h.update(data)
+    return h.hexdigest()
+
+def ReadLibCache(cachefile, key):
+    """Return the library stored in the given cache file, or None if it
+    doesn't exist, can't be read, or doesn't match the key.
+    """
+    try:
+        f = open(cachefile, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        try:
+            data = pickle.load(f)
+        except Exception:
+            # Corrupt, truncated, or written by an incompatible version.
+            return None
+    finally:
+        f.close()
+
+    if type(data) != tuple or len(data) != 2 or data[0] != key:
+        return None
+    events, constants, functions = data[1]
+
+    LinkLibrary(functions)
+    return events, constants, functions
+
+def WriteLibCache(cachefile, key, lib):
+    """Store the library in the given cache file. Failure to write it (e.g.
+    due to a read-only directory) is not an error.
+    """
+    events, constants, functions = lib
+    functions = dict((name, dict((k, v) for k, v in functions[name].items()
+                                 if k not in LIBCACHE_LINKED))
+                     for name in functions)
+    tmpfile = cachefile + '.%d.tmp' % os.getpid()
+    try:
+        f = open(tmpfile, 'wb')
+        try:
+            pickle.dump((key, (events, constants, functions)), f, 2)
+        finally:
+            f.close()
+        try:
+            os.rename(tmpfile, cachefile)
+        except OSError:
+            # Windows doesn't overwrite on rename.
+            os.remove(cachefile)
+            os.rename(tmpfile, cachefile)
+    except (IOError, OSError):
+        try:
+            os.remove(tmpfile)
+        except OSError:
+            pass
+
+# Conditions of the SEF and return flags of fndata.txt.
+#
+# They are parsed into tuples, which are stored in the function table as
+# 'SEFCond' and 'Return' (a list of (value, condition) in order, where the
+# condition is None if there's none), and then compiled into predicates,
+# 'SEFPred' and 'RetPred'. The nodes of the parsed conditions are:
+#   ('or', [cond, ...]), ('and', [cond, ...]), ('nulluuid', operand),
+#   ('cmp', [operand, op, operand, ...]).
+# The operands are ('param', index), ('event',) or ('const', value).
+
+cond_tok_re = re.compile(r'\s*(?:'
+    r'("(?:\\.|[^"\\])*")'                          # string
+    r'|(<[-+0-9.eE\s]+(?:,[-+0-9.eE\s]+){2,3}>)'      # vector, rotation
+    r'|(\[(?:[^]"]|"(?:\\.|[^"\\])*")*\])'            # list
+    r'|(-?(?:0[xX][0-9A-Fa-f]+|[0-9]+\.?[0-9]*(?:[eE][-+]?[0-9]+)?'
+        r'|\.[0-9]+(?:[eE][-+]?[0-9]+)?))'              # number
+    r'|([A-Za-z_][A-Za-z0-9_]*)'                       # identifier
+    r'|(==|!=|<=|>=|<|>|&&|\|\||[(),])'                # operator
+    r')')
+
+cond_cmp_ops = {'==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+def CondTokens(text):
+    """Split a condition or value of fndata.txt into a list of tuples of
+    (kind, token), where kind is the group number in cond_tok_re. Raises
+    ValueError if there are invalid characters.
+    """
+    ret = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = cond_tok_re.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError(text[pos:])
+        pos = match.end()
+        kind = match.lastindex
+        ret.append((kind, match.group(kind)))
+    return ret
+
+def CondLiteral(kind, token):
+    """Return the value of a literal token. Raises ValueError if it's not
+    a valid literal.
+    """
+    if kind == 1:
+        value = u''
+        esc = False
+        for c in str2u(token[1:-1], 'utf8'):
+            if esc:
+                value += u'\n' if c == u'n' else u'    ' if c == u't' else c
+                esc = False
+            elif c == u'\\':
+                esc = True
+            else:
+                value += c
+        return value
+    if kind == 2:
+        value = lslfuncs.F32List([float(x) for x in token[1:-1].split(',')])
+        return Vector(value) if len(value) == 3 else Quaternion(value)
+    if kind == 3:
+        tokens = CondTokens(token[1:-1])
+        value = []
+        for i in xrange(0, len(tokens), 2):
+            if i + 1 < len(tokens) and tokens[i + 1] != (6, ','):
+                raise ValueError(token)
+            value.append(CondLiteral(*tokens[i]))
+        if tokens and tokens[-1] == (6, ','):
+            raise ValueError(token)
+        return value
+    if kind == 4:
+        if token.lower().lstrip('-').startswith('0x'):
+            return lslfuncs.S32(int(token, 16))
+        if '.' in token or 'e' in token or 'E' in token:
+            return lslfuncs.F32(float(token))
+        return lslfuncs.S32(int(token))
+    raise ValueError(token)
+
+def CondValue(text, typ):
+    """Return the value of a return flag, converted to the given LSL type.
+    Raises ValueError if it's not valid or has the wrong type.
+    """
+    tokens = CondTokens(text)
+    if len(tokens) != 1:
+        raise ValueError(text)
+    value = CondLiteral(*tokens[0])
+    if typ == 'key' and type(value) == unicode:
+        value = lslcommon.Key(value)
+    elif typ == 'float' and type(value) == int:
+        value = lslfuncs.F32(float(value))
+    elif typ == 'rotation' and type(value) == Quaternion:
+        pass
+    elif lslcommon.PythonType2LSL.get(type(value)) != typ:
+        raise ValueError(text)
+    return value
+
+def ParseCondition(text, argnames, argtypes):
+    """Parse a condition of fndata.txt for a function with the given
+    parameter names and types, and return it as a tuple. Raises ValueError
+    if there's a syntax error.
+    """
+    tokens = CondTokens(text)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def expect(token):
+        if peek() != (6, token):
+            raise ValueError(text)
+        pos[0] += 1
+
+    def operand():
+        kind, token = peek()
+        pos[0] += 1
+        if kind == 5:
+            if token == 'event':
+                return ('event',), 'string'
+            if token not in argnames:
+                raise ValueError(text)
+            idx = argnames.index(token)
+            return ('param', idx), argtypes[idx]
+        value = CondLiteral(kind, token)
+        return ('const', value), lslcommon.PythonType2LSL[type(value)]
+
+    def convert(opnd, typ):
+        # Strings are cast to key and integers to float when compared with
+        # operands of these types.
+        if opnd[0] == 'const':
+            if typ == 'key' and type(opnd[1]) == unicode:
+                return ('const', lslcommon.Key(opnd[1]))
+            if typ == 'float' and type(opnd[1]) == int:
+                return ('const', float(opnd[1]))
+        return opnd
+
+    def comparison():
+        if peek() == (6, '('):
+            pos[0] += 1
+            cond = disjunction()
+            expect(')')
+            return cond
+        if peek() == (5, 'nulluuid'):
+            pos[0] += 1
+            expect('(')
+            opnd = operand()[0]
+            expect(')')
+            return ('nulluuid', opnd)
+        opnd, typ = operand()
+        chain = [opnd]
+        types = [typ]
+        while peek()[0] == 6 and peek()[1] in cond_cmp_ops:
+            chain.append(peek()[1])
+            pos[0] += 1
+            opnd, typ = operand()
+            chain.append(opnd)
+            types.append(typ)
+        if len(chain) < 3:
+            raise ValueError(text)
+        for i in xrange(0, len(chain), 2):
+            for typ in types:
+                chain[i] = convert(chain[i], typ)
+        return ('cmp', chain)
+
+    def conjunction():
+        conds = [comparison()]
+        while peek() == (6, '&&'):
+            pos[0] += 1
+            conds.append(comparison())
+        return conds[0] if len(conds) == 1 else ('and', conds)
+
+    def disjunction():
+        conds = [conjunction()]
+        while peek() == (6, '||'):
+            pos[0] += 1
+            conds.append(conjunction())
+        return conds[0] if len(conds) == 1 else ('or', conds)
+
+    cond = disjunction()
+    if pos[0] != len(tokens):
+        raise ValueError(text)
+    return cond
+
+def CompileCondition(cond):
+    """Return a predicate that evaluates a parsed condition. It takes a
+    list with the values of the parameters, where the ones that are not
+    known are None, and the name of the current event ('' if not known),
+    and returns True, False, or None if the result can't be known.
+    """
+    kind = cond[0]
+    if kind in ('or', 'and'):
+        preds = [CompileCondition(c) for c in cond[1]]
+        # The value that decides the result.
+        final = kind == 'or'
+        def pred(args, event):
+            ret = not final
+            for p in preds:
+                r = p(args, event)
+                if r is final:
+                    return final
+                if r is None:
+                    ret = None
+            return ret
+        return pred
+
+    if kind == 'nulluuid':
+        get = CompileOperand(cond[1])
+        def pred(args, event):
+            value = get(args, event)
+            if value is None:
+                return None
+            return not lslfuncs.cond(lslcommon.Key(value))
+        return pred
+
+    assert kind == 'cmp'
+    getters = [CompileOperand(opnd) for opnd in cond[1][::2]]
+    ops = [cond_cmp_ops[op] for op in cond[1][1::2]]
+    def pred(args, event):
+        values = [get(args, event) for get in getters]
+        ret = True
+        for i in xrange(len(ops)):
+            if values[i] is None or values[i + 1] is None:
+                ret = None
+            elif not ops[i](values[i], values[i + 1]):
+                return False
+        return ret
+    return pred
+
+def CompileOperand(opnd):
+    """Return a function that gives the value of an operand of a parsed
+    condition, with the same parameters as the predicates.
+    """
+    if opnd[0] == 'param':
+        idx = opnd[1]
+        return lambda args, event: args[idx]
+    if opnd[0] == 'event':
+        return lambda args, event: event
+    value = opnd[1]
+    return lambda args, event: value
+
+def CompileReturns(rules):
+    """Return a function that evaluates a list of return rules, with the
+    same parameters as the predicates. It returns the value of the first
+    rule whose condition is met, or None if none is, or if it's not known
+    whether one is.
+    """
+    rules = [(value, None if cond is None else CompileCondition(cond))
+             for value, cond in rules]
+    def ret(args, event):
+        for value, pred in rules:
+            met = True if pred is None else pred(args, event)
+            if met is None:
+                return None
+            if met:
+                return list(value) if type(value) == list else value
+        return None
+    return ret
+
+def LinkLibrary(functions):
+    """Add to the function table the entries that can't be stored in the
+    cache: the implementations and the compiled conditions.
+    """
+    for name in functions:
+        sym = functions[name]
+        fn = getattr(lslfuncs, name, None)
+        if fn is not None:
+            sym['Fn'] = fn
+        if 'SEFCond' in sym:
+            sym['SEFPred'] = CompileCondition(sym['SEFCond'])
+        if 'Return' in sym:
+            sym['RetPred'] = CompileReturns(sym['Return'])
+
+def LoadLibrary(builtins = None, fndata = None, cache = True):
     """Load builtins.txt and fndata.txt (or the given filenames) and return
     a tuple with the events, constants and functions, each in a dict.
+
+    If cache is True, the tables are read from a cache file located next to
+    the builtins file when it's up to date, and the cache is regenerated
+    otherwise. Libraries that generate warnings are never cached.
     """
 
     if builtins is None:
@@ -33,6 +394,34 @@ def LoadLibrary(builtins = None, fndata = None):
     if fndata is None:
         fndata = lslcommon.DataPath + 'fndata.txt'
 
+    if not cache:
+        return ParseLibrary(builtins, fndata)[0]
+
+    try:
+        key = LibCacheKey(builtins, fndata)
+    except (IOError, OSError):
+        # Let ParseLibrary report the error.
+        return ParseLibrary(builtins, fndata)[0]
+
+    cachefile = LibCacheFile(builtins)
+    lib = ReadLibCache(cachefile, key)
+    if lib is None:
+        lib, clean = ParseLibrary(builtins, fndata)
+        if clean:
+            WriteLibCache(cachefile, key, lib)
+    return lib
+
+def ParseLibrary(builtins, fndata):
+    """Parse the given builtins and function data files. Return a tuple with
+    the library (events, constants and functions) and whether it was parsed
+    without warnings.
+    """
+
+    issued = []
+    def warning(txt):
+        issued.append(txt)
+        lslcommon.warning(txt)
+
     events = {}
     constants = {}
     functions = {}
@@ -126,11 +515,8 @@ def LoadLibrary(builtins = None, fndata = None):
                                 u" in %s, overwriting: %s"
                                 % (linenum, ubuiltins, uname))
                         del uname
-                    fn = getattr(lslfuncs, name, None)
                     functions[name] = {'Kind':'f', 'Type':typ, 'uns':True,
                                        'ParamTypes':args, 'NeedsData':True}
-                    if fn is not None:
-                        functions[name]['Fn'] = fn
             elif match.group(4):
                 # constant
                 name = match.group(5)
@@ -332,6 +718,7 @@ def LoadLibrary(builtins = None, fndata = None):
                 # passed all tests
                 curr_fn = name
                 curr_ty = rettype
+                curr_args = argnames
                 skipping = False
                 if curr_ty == 'event':
                     del events[name]['NeedsData']
@@ -351,9 +738,6 @@ def LoadLibrary(builtins = None, fndata = None):
                         ucurr_fn = str2u(curr_fn, 'utf8')
                         if match_flag.group(1):
                             # SEF
-                            # We don't handle conditions yet. Take the
-                            # condition as never met for now (every function
-                            # that is conditionally SEF is taken as not SEF)
                             if curr_ty == 'event' and match_flag.group(3):
                                 warning(u"Events do not support conditions"
                                         u" in SEF flags, in line %d, event %s."
@@ -362,9 +746,22 @@ def LoadLibrary(builtins = None, fndata = None):
                                 continue
                             elif curr_ty == 'event':
                                 events[curr_fn]['SEF'] = True
+                            elif not match_flag.group(3):
+                                functions[curr_fn]['SEF'] = True
                             else:
-                                if not match_flag.group(3):
-                                    functions[curr_fn]['SEF'] = True
+                                # Conditionally SEF. It's only taken as SEF
+                                # when the condition is known to be met.
+                                try:
+                                    functions[curr_fn]['SEFCond'] = \
+                                        ParseCondition(match_flag.group(3),
+                                                       curr_args,
+                                                       functions[curr_fn]
+                                                           ['ParamTypes'])
+                                except ValueError:
+                                    warning(u"Invalid condition in %s line"
+                                            u" %d: %s"
+                                            % (ufndata, linenum, uline))
+                                    continue
 
                         elif curr_ty == 'event':
                             if match_flag.group(4):
@@ -378,7 +775,20 @@ def LoadLibrary(builtins = None, fndata = None):
                                             % (linenum, ucurr_fn, uline))
                             continue
                         elif match_flag.group(2):
-                            pass # return not handled yet
+                            sym = functions[curr_fn]
+                            try:
+                                value = CondValue(match_flag.group(2),
+                                                  sym['Type'])
+                                cond = match_flag.group(3)
+                                if cond is not None:
+                                    cond = ParseCondition(cond, curr_args,
+                                                          sym['ParamTypes'])
+                            except ValueError:
+                                warning(u"Invalid return value or condition"
+                                        u" in %s line %d: %s"
+                                        % (ufndata, linenum, uline))
+                                continue
+                            sym.setdefault('Return', []).append((value, cond))
                         elif match_flag.group(4):
                             flag = match_flag.group(4).lower()
                             if flag == 'unstable':
@@ -462,4 +872,5 @@ def LoadLibrary(builtins = None, fndata = None):
             warning(u"Library data, file %s: Event %s has no data."
                     % (ufndata, ui))
 
-    return events, constants, functions
+    LinkLibrary(functions)
+    return (events, constants, functions), not issued
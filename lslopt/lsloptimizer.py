@@ -17,15 +17,18 @@
 
 # Optimizer class that wraps and calls the other parts.
 
-from lslopt import lslfuncs
+import time
+from lslopt import lslfuncs, lslcommon, lsltimings
 
 from lslopt.lslcommon import nr
 from lslopt.lslfoldconst import foldconst
 from lslopt.lslrenamer import renamer
 from lslopt.lsldeadcode import deadcode
 from lslopt.lsllastpass import lastpass
+from lslopt.lslcse import cse
+from lslopt.lsllicm import licm
 
-class optimizer(foldconst, renamer, deadcode, lastpass):
+class optimizer(foldconst, renamer, deadcode, lastpass, cse, licm):
 
     # Default values per type when declaring variables
     DefaultValues = {'integer': 0, 'float': 0.0, 'string': u'',
@@ -33,10 +36,12 @@ class optimizer(foldconst, renamer, deadcode, lastpass):
         'rotation': lslfuncs.ZERO_ROTATION, 'list': []
         }
 
-    # explicitly exclude assignments
-    binary_ops = frozenset({'+','-','*','/','%','<<','>>','<','<=','>','>=',
-        '==','!=','|','^','&','||','&&'})
-    assign_ops = frozenset({'=','+=','-=','*=','/=','%=','&=','|=','^=','<<=','>>='})
+    # Context of the script being optimized (set by optimize())
+    ctx = lslcommon.GlobalContext
+
+    # Maximum number of additional rounds of dead code removal and constant
+    # folding, run while each keeps changing the result of the other.
+    MaxPassRounds = 8
 
     def Cast(self, value, newtype):
         """Return a CAST node if the types are not equal, otherwise the
@@ -51,10 +56,12 @@ class optimizer(foldconst, renamer, deadcode, lastpass):
             ret.X = value.X
         return ret
 
+    @lslcommon.WithContext
     def optimize(self, treesymtab, options = ('optimize','constfold','dcr',
                  'warntabs')):
         """Optimize the symbolic table symtab in place. Requires a table of
-        predefined functions for folding constants.
+        predefined functions for folding constants. ctx is the
+        lslcommon.context to use; the current one by default.
         """
         if 'optimize' not in options:
             return treesymtab
@@ -71,6 +78,11 @@ class optimizer(foldconst, renamer, deadcode, lastpass):
         self.optlistlength = 'listlength' in options
         self.optlistadd = 'listadd' in options
         self.dcr = 'dcr' in options
+        self.objective = lslcommon.Objective(options)
+        self.cseall = 'cseall' in options
+        self.cse = ('cse' in options or self.cseall
+                    or self.objective != 'size')
+        self.licm = 'licm' in options or self.objective != 'size'
 
         # Math that works fine except in rare corner-cases can be optimized.
         self.cornermath = 'cornermath' in options
@@ -79,27 +91,132 @@ class optimizer(foldconst, renamer, deadcode, lastpass):
 
         self.globalmode = False
 
+        # Statistics of the passes: name -> [runs, seconds]
+        self.passstats = {}
+        self.passrounds = 0
+        self.foldcalls = self.foldhits = 0
+
         if self.dcr:
             if self.constfold:
-                self.FoldScript(warningpass=False)
+                self.RunPass('FoldScript', self.FoldScript, False)
 
-            self.RemoveDeadCode()
+            self.RunPass('RemoveDeadCode', self.RemoveDeadCode)
+            fingerprints = self.Fingerprints()
 
         # Make another fold pass, since RemoveDeadCode can embed expressions
         # into other expressions and generate unoptimized code.
         # Or make the first pass here if DCR is disabled.
         if self.constfold:
-            self.FoldScript(warningpass=True)
-
-        names = self.LastPass()
+            SEFFunctions = self.SEFFunctions()
+            self.RunPass('FoldScript', self.FoldScript, True)
+
+        if self.dcr and self.constfold and not self.ctx.IsCalc:
+            # Repeat until neither pass changes what the other one did,
+            # folding only the parts that changed.
+            while self.passrounds < self.MaxPassRounds:
+                changed, dirty = self.Changes(fingerprints)
+                if not changed and self.SEFFunctions() == SEFFunctions:
+                    break
+                self.passrounds += 1
+                self.ClearDeadCodeMarks()
+                fingerprints = self.Fingerprints()
+                self.RunPass('RemoveDeadCode', self.RemoveDeadCode)
+                changed, dirty = self.Changes(fingerprints)
+                if self.SEFFunctions() != SEFFunctions:
+                    # Calls may now be removable anywhere.
+                    dirty = None
+                elif not changed:
+                    break
+                elif any(id(node) in dirty for node in self.tree
+                         if node.nt == 'DECL'):
+                    # Globals are folded using the values of other globals.
+                    dirty.update(id(node) for node in self.tree
+                                 if node.nt == 'DECL')
+                fingerprints = self.Fingerprints()
+                SEFFunctions = self.SEFFunctions()
+                self.RunPass('FoldScript', self.FoldScript, False, dirty)
+
+        if self.licm and not self.ctx.IsCalc:
+            self.RunPass('LICM', self.HoistLoopInvariants)
+
+        if self.cse and not self.ctx.IsCalc:
+            self.RunPass('CSE', self.EliminateCommonSubexpressions)
+
+        names = self.RunPass('LastPass', self.LastPass)
 
         if self.shrinknames:
-            self.ShrinkNames(UsableAsParams = names['libfuncs'])
+            self.RunPass('ShrinkNames', self.ShrinkNames,
+                        UsableAsParams = names['libfuncs'])
 
         treesymtab = (self.tree, self.symtab)
         del self.tree
         del self.symtab
         return treesymtab
 
+    def RunPass(self, name, fn, *args, **kwargs):
+        """Call a pass, accounting it in the pass statistics, and return
+        its result. The pass is also measured in the timings of the context,
+        if it has them.
+        """
+        lsltimings.Begin(self.ctx, name, self.tree)
+        t = time.time()
+        ret = fn(*args, **kwargs)
+        t = time.time() - t
+        lsltimings.End(self.ctx, self.tree)
+        stats = self.passstats.setdefault(name, [0, 0.])
+        stats[0] += 1
+        stats[1] += t
+        return ret
+
+    def PassStats(self):
+        """Return a text with the statistics of the passes run by the last
+        call to optimize().
+        """
+        ret = [u"Optimizer passes (%d extra rounds):\n" % self.passrounds]
+        for name in ('FoldScript', 'RemoveDeadCode', 'LICM', 'CSE', 'LastPass',
+                     'ShrinkNames'):
+            if name in self.passstats:
+                runs, t = self.passstats[name]
+                ret.append(u"  %-16s %3d runs %10.3f ms\n"
+                           % (name, runs, t * 1000.))
+        ret.append(u"Folded library calls: %d, %d from the memo\n"
+                   % (self.foldcalls, self.foldhits))
+        return u''.join(ret)
+
+    def Fingerprint(self, node):
+        """Return a value that changes when the subtree changes. Attributes
+        that the passes only use as annotations are not included.
+        """
+        ret = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            ret.append((node.nt, node.t, node.name, node.scope,
+                        None if node.value is None else repr(node.value),
+                        getattr(node, 'fld', None),
+                        None if node.ch is None else len(node.ch)))
+            if node.ch:
+                stack.extend(node.ch)
+        return ret
+
+    def Fingerprints(self):
+        """Return the fingerprints of the top level nodes, by id."""
+        return dict((id(node), self.Fingerprint(node)) for node in self.tree)
+
+    def Changes(self, fingerprints):
+        """Compare the tree with the given fingerprints. Return whether the
+        tree changed, and the set of ids of the top level nodes that are new
+        or have changed.
+        """
+        dirty = set(id(node) for node in self.tree
+                    if fingerprints.get(id(node)) != self.Fingerprint(node))
+        return bool(dirty) or len(fingerprints) != len(self.tree), dirty
+
+    def SEFFunctions(self):
+        """Return the set of user functions currently known to be SEF."""
+        return frozenset(name for name, sym in self.symtab[0].items()
+                         if sym.get('Kind') == 'f' and 'Loc' in sym
+                         and sym.get('SEF'))
+
     def __init__(self, lib):
         self.events = lib[0]
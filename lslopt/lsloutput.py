@@ -21,6 +21,7 @@ from lslopt import lslfuncs
 from lslopt import lslcommon
 from lslopt.lslcommon import Key, Vector, Quaternion, warning
 from math import copysign
+from types import GeneratorType
 from strutil import *
 
 debugScopes = False
@@ -39,6 +40,13 @@ class outscript(object):
         '*':9, '/':9, '%':9}#, '!':10, '~':10, '++':10, '--':10, }
     assignment_ops = frozenset({'=', '+=', '-=', '*=', '/=','%='})
 
+    # Context of the script being output (set by output())
+    ctx = lslcommon.GlobalContext
+
+    # Output of the deep nodes of the expression being output, by node id,
+    # or None when there's none in progress.
+    exprcache = None
+
     def Value2LSL(self, value):
         tvalue = type(value)
         if tvalue in (Key, unicode):
@@ -77,7 +85,7 @@ class outscript(object):
                     if value == 0 and copysign(1, value) == -1:
                         return '-0.'
                     return str(int(value))
-                elif not self.globalmode:
+                elif not self.globalmode and self.floatcasts:
                     # Important inside lists!!
                     if value == 0 and copysign(1, value) == -1:
                         return '(-(float)0)'
@@ -160,9 +168,9 @@ class outscript(object):
                 ret += ']'
                 self.listmode = save_listmode
                 return ret
-            ret = '' if lslcommon.IsCalc else '\n'
+            ret = '' if self.ctx.IsCalc else '\n'
             first = True
-            self.indentlevel += 0 if lslcommon.IsCalc else 1
+            self.indentlevel += 0 if self.ctx.IsCalc else 1
             for entry in value:
                 ret += self.dent() + ('[ ' if first else ', ')
                 save_listmode = self.listmode
@@ -171,7 +179,7 @@ class outscript(object):
                 self.listmode = save_listmode
                 first = False
             ret += self.dent()
-            self.indentlevel -= 0 if lslcommon.IsCalc else 1
+            self.indentlevel -= 0 if self.ctx.IsCalc else 1
             return ret + ']'
 
         assert False, u'Value of unknown type in Value2LSL: ' + repr(value)
@@ -182,7 +190,7 @@ class outscript(object):
     def FindName(self, node, scope = None):
         if scope is None:
             # node is a node
-            if (hasattr(node, 'scope')
+            if (node.scope is not None
                     and 'NewName' in self.symtab[node.scope][node.name]):
                 return self.symtab[node.scope][node.name]['NewName']
             if node.nt == 'FNCALL' and 'NewName' in self.symtab[0][node.name]:
@@ -195,12 +203,13 @@ class outscript(object):
         return node
 
     def OutIndented(self, node):
+        # Part of OutNode; yields the statement, then its indented output.
         if node.nt != '{}':
             self.indentlevel += 1
-        ret = self.OutCode(node)
+        ret = yield node
         if node.nt != '{}':
             self.indentlevel -= 1
-        return ret
+        yield ret
 
     def OutExprList(self, L):
         ret = ''
@@ -215,6 +224,22 @@ class outscript(object):
 
     def OutExpr(self, expr):
         # Handles expression nodes (as opposed to statement nodes)
+        if self.exprcache is None:
+            # Outermost call. Output the deep nodes first (see DeepNodes).
+            # The lists are skipped, since their output depends on the
+            # indentation level.
+            self.exprcache = {}
+            try:
+                for parent, index in lslcommon.DeepNodes([expr], 0,
+                                                         ('LIST',)):
+                    node = parent[index]
+                    self.exprcache[id(node)] = self.OutExpr(node)
+                return self.OutExpr(expr)
+            finally:
+                self.exprcache = None
+        if id(expr) in self.exprcache:
+            return self.exprcache[id(expr)]
+
         nt = expr.nt
         child = expr.ch
 
@@ -324,15 +349,15 @@ class outscript(object):
             if len(child) < 5:
                 ret = '[' + self.OutExprList(child) + ']'
             else:
-                self.indentlevel += 0 if lslcommon.IsCalc else 1
-                ret = '' if lslcommon.IsCalc else '\n'
+                self.indentlevel += 0 if self.ctx.IsCalc else 1
+                ret = '' if self.ctx.IsCalc else '\n'
                 first = True
                 for elem in child:
                     ret += self.dent() + ('[ ' if first else ', ')
                     ret += self.OutExpr(elem) + '\n'
                     first = False
                 ret += self.dent() + ']'
-                self.indentlevel -= 0 if lslcommon.IsCalc else 1
+                self.indentlevel -= 0 if self.ctx.IsCalc else 1
             self.listmode = False
             return ret
 
@@ -407,6 +432,27 @@ class outscript(object):
         assert False, 'Internal error: expression type "' + nt + '" not handled' # pragma: no cover
 
     def OutCode(self, node):
+        # The output of each statement is a generator (see OutNode) that
+        # yields the statements or OutIndented generators it needs the
+        # output of, receives it, and finally yields its own output as a
+        # string. Keeping them in a stack instead of recursing allows any
+        # nesting depth of statements.
+        stack = [self.OutNode(node)]
+        value = None
+        while True:
+            value = stack[-1].send(value)
+            if isinstance(value, lslcommon.nr):
+                stack.append(self.OutNode(value))
+            elif isinstance(value, GeneratorType):
+                stack.append(value)
+            else:
+                stack.pop()
+                if not stack:
+                    return value
+                continue
+            value = None
+
+    def OutNode(self, node):
         nt = node.nt
         child = node.ch
 
@@ -426,50 +472,63 @@ class outscript(object):
                         needs_braces = True
                 if needs_braces:
                     ret += self.dent() + '{\n'
-                    ret += self.OutIndented(child[1])
+                    ret += (yield self.OutIndented(child[1]))
                     ret += self.dent() + '}\n'
                 else:
-                    ret += self.OutIndented(child[1])
+                    ret += (yield self.OutIndented(child[1]))
                 if len(child) < 3:
-                    return ret
+                    yield ret
+                    return
                 if child[2].nt != 'IF':
-                    ret += self.dent() + 'else\n' + self.OutIndented(child[2])
-                    return ret
+                    ret += self.dent() + 'else\n'
+                    ret += (yield self.OutIndented(child[2]))
+                    yield ret
+                    return
                 ret += self.dent() + 'else '
                 node = child[2]
                 child = node.ch
         if nt == 'WHILE':
             ret = self.dent() + 'while (' + self.OutExpr(child[0]) + ')\n'
-            ret += self.OutIndented(child[1])
-            return ret
+            ret += (yield self.OutIndented(child[1]))
+            yield ret
+            return
         if nt == 'DO':
             ret = self.dent() + 'do\n'
-            ret += self.OutIndented(child[0])
-            return ret + self.dent() + 'while (' + self.OutExpr(child[1]) + ');\n'
+            ret += (yield self.OutIndented(child[0]))
+            yield ret + self.dent() + 'while (' + self.OutExpr(child[1]) + ');\n'
+            return
         if nt == 'FOR':
             ret = self.dent() + 'for ('
             ret += self.OutExpr(child[0])
             ret += '; ' + self.OutExpr(child[1]) + '; '
             ret += self.OutExpr(child[2])
             ret += ')\n'
-            ret += self.OutIndented(child[3])
-            return ret
+            ret += (yield self.OutIndented(child[3]))
+            yield ret
+            return
         if nt == '@':
             if debugScopes:
-                return self.dent() + '@' + self.FindName(node) \
-                       + '\\' + str(node.scope) + '/;\n'
-            return self.dent() + '@' + self.FindName(node) + ';\n'
+                yield self.dent() + '@' + self.FindName(node) \
+                      + '\\' + str(node.scope) + '/;\n'
+                return
+            yield self.dent() + '@' + self.FindName(node) + ';\n'
+            return
         if nt == 'JUMP':
             if debugScopes:
-                return self.dent() + 'jump ' + self.FindName(node) \
-                       + '\\' + str(node.scope) + '/;\n'
-            return self.dent() + 'jump ' + self.FindName(node) + ';\n'
+                yield self.dent() + 'jump ' + self.FindName(node) \
+                      + '\\' + str(node.scope) + '/;\n'
+                return
+            yield self.dent() + 'jump ' + self.FindName(node) + ';\n'
+            return
         if nt == 'STSW':
-            return self.dent() + 'state ' + self.FindName(node) + ';\n'
+            yield self.dent() + 'state ' + self.FindName(node) + ';\n'
+            return
         if nt == 'RETURN':
             if child:
-                return self.dent() + 'return ' + self.OutExpr(child[0]) + ';\n'
-            return self.dent() + 'return;\n'
+                yield self.dent() + 'return ' + self.OutExpr(child[0]) + ';\n'
+                return
+            yield self.dent() + 'return;\n'
+            return
         if nt == 'DECL':
             ret = self.dent() + node.t + ' ' + self.FindName(node)
             if debugScopes:
@@ -481,9 +540,11 @@ class outscript(object):
                     ret += ' = ' + self.OutExpr(child[0].orig)
                 else:
                     ret += ' = ' + self.OutExpr(child[0])
-            return ret + ';\n'
+            yield ret + ';\n'
+            return
         if nt == ';':
-            return self.dent() + ';\n'
+            yield self.dent() + ';\n'
+            return
 
         if nt in ('STDEF', '{}'):
             ret = ''
@@ -501,10 +562,11 @@ class outscript(object):
                     continue
                 if nt == 'STDEF' and not firstnode:
                     ret += '\n'
-                ret += self.OutCode(stmt)
+                ret += (yield stmt)
                 firstnode = False
             self.indentlevel -= 1
-            return ret + self.dent() + '}\n'
+            yield ret + self.dent() + '}\n'
+            return
 
         if nt == 'FNDEF':
             ret = self.dent()
@@ -514,17 +576,23 @@ class outscript(object):
             scope = node.pscope
             ret += ', '.join(typ + ' ' + self.FindName(name, scope)
                              for typ, name in zip(node.ptypes, node.pnames))
-            return ret + ')\n' + self.OutCode(child[0])
+            ret += ')\n'
+            ret += (yield child[0])
+            yield ret
+            return
 
         if nt == 'EXPR':
-            return self.dent() + self.OutExpr(child[0]) + (
-                ';\n' if not lslcommon.IsCalc else '')
+            yield self.dent() + self.OutExpr(child[0]) + (
+                ';\n' if not self.ctx.IsCalc else '')
+            return
 
         if nt == 'LAMBDA':
-            return ''
+            yield ''
+            return
 
         assert False, "Internal error: node type not handled: " + nt # pragma: no cover
 
+    @lslcommon.WithContext
     def output(self, treesymtab, options = ('optimize',
             'optsigns','optfloats','warntabs')):
         # Build a sorted list of dict entries
@@ -536,6 +604,9 @@ class outscript(object):
         self.optsigns = self.optimize and 'optsigns' in options
         self.optfloats = self.optimize and 'optfloats' in options
         self.foldconst = self.optimize and 'constfold' in options
+        # In local code, a cast from integer saves 3 bytes over a float
+        # constant, but the conversion is an extra instruction.
+        self.floatcasts = lslcommon.Worth(lslcommon.Objective(options), 3, -1)
 
         self.warntabs = 'warntabs' in options
 
@@ -21,7 +21,7 @@
 # TODO: Add info to be able to propagate error position to the source.
 
 from lslopt.lslcommon import Key, Vector, Quaternion, types, nr
-from lslopt import lslcommon, lslfuncs
+from lslopt import lslcommon, lslfuncs, lsltimings
 from strutil import *
 strutil_used
 import re
@@ -73,6 +73,7 @@ def GetErrLineCol(parser):
 
 class EParse(Exception):
     def __init__(self, parser, msg):
+        self.rawmsg = msg
         self.errorpos = parser.errorpos
         self.lno, self.cno, self.fname = GetErrLineCol(parser)
         filename = self.fname
@@ -243,7 +244,8 @@ class parser(object):
         unicode:'STRING_VALUE', Key:'KEY_VALUE', Vector:'VECTOR_VALUE',
         Quaternion:'ROTATION_VALUE', list:'LIST_VALUE'}
 
-    TypeToExtractionFunction = {}
+    # Context of the script being parsed (set by parse())
+    ctx = lslcommon.GlobalContext
 
     # Utility function
     def GenerateLabel(self):
@@ -424,10 +426,6 @@ class parser(object):
     def ProcessDirective(self, directive):
         """Process a given preprocessor directive during parsing."""
 
-        # Ignore directives on the first pass
-        if self.scanglobals:
-            return
-
         if directive[len(directive)-1:] == '\\':
             raise EParseInvalidBackslash(self)
 
@@ -484,8 +482,161 @@ class parser(object):
                     warning("Warning: #warning")
             # else ignore
 
+    # Regular expression for the tokens that GetToken recognizes directly,
+    # preceded by any whitespace. Order matters: e.g. L"..." must be tried
+    # before identifiers.
+    token_re = re.compile(
+        r'[ \t\r\n\x0B\x0C]*(?:'
+        r'(?P<lstr>L"[^"\\]*(?:\\[^\n][^"\\]*)*")'
+        r'|(?P<ident>[A-Za-z_][A-Za-z0-9_]*)'
+        r'|(?P<hex>0[Xx][0-9A-Fa-f]+)'
+        r'|(?P<num>(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[Ee][-+]?[0-9]+)?)'
+        r'|(?P<str>"[^"\\]*(?:\\[^\n][^"\\]*)*")'
+        r'|(?P<lcomment>//[^\n]*\n)'
+        r'|(?P<bcomment>/\*[^*]*\*+(?:[^/*][^*]*\*+)*/)'
+        r'|(?P<dir>#[^\n]*\n)'
+        r'|(?P<sym>[-+*/%@:<>=!&|^~.;{},()\[\]])'
+        r')')
+
+    escape_re = re.compile(r'\\(.)', re.S)
+
+    @staticmethod
+    def Unescape(match):
+        c = match.group(1)
+        return '\n' if c == 'n' else '    ' if c == 't' else c
+
     def GetToken(self):
-        """Lexer"""
+        """Lexer. The common tokens are recognized with a regular expression;
+        anything else (including errors, EOF and some corner cases) is left
+        to GetTokenChars, which processes the script character by character
+        and is the reference for the behaviour of this function.
+        """
+        script = self.script
+        match = self.token_re.match
+        while True:
+            pos = self.pos
+            m = match(script, pos)
+            if m is None:
+                return self.GetTokenChars()
+            kind = m.lastgroup
+            start = m.start(kind)
+            end = m.end()
+
+            if start != pos:
+                # Skip the whitespace. Only '\n' and '\t' affect linestart;
+                # the last one wins.
+                nl = script.rfind('\n', pos, start)
+                tab = script.rfind('\t', pos, start)
+                if nl > tab:
+                    self.linestart = True
+                elif tab > nl:
+                    self.linestart = False
+                self.pos = start
+
+            if kind == 'ident':
+                ident = m.group(kind)
+                if ident == 'L' and script[end:end+1] == '"':
+                    # Unterminated L"...
+                    return self.GetTokenChars()
+                self.errorpos = start
+                self.pos = end
+                self.linestart = False
+                if ident in self.keywords:
+                    return (ident.upper(),)
+                if ident in types:
+                    if ident == 'quaternion':
+                        ident = 'rotation'  # Normalize types
+                    return ('TYPE',ident)
+                if ident in self.events:
+                    return ('EVENT_NAME',ident)
+                if ident in self.constants:
+                    value = self.constants[ident]
+                    return (self.PythonType2LSLToken[type(value)], value)
+                return ('IDENT', ident)
+
+            if kind == 'sym':
+                c = script[start]
+                if c == '/' and script[end:end+1] in ('/', '*'):
+                    # Comment at EOF or unterminated
+                    return self.GetTokenChars()
+                self.errorpos = start
+                self.linestart = False
+                tok = script[start:start+2]
+                if tok in self.double_toks or self.extendedassignment \
+                   and tok in self.extdouble_toks:
+                    if self.extendedassignment \
+                       and script[start:start+3] in ('<<=', '>>='):
+                        self.pos = start + 3
+                        return (script[start:start+3],)
+                    self.pos = start + 2
+                    return (tok,)
+                self.pos = end
+                return (c,)
+
+            if kind == 'num':
+                self.errorpos = start
+                self.linestart = False
+                number = m.group(kind)
+                if '.' in number:
+                    # Eat the 'F' if present
+                    if script[end:end+1] in ('f', 'F'):
+                        end += 1
+                    self.pos = end
+                    return ('FLOAT_VALUE', lslfuncs.F32(float(number)))
+                self.pos = end
+                if 'e' in number or 'E' in number:
+                    return ('FLOAT_VALUE', lslfuncs.F32(float(number)))
+                if len(number) > 10 or len(number) == 10 and number > '4294967295':
+                    return ('INTEGER_VALUE', -1)
+                return ('INTEGER_VALUE', lslfuncs.S32(int(number)))
+
+            if kind == 'str' or kind == 'lstr':
+                self.errorpos = start
+                self.pos = end
+                self.linestart = False
+                if kind == 'str':
+                    strliteral = script[start+1:end-1]
+                else:
+                    strliteral = '"' + script[start+2:end-1]
+                if '\\' in strliteral:
+                    strliteral = self.escape_re.sub(self.Unescape, strliteral)
+                return ('STRING_VALUE', lslfuncs.zstr(str2u(strliteral, 'utf8')))
+
+            if kind == 'hex':
+                self.errorpos = start
+                self.pos = end
+                self.linestart = False
+                number = script[start+2:end].lstrip('0') or '0'
+                if len(number) > 8:
+                    return ('INTEGER_VALUE', -1)
+                return ('INTEGER_VALUE', lslfuncs.S32(int(number, 16)))
+
+            if kind == 'lcomment' or kind == 'bcomment':
+                if self.enable_inline and script.startswith('pragma inline',
+                                                            start + 2):
+                    return self.GetTokenChars()
+                self.errorpos = start
+                self.pos = end
+                if kind == 'lcomment':
+                    self.linestart = True
+                if end >= self.length:
+                    return ('EOF',)
+                continue
+
+            # kind == 'dir'
+            self.errorpos = start
+            if not (self.processpre and self.linestart):
+                # Not a directive; ignore the '#'.
+                self.pos = start + 1
+                self.linestart = False
+                continue
+            self.directives.append((start, end - 1, script[start:end-1]))
+            self.pos = end
+            if end >= self.length:
+                return ('EOF',)
+
+    def GetTokenChars(self):
+        """Character by character lexer. See GetToken."""
 
         try:
             while self.pos < self.length:
@@ -515,7 +666,8 @@ class parser(object):
                         self.pos += 1
                         self.ceof()  # A preprocessor command at EOF is not unexpected EOF.
 
-                    self.ProcessDirective(self.script[self.errorpos:self.pos])
+                    self.directives.append((self.errorpos, self.pos,
+                        self.script[self.errorpos:self.pos]))
 
                     self.pos += 1
                     self.ceof()
@@ -741,9 +893,62 @@ class parser(object):
 
         return ('EOF',)
 
+    def LexToken(self):
+        """Lex the next token of the script into the token buffer.
+
+        The lexer doesn't process the directives; it stores them with the
+        token that follows them, together with their positions, so that
+        NextToken can process them when the parser gets to that token.
+        """
+        self.pos, self.errorpos, self.linestart = self.lexstate
+        self.directives = []
+        tok = self.GetToken()
+        if self.directives:
+            self.tokdirectives[len(self.toks)] = self.directives
+        self.toks.append(tok)
+        self.tokerrorpos.append(self.errorpos)
+        self.tokpos.append(self.pos)
+        self.lexstate = (self.pos, self.errorpos, self.linestart)
+
     def NextToken(self):
-        """Calls GetToken and sets the internal token."""
-        self.tok = self.GetToken()
+        """Advance to the next token in the token buffer, lexing it if
+        necessary, and set the internal token.
+
+        The script is lexed only once, even if it's parsed twice. Directives
+        are processed here, unless scanning globals. If one changes how
+        the rest of the script must be lexed (e.g. #pragma OPT +breakcont),
+        the tokens after it are discarded and lexed again.
+        """
+        i = self.tokindex + 1
+        while True:
+            if i == len(self.toks):
+                self.LexToken()
+            if not self.scanglobals and i in self.tokdirectives:
+                for errorpos, pos, directive in self.tokdirectives[i]:
+                    self.errorpos = errorpos
+                    self.pos = pos
+                    lexopts = (frozenset(self.keywords), self.extendedassignment,
+                               self.processpre, self.enable_inline)
+                    self.ProcessDirective(directive)
+                    if lexopts != (frozenset(self.keywords),
+                                   self.extendedassignment, self.processpre,
+                                   self.enable_inline):
+                        # Lex again from the end of this directive.
+                        del self.toks[i:]
+                        del self.tokerrorpos[i:]
+                        del self.tokpos[i:]
+                        for j in [j for j in self.tokdirectives if j >= i]:
+                            del self.tokdirectives[j]
+                        self.lexstate = (pos + 1, errorpos, True)
+                        break
+                else:
+                    break
+                continue
+            break
+        self.tokindex = i
+        self.tok = self.toks[i]
+        self.errorpos = self.tokerrorpos[i]
+        self.pos = self.tokpos[i]
 
     # Recursive-descendent parser. The result is an AST and a symbol table.
 
@@ -782,6 +987,7 @@ class parser(object):
         backtrack if it causes an error.
         """
         ret = []
+        tokindex = self.tokindex
         pos = self.pos
         errorpos = self.errorpos
         tok = self.tok
@@ -800,6 +1006,7 @@ class parser(object):
             self.NextToken()
         except EParse:  # The errors can be varied, e.g. <0,0,0>-v; raises EParseTypeMismatch
             # Backtrack
+            self.tokindex = tokindex
             self.pos = pos
             self.errorpos = errorpos
             self.tok = tok
@@ -1712,6 +1919,66 @@ list lazy_list_set(list L, integer i, list v)
             raise EParseFunctionMismatch(self)
         return ret
 
+    def Parse_if_statement(self, ReturnType, AllowStSw, InsideLoop):
+        """Grammar parsed here:
+
+        if_statement: IF '(' expression ')' statement ELSE statement
+            | IF '(' expression ')' statement
+
+        An if_statement that is a branch of another one is parsed in the
+        same loop, keeping the unfinished ones in a stack, so that long
+        chains of else if and deeply nested ifs don't exceed the recursion
+        limit.
+        """
+        # Each entry is a list with the IF node, the PruneBug list to
+        # restore, the AllowStSw of the statement and whether its first
+        # branch sets the LastIsReturn flag.
+        stack = []
+        while True:
+            ret = nr(nt='IF', t=None, ch=[])
+            self.NextToken()
+            self.expect('(')
+            self.NextToken()
+            ret.ch.append(self.Parse_expression())
+            self.expect(')')
+            self.NextToken()
+            stack.append([ret, self.PruneBug, AllowStSw, False])
+            self.PruneBug = []
+            AllowStSw = None
+            if self.tok[0] == 'IF':
+                continue
+            stmt = self.Parse_statement(ReturnType, AllowStSw = None,
+                                        InsideLoop = InsideLoop)
+
+            # Add the statement to the IF it belongs to, and finish the IFs
+            # that are complete with it.
+            while True:
+                entry = stack[-1]
+                ret = entry[0]
+                ret.ch.append(stmt)
+                if len(ret.ch) == 2 and self.tok[0] == 'ELSE':
+                    AllowStSw = entry[2]
+                    if AllowStSw is False and self.PruneBug:
+                        self.errorpos = self.PruneBug[0][0]
+                        raise self.PruneBug[0][1](self)
+                    entry[3] = getattr(stmt, 'LIR', False)
+                    self.NextToken()
+                    if self.tok[0] == 'IF':
+                        break
+                    stmt = self.Parse_statement(ReturnType,
+                        AllowStSw = AllowStSw, InsideLoop = InsideLoop)
+                    continue
+                if len(ret.ch) == 3:
+                    if entry[2] is None:
+                        entry[1] += self.PruneBug
+                    if entry[3] and getattr(stmt, 'LIR', False):
+                        ret.LIR = True
+                self.PruneBug = entry[1]
+                stack.pop()
+                if not stack:
+                    return ret
+                stmt = ret
+
     def Parse_statement(self, ReturnType, AllowDecl = False, AllowStSw = False,
         InsideSwitch = False, InsideLoop = False):
         """Grammar parsed here:
@@ -1875,30 +2142,7 @@ list lazy_list_set(list L, integer i, list v)
                 ch=[self.autocastcheck(value, ReturnType)])
 
         if tok0 == 'IF':
-            ret = nr(nt='IF', t=None, ch=[])
-            self.NextToken()
-            self.expect('(')
-            self.NextToken()
-            ret.ch.append(self.Parse_expression())
-            self.expect(')')
-            self.NextToken()
-            savePruneBug = self.PruneBug
-            self.PruneBug = []
-            ret.ch.append(self.Parse_statement(ReturnType, AllowStSw = None, InsideLoop = InsideLoop))
-            if self.tok[0] == 'ELSE':
-                if AllowStSw is False and self.PruneBug:
-                    self.errorpos = self.PruneBug[0][0]
-                    raise self.PruneBug[0][1](self)
-                LastIsReturn = getattr(ret.ch[1], 'LIR', False)
-                self.NextToken()
-                ret.ch.append(self.Parse_statement(ReturnType,
-                    AllowStSw = AllowStSw, InsideLoop = InsideLoop))
-                if AllowStSw is None:
-                    savePruneBug += self.PruneBug
-                if LastIsReturn and getattr(ret.ch[2], 'LIR', False):
-                    ret.LIR = True
-            self.PruneBug = savePruneBug
-            return ret
+            return self.Parse_if_statement(ReturnType, AllowStSw, InsideLoop)
 
         if tok0 == 'WHILE':
             self.NextToken()
@@ -2355,7 +2599,7 @@ list lazy_list_set(list L, integer i, list v)
                     or 'ParamNames' in sym):  # only UDFs have ParamNames
                 raise EParseUndefined(self)
             typ = sym['Type']
-            if ForbidList and lslcommon.LSO and typ == 'key':
+            if ForbidList and self.ctx.LSO and typ == 'key':
                 # This attempts to reproduce LSO's behaviour that a key global
                 # var inside a list global definition takes a string value
                 # (SCR-295).
@@ -2526,6 +2770,7 @@ list lazy_list_set(list L, integer i, list v)
                     if self.extendedglobalexpr:
                         self.disallowglobalvars = True  # Disallow forward globals.
                         # Mark backtracking position
+                        tokindex = self.tokindex
                         pos = self.pos
                         errorpos = self.errorpos
                         tok = self.tok
@@ -2535,6 +2780,7 @@ list lazy_list_set(list L, integer i, list v)
                             value.Simple = True  # Success - mark it as simple
                         except EParse:
                             # Backtrack
+                            self.tokindex = tokindex
                             self.pos = pos
                             self.errorpos = errorpos
                             self.tok = tok
@@ -2795,6 +3041,7 @@ list lazy_list_set(list L, integer i, list v)
                 self.NextToken()
 
 
+    @lslcommon.WithContext
     def parse(self, script, options = (), filename = '<stdin>', lib = None):
         """Parse the given string with the given options.
 
@@ -2804,6 +3051,8 @@ list lazy_list_set(list L, integer i, list v)
         '<stdin>' means errors in this file won't include a filename.
         #line directives change the filename.
 
+        ctx is the lslcommon.context to use; the current one by default.
+
         This function also builds the temporary globals table.
         """
 
@@ -2813,7 +3062,7 @@ list lazy_list_set(list L, integer i, list v)
         self.constants = lib[1]
         self.funclibrary = lib[2]
 
-        self.TypeToExtractionFunction.clear()
+        self.TypeToExtractionFunction = {}
         for name in self.funclibrary:
             fn = self.funclibrary[name]
             if 'ListTo' in fn:
@@ -2995,39 +3244,55 @@ list lazy_list_set(list L, integer i, list v)
         # detail. But given LSL's structure, it's relatively easy to do a fast
         # incomplete parsing pass, gathering globals with their types and
         # function arguments. And that's what we do.
-
-        self.scanglobals = True  # Tell the lexer not to process directives
+        #
+        # The script is lexed only once, into a token buffer that both passes
+        # share; see NextToken.
+
+        self.toks = []
+        self.tokerrorpos = []
+        self.tokpos = []
+        # Directives found by the lexer, by index of the following token.
+        self.tokdirectives = {}
+        self.lexstate = (0, 0, True)  # pos, errorpos, linestart
         self.pos = self.errorpos = 0
-        self.linestart = True
-        self.tok = self.GetToken()
 
-        self.globals = self.BuildTempGlobalsTable() if not lslcommon.IsCalc \
+        self.scanglobals = True  # Don't process directives in the first pass
+        self.tokindex = -1
+        lsltimings.Begin(self.ctx, 'BuildTempGlobalsTable')
+        self.NextToken()
+
+        self.globals = self.BuildTempGlobalsTable() if not self.ctx.IsCalc \
           else self.funclibrary.copy()
+        lsltimings.End(self.ctx)
 
         # Restart
 
         self.scanglobals = False
-        self.pos = self.errorpos = 0
-        self.linestart = True
-        self.tok = self.GetToken()
+        self.tokindex = -1
+        self.NextToken()
 
         # Reserve spots at the beginning for functions we add
         self.tree = [nr(nt='LAMBDA', t=None)]
         self.usedspots = 0
 
         # Start the parsing proper
-        if lslcommon.IsCalc:
+        lsltimings.Begin(self.ctx, 'ParseScript')
+        if self.ctx.IsCalc:
             self.Parse_single_expression()
         else:
             self.Parse_script()
+        lsltimings.End(self.ctx, self.tree)
 
         # No longer needed. The data is already in self.symtab[0].
         del self.globals
         del self.scopestack
+        del self.toks, self.tokerrorpos, self.tokpos, self.tokdirectives
 
         if self.enable_inline:
             from lslopt import lslinliner
+            lsltimings.Begin(self.ctx, 'Inline', self.tree)
             lslinliner.inliner().inline(self.tree, self.symtab)
+            lsltimings.End(self.ctx, self.tree)
 
         treesymtab = self.tree, self.symtab
         del self.tree
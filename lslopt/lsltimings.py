@@ -0,0 +1,143 @@
+#    (C) Copyright 2015-2021 Sei Lisa. All rights reserved.
+#
+#    This file is part of LSL PyOptimizer.
+#
+#    LSL PyOptimizer is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    LSL PyOptimizer is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with LSL PyOptimizer. If not, see <http://www.gnu.org/licenses/>.
+
+# Per-phase instrumentation of the processing of a script.
+#
+# A timings object is stored in the timings attribute of the context, and the
+# parser, optimizer and main program mark the start and end of each phase in
+# it. For each phase it records the wall time, the CPU time, the peak memory
+# allocated during it according to tracemalloc (not available in Python 2),
+# and the number of nodes of the tree before and after it, when known.
+# Phases can be nested; the measurements of a phase include its subphases.
+
+import json, time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if hasattr(time, 'perf_counter'):
+    WallClock = time.perf_counter
+    CPUClock = time.process_time
+else:
+    WallClock = time.time
+    CPUClock = time.clock
+
+def CountNodes(tree):
+    """Return the number of nodes in a tree (a list of nodes)."""
+    n = 0
+    stack = list(tree)
+    while stack:
+        node = stack.pop()
+        n += 1
+        if node.ch:
+            stack.extend(node.ch)
+    return n
+
+class timings(object):
+
+    def __init__(self, memory = True):
+        # Records of the phases in order of start. Each is a dict with the
+        # keys name, depth, wall, cpu, peak (in bytes, or None if memory is
+        # not traced), nodes_before and nodes_after (None if unknown).
+        self.phases = []
+        # Stack of [record, wall, cpu, memory at start, peak] of the phases
+        # in progress.
+        self.active = []
+        # reset_peak is needed to measure each phase separately.
+        self.memory = memory and hasattr(tracemalloc, 'reset_peak')
+        self.tracing = False
+
+    def Begin(self, name, tree = None):
+        """Start a phase. tree is the tree it works on, if any."""
+        rec = {'name': name, 'depth': len(self.active), 'wall': None,
+               'cpu': None, 'peak': None,
+               'nodes_before': None if tree is None else CountNodes(tree),
+               'nodes_after': None}
+        self.phases.append(rec)
+        mem = 0
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            mem, peak = tracemalloc.get_traced_memory()
+            if self.active:
+                self.active[-1][4] = max(self.active[-1][4], peak)
+            tracemalloc.reset_peak()
+        self.active.append([rec, WallClock(), CPUClock(), mem, mem])
+
+    def End(self, tree = None):
+        """End the last phase started. tree is the tree it produced, if
+        any.
+        """
+        wall, cpu = WallClock(), CPUClock()
+        rec, wall0, cpu0, mem, peak = self.active.pop()
+        rec['wall'] = wall - wall0
+        rec['cpu'] = cpu - cpu0
+        if self.memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            rec['peak'] = peak - mem
+            if self.active:
+                self.active[-1][4] = max(self.active[-1][4], peak)
+            elif self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+            tracemalloc.reset_peak()
+        if tree is not None:
+            rec['nodes_after'] = CountNodes(tree)
+
+    def Finish(self):
+        """End the phases left in progress, e.g. by an error."""
+        while self.active:
+            self.End()
+
+    def Report(self):
+        """Return a text with the measurements."""
+        ret = [u"Timings:\n%-32s %10s %10s %10s  %s\n"
+               % (u"  Phase", u"Wall ms", u"CPU ms", u"Peak KiB", u"Nodes")]
+        for rec in self.phases:
+            nodes = u''
+            if rec['nodes_before'] is not None:
+                nodes = u'%d' % rec['nodes_before']
+            if rec['nodes_after'] is not None:
+                nodes += u' -> %d' % rec['nodes_after']
+            ret.append((u"%-32s %10s %10s %10s  %s"
+                % (u'  ' * (rec['depth'] + 1) + rec['name'],
+                   u'-' if rec['wall'] is None
+                        else u'%.3f' % (rec['wall'] * 1000.),
+                   u'-' if rec['cpu'] is None
+                        else u'%.3f' % (rec['cpu'] * 1000.),
+                   u'-' if rec['peak'] is None
+                        else u'%.1f' % (rec['peak'] / 1024.),
+                   nodes)).rstrip() + u"\n")
+        return u''.join(ret)
+
+    def JSON(self):
+        """Return the measurements as a JSON text. Times are in seconds and
+        memory in bytes.
+        """
+        return json.dumps({'phases': self.phases}, sort_keys = True)
+
+def Begin(ctx, name, tree = None):
+    """Start a phase in the timings of ctx, if it has them."""
+    if ctx.timings is not None:
+        ctx.timings.Begin(name, tree)
+
+def End(ctx, tree = None):
+    """End the last phase started in the timings of ctx, if it has them."""
+    if ctx.timings is not None:
+        ctx.timings.End(tree)
@@ -31,6 +31,9 @@ from lslopt.lsloptimizer import optimizer
 import sys, os, getopt, re
 import lslopt.lslcommon
 import lslopt.lslloadlib
+import lslopt.lslcache
+import lslopt.lsltimings
+from lslopt.lslapi import defaultoptions, ApplyOptions
 from strutil import *
 
 
@@ -218,9 +221,11 @@ Usage: {progname}
                                 optimizer options (use '-O help' for help)
     [-h|--help]                 print this help
     [--version]                 print this program's version
-    [-o|--output=<filename>]    output to file rather than stdout
+    [-o|--output=<filename>]    output to file rather than stdout (a template
+                                when optimizing more than one file, see below)
     [-b|--builtins=<filename>]  use a builtins file other than builtins.txt
     [-L|--libdata=<filename>]   use a function data file other than fndata.txt
+    [--no-lib-cache]            don't use or update the cached library tables
     [-H|--header]               add the script as a comment in Firestorm format
     [-T|--timestamp]            add a timestamp as a comment at the beginning
     [-y|--python-exceptions]    when an exception is raised, show a stack trace
@@ -241,13 +246,54 @@ Usage: {progname}
     [--bom]                     Prefix script with a UTF-8 byte-order mark
     [--emap]                    Output error messages in a format suitable for
                                 automated processing
-    filename                    input file
+    [--batch=<listfile>]        optimize the files listed in listfile, one per
+                                line, in addition to those in the command line
+    [-j|--jobs=<N>]             optimize up to N files in parallel (batch mode)
+    [--server]                  run as a server reading requests from stdin
+                                (see below)
+    [--result-cache=<dir>]      reuse the results of previous optimizations of
+                                the same scripts, stored in the given directory
+    [--result-cache-size=<MB>]  maximum size of the result cache (64 MB by
+                                default); the least recently used results are
+                                removed when it's exceeded
+    [--result-cache-stats]      print the result cache statistics to stderr
+    [--pass-stats]              print the number of runs and the time spent in
+                                each optimizer pass to stderr
+    [--timings]                 print the wall time, CPU time, peak memory and
+                                node counts of each processing phase to stderr
+    [--timings-json]            like --timings, but as a line of JSON (memory
+                                tracing slows down the processing)
+    filename [filename...]      input file(s)
 
 Options marked with * are used to define the preprocessor macros __AGENTID__,
 __AGENTKEY__, __AGENTIDRAW__, __AGENTNAME__, __ASSETID__ and __SHORTFILE__,
 and have no effect if --prenodef is specified.
 
 If filename is a dash (-) then standard input is used.
+
+When more than one input file is given, or with --batch, the library is loaded
+only once and each file is optimized in turn. A failure in one file does not
+stop the processing of the rest, and a status line per file is printed to
+stderr. The output file name must then be a template with any of these fields:
+{{name}} (input file name without the directory), {{base}} (same, without the
+extension), {{ext}} (the extension), {{dir}} (the directory) and {{path}}
+(the input file name as given), e.g. -o 'optimized/{{base}}.o{{ext}}'.
+In this mode, directories given as input are searched recursively for .lsl
+files. With -j, the files are distributed among N worker processes, each of
+which loads the library once; the results are still reported in input order.
+No two input files may have the same output file name. If the 'rsrclimit'
+option is active, the limits are applied to each file separately, by
+processing it in a child process.
+
+With --server, the library is loaded once and scripts are read from stdin as
+requests, one JSON object per line, with these fields: "script" (the source
+code), and optionally "options" (changes to the options, in the format of -O),
+"name" (the file name to report), "preproc" (the preprocessor mode) and "id"
+(any value, returned in the response). For each request, a JSON object is
+written to stdout in a single line, with the fields "id", "status" (the exit
+status), "output" (the result, or null on failure), "warnings" (a list) and
+"errors". If the 'rsrclimit' option is active, the limits are applied to each
+request separately, by processing it in a child process.
 Use: {progname} -O help for help on the optimizer control options.
 
 Comments are always removed in the output, even when using --prettify.
@@ -343,6 +389,19 @@ Case insensitive.
   ListLength         + Optimize llGetListLength(arg) to arg!=[]. Needs constant
                        folding active to work.
   ListAdd            + Convert [a,b,c...] to (list)a + b + c... if possible.
+  CSE                - Evaluate repeated expressions without side effects
+                       once into a local variable when that saves memory.
+  CSEAll             - Like CSE, but do it even if it takes more memory. It's
+                       always faster.
+  LICM               - Evaluate the expressions without side effects that call
+                       functions and don't change within a loop once, before
+                       the loop, into a local variable. Takes more memory.
+  Speed              - Prefer faster code over smaller code when they conflict:
+                       e.g. don't use -~-~x for x+2, don't apply ListAdd and
+                       write float constants in local code as such. Enables
+                       CSE, applying it when it's faster, and LICM.
+  Balanced           - Like Speed, but only when the speed gain is worth the
+                       memory cost. Ignored if Speed is active.
 
   Miscellaneous options
 
@@ -375,17 +434,590 @@ break/continue syntax extension (which is inactive by default).
 """.format(progname=str2u(progname)))
         return
 
-validoptions = frozenset({'extendedglobalexpr','breakcont','extendedtypecast',
-    'extendedassignment','allowkeyconcat','allowmultistrings','duplabels',
-    'lazylists','enableswitch','errmissingdefault','funcoverride','optimize',
-    'optsigns','optfloats','constfold','dcr','shrinknames','addstrings',
-    'foldtabs','warntabs','processpre','explicitcast','listlength','listadd',
-    'inline', 'help',
-    # undocumented
-    'lso','expr','rsrclimit',
-    # 'clear' is handled as a special case
-    # 'prettify' is internal, as it's a user flag
-})
+def OutputName(template, fname):
+    """Return the output file name for the given input file name in batch
+    mode. The template can contain the fields {name} (file name without the
+    directory), {base} (same, without the extension), {ext} (the extension,
+    including the dot), {dir} (the directory, without the trailing slash),
+    and {path} (the input file name as given).
+    """
+    if fname == '-':
+        fname = 'stdin'
+    name = os.path.basename(fname)
+    base, ext = os.path.splitext(name)
+    return template.format(name=name, base=base, ext=ext,
+                           dir=os.path.dirname(fname) or '.', path=fname)
+
+class pipeline(object):
+    """Holds the library and the parser, optimizer and output objects, which
+    are created on first use and reused for every script processed, and the
+    result cache if one is used.
+    """
+    def __init__(self, builtins=None, libdata=None, libcache=True,
+                 resultcache=None, resultcachesize=64 * 1024 * 1024):
+        self.builtins = builtins
+        self.libdata = libdata
+        self.libcache = libcache
+        self.lib = None
+        self.libkey = None
+        self.resultcache = None
+        if resultcache is not None:
+            self.resultcache = lslopt.lslcache.resultcache(resultcache,
+                                                           resultcachesize)
+
+    def ResultKey(self, script, options, fname, ctx):
+        """Return the result cache key for the given preprocessed script."""
+        if self.libkey is None:
+            self.libkey = lslopt.lslloadlib.LibCacheKey(
+                self.builtins or lslopt.lslcommon.DataPath + 'builtins.txt',
+                self.libdata or lslopt.lslcommon.DataPath + 'fndata.txt')
+        return self.resultcache.key(VERSION, self.libkey, ctx.LSO, ctx.IsCalc,
+            sorted(ctx.Bugs), sorted(options), fname, script)
+
+    def load(self):
+        if self.lib is None:
+            self.lib = lslopt.lslloadlib.LoadLibrary(self.builtins,
+                                                     self.libdata,
+                                                     self.libcache)
+            self.parser = parser(self.lib)
+            self.optimizer = optimizer(self.lib)
+            self.outscript = outscript()
+
+def ProcessScript(fname, outfile, options, tools, preproc='none',
+                  preproc_command='cpp', preproc_user_preargs=(),
+                  preproc_user_postargs=(), predefines=True,
+                  avid='00000000-0000-0000-0000-000000000000', avname='',
+                  assetid='00000000-0000-0000-0000-000000000000',
+                  shortname='', script_header='', script_timestamp='',
+                  preshow=False, bom=False, emap=False, ctx=None,
+                  pass_stats=False, timings=None):
+    """Read, preprocess, optimize and write a single script. Returns the exit
+    status. Errors in the script are reported to stderr.
+    """
+    script = ''
+    if fname == '-':
+        script = sys.stdin.read()
+    else:
+        try:
+            f = open(fname, 'r')
+        except IOError as e:
+            if e.errno == 2:
+                werr(u"Error: File not found: %s\n" % str2u(fname))
+                return 2
+            raise
+        try:
+            script = f.read()
+        finally:
+            f.close()
+            del f
+
+    status, script = OptimizeScript(script, fname, options, tools,
+        preproc=preproc, preproc_command=preproc_command,
+        preproc_user_preargs=preproc_user_preargs,
+        preproc_user_postargs=preproc_user_postargs, predefines=predefines,
+        avid=avid, avname=avname, assetid=assetid, shortname=shortname,
+        script_header=script_header, script_timestamp=script_timestamp,
+        preshow=preshow, bom=bom, emap=emap, ctx=ctx, pass_stats=pass_stats,
+        timings=timings)
+    if status:
+        return status
+
+    if outfile == '-':
+        sys.stdout.write(script)
+    else:
+        outf = open(outfile, 'w')
+        try:
+            outf.write(script)
+        finally:
+            outf.close()
+    return 0
+
+def OptimizeScript(script, fname, options, tools, preproc='none',
+                   preproc_command='cpp', preproc_user_preargs=(),
+                   preproc_user_postargs=(), predefines=True,
+                   avid='00000000-0000-0000-0000-000000000000', avname='',
+                   assetid='00000000-0000-0000-0000-000000000000',
+                   shortname='', script_header='', script_timestamp='',
+                   preshow=False, bom=False, emap=False, ctx=None,
+                   pass_stats=False, timings=None):
+    """Preprocess and optimize the given script source. Returns a tuple with
+    the exit status and the resulting script, which is None on failure.
+    Errors in the script are reported to stderr. ctx is the lslcommon.context
+    to process it with; the current one by default. If pass_stats is set,
+    the statistics of the optimizer passes are also reported to stderr. If
+    timings is 'text' or 'json', the measurements of each phase are reported
+    to stderr in that format.
+    """
+    if ctx is None:
+        ctx = lslopt.lslcommon.CurrentContext()
+    if timings is not None:
+        measures = lslopt.lsltimings.timings()
+        ctx = lslopt.lslcommon.context(ctx.LSO, ctx.IsCalc, ctx.Bugs,
+                                       ctx.warnings, measures)
+        try:
+            return OptimizeScript(script, fname, options, tools,
+                preproc=preproc, preproc_command=preproc_command,
+                preproc_user_preargs=preproc_user_preargs,
+                preproc_user_postargs=preproc_user_postargs,
+                predefines=predefines, avid=avid, avname=avname,
+                assetid=assetid, shortname=shortname,
+                script_header=script_header,
+                script_timestamp=script_timestamp, preshow=preshow, bom=bom,
+                emap=emap, ctx=ctx, pass_stats=pass_stats)
+        finally:
+            measures.Finish()
+            werr(measures.Report() if timings == 'text'
+                 else measures.JSON() + u"\n")
+    # The preprocessor may enable some options for this script only.
+    options = set(options)
+
+    # Transform to str and check Unicode validity
+    if type(script) is unicode:
+        script = u2str(script, 'utf8')
+    else:
+        try:
+            # Try converting the script to Unicode, to report any encoding
+            # errors with accurate line information.
+            tmp = UniConvScript(script, options,
+                                fname if fname != '-' else '<stdin>',
+                                emap).to_unicode()
+            # For Python 2, just report any errors and ignore the result.
+            # For Python 3, use the Unicode.
+            if python3:
+                script = tmp
+            del tmp
+        except EParse as e:
+            # We don't call ReportError to prevent problems due to
+            # displaying invalid UTF-8
+            werr(e.args[0] + u"\n")
+            return 1, None
+    # Now script is in native str format.
+
+    if script_header:
+        script_header = ScriptHeader(script, avname)
+
+    if script_timestamp:
+        import time
+        tmp = time.time()
+        script_timestamp = time.strftime(
+            '// Generated on %Y-%m-%dT%H:%M:%S.{0:06d}Z\n'
+            .format(int(tmp % 1 * 1000000)), time.gmtime(tmp))
+        del tmp
+
+    if shortname == '':
+        shortname = os.path.basename(fname)
+
+    # Build preprocessor command line
+    preproc_cmdline = [preproc_command] + list(preproc_user_preargs)
+    if preproc == 'gcpp':
+        preproc_cmdline += [
+            '-undef', '-x', 'c', '-std=c99', '-nostdinc',
+            '-trigraphs', '-dN', '-fno-extended-identifiers',
+            ]
+
+    elif preproc == 'mcpp':
+        preproc_cmdline += [
+            '-e', 'UTF-8', '-I-', '-N', '-2', '-3', '-j',
+            '-V199901L',
+            ]
+
+    if predefines:
+        preproc_cmdline += [
+            '-Dinteger(...)=((integer)(__VA_ARGS__))',
+            '-Dfloat(...)=((float)(__VA_ARGS__))',
+            '-Dstring(...)=((string)(__VA_ARGS__))',
+            '-Dkey(...)=((key)(__VA_ARGS__))',
+            '-Drotation(...)=((rotation)(__VA_ARGS__))',
+            '-Dquaternion(...)=((quaternion)(__VA_ARGS__))',
+            '-Dvector(...)=((vector)(__VA_ARGS__))',
+            '-Dlist(...)=((list)(__VA_ARGS__))',
+            ]
+        preproc_cmdline.append('-D__AGENTKEY__="%s"' % avid)
+        preproc_cmdline.append('-D__AGENTID__="%s"' % avid)
+        preproc_cmdline.append('-D__AGENTIDRAW__=' + avid)
+        preproc_cmdline.append('-D__AGENTNAME__="%s"' % avname)
+        preproc_cmdline.append('-D__ASSETID__=' + assetid)
+        preproc_cmdline.append('-D__SHORTFILE__="%s"' % shortname)
+        preproc_cmdline.append('-D__OPTIMIZER__=LSL PyOptimizer')
+        preproc_cmdline.append('-D__OPTIMIZER_VERSION__=' + VERSION)
+
+    # Append user arguments at the end to allow them to override defaults
+    preproc_cmdline += preproc_user_postargs
+
+    if preproc != 'none':
+        # PreparePreproc uses and returns Unicode string encoding.
+        script = u2b(PreparePreproc(any2u(script, 'utf8')), 'utf8')
+        # At this point, for the external preprocessor to work we need the
+        # script as a byte array, not as unicode, but it should be UTF-8.
+        if preproc == 'mcpp':
+            # As a special treatment for mcpp, we force it to output its
+            # macros so we can read if USE_xxx are defined. With GCC that
+            # is achieved with -dN, but mcpp has no command line option.
+            script += b'\n#pragma MCPP put_defines\n'
+
+        # Invoke the external preprocessor
+        import subprocess
+
+        lslopt.lsltimings.Begin(ctx, 'Preprocess')
+        p = subprocess.Popen(preproc_cmdline, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        script = p.communicate(input=script)[0]
+        status = p.wait()
+        lslopt.lsltimings.End(ctx)
+        if status:
+            return status, None
+        del p, status
+
+        script = any2str(script, 'utf8')
+
+        # This method is very imperfect, in several senses. However, since
+        # it's applied to the output of the preprocessor, all of the
+        # concerns should be addressed:
+        #    - \s includes \n, but \n should not be allowed.
+        #    - Comments preceding the directive should not cause problems.
+        #              e.g.: /* test */ #directive
+        #    - #directive within a comment or string should be ignored.
+        for x in re.findall(r'(?:(?<=\n)|^)\s*#\s*define\s+('
+                            r'USE_SWITCHES'
+                            r'|USE_LAZY_LISTS'
+                            r')(?:$|[^A-Za-z0-9_])', script, re.S):
+            if x == 'USE_SWITCHES':
+                options.add('enableswitch')
+            elif x == 'USE_LAZY_LISTS':
+                options.add('lazylists')
+
+    if not preshow:
+
+        if emap:
+            options.add('emap')
+
+        assert type(script) == str
+        output = key = None
+        if tools.resultcache is not None:
+            key = tools.ResultKey(script, options, fname, ctx)
+            cached = tools.resultcache.get(key)
+            if cached is not None:
+                # Replay the warnings emitted when it was optimized.
+                output, messages = cached
+                werr(messages)
+
+        if output is None:
+            if key is not None:
+                # Collect the warnings to store them with the result.
+                stderr = sys.stderr
+                sys.stderr = capture = ErrCapture()
+            try:
+                if tools.lib is None:
+                    lslopt.lsltimings.Begin(ctx, 'LoadLibrary')
+                    tools.load()
+                    lslopt.lsltimings.End(ctx)
+                lslopt.lsltimings.Begin(ctx, 'Parse')
+                try:
+                    ts = tools.parser.parse(script, options,
+                                            'stdin' if fname == '-' else fname,
+                                            ctx=ctx)
+                except EParse as e:
+                    ReportError(script, e)
+                    return 1, None
+                lslopt.lsltimings.End(ctx, ts[0])
+
+                lslopt.lsltimings.Begin(ctx, 'Optimize', ts[0])
+                ts = tools.optimizer.optimize(ts, options, ctx=ctx)
+                lslopt.lsltimings.End(ctx, ts[0])
+                lslopt.lsltimings.Begin(ctx, 'Output', ts[0])
+                output = tools.outscript.output(ts, options, ctx=ctx)
+                lslopt.lsltimings.End(ctx)
+                del ts
+            finally:
+                if key is not None:
+                    sys.stderr = stderr
+                    werr(capture.getvalue())
+            if key is not None:
+                tools.resultcache.put(key, (output, capture.getvalue()))
+            if pass_stats:
+                werr(tools.optimizer.PassStats())
+
+        script = script_header + script_timestamp + output
+        del output
+
+    del script_header, script_timestamp
+
+    if bom:
+        if not script.startswith(b'\xEF\xBB\xBF'):
+            script = b'\xEF\xBB\xBF' + script
+
+    return 0, script
+
+def ExpandInputs(args):
+    """Replace the directories in the list of input files with the .lsl
+    files found in them, recursively and in sorted order.
+    """
+    ret = []
+    for fname in args:
+        if fname == '-' or not os.path.isdir(fname):
+            ret.append(fname)
+            continue
+        for dirpath, dirnames, filenames in os.walk(fname):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith('.lsl'):
+                    ret.append(os.path.join(dirpath, name))
+    return ret
+
+class ErrCapture(object):
+    """Stand-in for sys.stderr that collects everything written to it, so
+    that the messages of a worker can be shown together with its result.
+    """
+    encoding = 'utf8'
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, s):
+        self.data.append(any2u(s, 'utf8'))
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return u''.join(self.data)
+
+# Per-process state of the batch workers.
+worker_tools = None
+
+def BatchWorkerInit(builtins, libdata, libcache, resultcache,
+                    resultcachesize, DataPath):
+    """Initialize a worker process: replicate the data path of the parent,
+    which is not inherited when the process is spawned rather than forked,
+    and load the library.
+    """
+    global worker_tools
+    lslopt.lslcommon.DataPath = DataPath
+    worker_tools = pipeline(builtins, libdata, libcache, resultcache,
+                            resultcachesize)
+    worker_tools.load()
+
+def RunCaptured(failure, show_traceback, fn, *args, **kwargs):
+    """Call fn with the given arguments, collecting everything it writes to
+    stderr. If it raises an exception, the exception is reported in the
+    collected text and the result is the value of failure. Returns a tuple
+    with the result and the text.
+    """
+    stderr = sys.stderr
+    sys.stderr = capture = ErrCapture()
+    try:
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if show_traceback:
+                import traceback
+                werr(str2u(traceback.format_exc(), 'utf8'))
+            else:
+                werr(e.__class__.__name__ + u': ' + str(e) + u'\n')
+            result = failure
+    finally:
+        sys.stderr = stderr
+    return result, capture.getvalue()
+
+def BatchJob(job, tools):
+    """Optimize one file of the batch mode with the given pipeline. Returns
+    the exit status, the text written to stderr in the process and the
+    result cache counters of the job. If the 'rsrclimit' option is active,
+    the limits are applied to this job alone.
+    """
+    fname, outname, options, settings, raise_exception = job
+
+    def run():
+        rc = tools.resultcache
+        if rc is not None:
+            before = (rc.hits, rc.misses, rc.stores, rc.evictions)
+        status, errtext = RunCaptured(1, raise_exception, ProcessScript,
+                                      fname, outname, options, tools,
+                                      **settings)
+        counters = None
+        if rc is not None:
+            counters = (rc.hits - before[0], rc.misses - before[1],
+                        rc.stores - before[2], rc.evictions - before[3])
+        return status, errtext, counters
+
+    if 'rsrclimit' not in options:
+        return run()
+    # Load the library beforehand, so that it isn't loaded again for every
+    # child process.
+    tools.load()
+    result = RunLimited(run)
+    if result is None:
+        result = (1, u"Error: Resource limits exceeded.\n", None)
+    return result
+
+def BatchWorker(job):
+    """Optimize one file in a worker process. Returns the same as BatchJob.
+    """
+    return BatchJob(job, worker_tools)
+
+def SetResourceLimits():
+    """Set the resource limits of the 'rsrclimit' option."""
+    import resource
+    resource.setrlimit(resource.RLIMIT_CPU, (5, 8))
+    resource.setrlimit(resource.RLIMIT_STACK, (0x60000, 0x80000))
+    resource.setrlimit(resource.RLIMIT_DATA, (9001000, 12001000))
+    resource.setrlimit(resource.RLIMIT_AS, (61001000, 81001000))
+
+def RunLimited(fn):
+    """Call fn in a forked child process with the resource limits applied,
+    so that they only affect this call, and return its result, which must
+    be picklable. Returns None if the child dies without producing one.
+    Where fork is not available, fn is just called without limits.
+    """
+    if not hasattr(os, 'fork'):
+        return fn()
+    import pickle
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child process
+        status = 1
+        try:
+            os.close(r)
+            SetResourceLimits()
+            data = pickle.dumps(fn(), 2)
+            while data:
+                data = data[os.write(w, data):]
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(w)
+    data = []
+    try:
+        while True:
+            chunk = os.read(r, 65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        os.close(r)
+        os.waitpid(pid, 0)
+    try:
+        return pickle.loads(b''.join(data))
+    except Exception:
+        return None
+
+def ErrorResponse(reqid, errors):
+    """Return a failed response of the server mode with the given text."""
+    return {'id': reqid, 'status': 1, 'output': None, 'warnings': [],
+            'errors': errors}
+
+def CheckRequest(req):
+    """Return the error text of an invalid request of the server mode, or
+    None if it's valid. The id can't be an object or an array, and the
+    other fields must be strings.
+    """
+    if type(req) is not dict or 'script' not in req:
+        return (u"Error: Invalid request. It must be a JSON object with a"
+                u" 'script' field.\n")
+    if type(req.get('id')) in (dict, list):
+        return (u"Error: Invalid request. The field 'id' can't be an object"
+                u" or an array.\n")
+    for field in ('script', 'name', 'options', 'preproc'):
+        if field in req and type(req[field]) is not unicode:
+            return (u"Error: Invalid request. The field '%s' must be a"
+                    u" string.\n" % str2u(field))
+    return None
+
+def ServeRequest(req, options, tools, settings, raise_exception):
+    """Process one request of the server mode and return the response. The
+    request must have been validated with CheckRequest.
+    """
+    response = ErrorResponse(req.get('id'), u'')
+
+    try:
+        options = ApplyOptions(options, any2str(req.get('options', u''),
+                                                'utf8'))
+    except ValueError as e:
+        response['errors'] = (u"Error: Unrecognized optimizer option: %s\n"
+                              % str2u(e.args[0], 'utf8'))
+        return response
+
+    settings = dict(settings)
+    if 'preproc' in req:
+        if req['preproc'] not in ('none', 'ext', 'mcpp', 'gcpp'):
+            response['errors'] = (u"Error: Unrecognized preprocessor mode:"
+                                  u" %s\n" % any2u(req['preproc'], 'utf8'))
+            return response
+        settings['preproc'] = any2str(req['preproc'], 'utf8')
+        if settings['preproc'] == 'gcpp':
+            settings['preproc_command'] = 'cpp'
+        elif settings['preproc'] == 'mcpp':
+            settings['preproc_command'] = 'mcpp'
+    script = any2str(req['script'], 'utf8')
+    fname = any2str(req.get('name', u'-'), 'utf8')
+
+    ctx = settings['ctx']
+    settings['ctx'] = lslopt.lslcommon.context(ctx.LSO or 'lso' in options,
+                                               ctx.IsCalc or 'expr' in options,
+                                               ctx.Bugs)
+    options.discard('lso')
+    options.discard('expr')
+
+    job = lambda: RunCaptured((1, None), raise_exception, OptimizeScript,
+                              script, fname, options, tools, **settings)
+    if 'rsrclimit' in options:
+        result = RunLimited(job)
+        if result is None:
+            result = ((1, None), u"Error: Resource limits exceeded.\n")
+    else:
+        result = job()
+
+    (status, output), errtext = result
+    response['status'] = status
+    if output is not None:
+        response['output'] = any2u(output, 'utf8')
+    errors = []
+    for line in errtext.splitlines(True):
+        if line.startswith(u'WARNING: '):
+            response['warnings'].append(line[9:].rstrip(u'\n'))
+        else:
+            errors.append(line)
+    response['errors'] = u''.join(errors)
+    return response
+
+def Server(options, tools, settings, raise_exception):
+    """Run the server mode: read requests from stdin, one JSON object per
+    line, and write the responses to stdout in the same format.
+    """
+    import json
+    tools.load()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        try:
+            req = json.loads(line)
+        except ValueError:
+            req = None
+        errors = CheckRequest(req)
+        if errors is not None:
+            reqid = req.get('id') if type(req) is dict else None
+            response = ErrorResponse(None if type(reqid) in (dict, list)
+                                     else reqid, errors)
+        else:
+            # A failure in a request must not stop serving the next ones.
+            try:
+                response = ServeRequest(req, options, tools, settings,
+                                        raise_exception)
+            except Exception as e:
+                if raise_exception:
+                    import traceback
+                    errors = str2u(traceback.format_exc(), 'utf8')
+                else:
+                    errors = (e.__class__.__name__ + u': '
+                              + str2u(str(e), 'utf8') + u'\n')
+                response = ErrorResponse(req.get('id'), errors)
+        sys.stdout.write(json.dumps(response, sort_keys=True) + '\n')
+        sys.stdout.flush()
+    return 0
 
 def main(argv):
     """Main executable."""
@@ -395,23 +1027,17 @@ def main(argv):
     lslopt.lslcommon.DataPath = __file__[:-len(os.path.basename(__file__))]
 
     # Default options
-    options = set(('extendedglobalexpr','extendedtypecast','extendedassignment',
-        'allowkeyconcat','allowmultistrings','processpre','warntabs','optimize',
-        'optsigns','optfloats','constfold','dcr','errmissingdefault',
-        'listlength','listadd',
-        ))
-
-    assert not (options - validoptions), (u"Default options not present in"
-        u" validoptions: '%s'"
-        % (b"', '".join(options - validoptions)).decode('utf8'))
+    options = set(defaultoptions)
 
     try:
-        opts, args = getopt.gnu_getopt(argv[1:], 'hO:o:p:P:HTyb:L:A:',
+        opts, args = getopt.gnu_getopt(argv[1:], 'hO:o:p:P:HTyb:L:A:j:',
             ('optimizer-options=', 'help', 'version', 'output=', 'header',
             'timestamp', 'python-exceptions', 'prettify', 'bom', 'emap',
             'preproc=', 'precmd=', 'prearg=', 'prenodef', 'preshow',
             'avid=', 'avname=', 'assetid=', 'shortname=', 'builtins='
-            'libdata=', 'postarg='))
+            'libdata=', 'postarg=', 'no-lib-cache', 'batch=', 'jobs=', 'server',
+            'result-cache=', 'result-cache-size=', 'result-cache-stats',
+            'pass-stats', 'timings', 'timings-json'))
     except getopt.GetoptError as e:
         Usage(argv[0])
         werr(u"\nError: %s\n" % str2u(str(e), 'utf8'))
@@ -436,32 +1062,25 @@ def main(argv):
     emap = False
     builtins = None
     libdata = None
+    libcache = True
+    batchfile = None
+    jobs = None
+    server = False
+    resultcache = None
+    resultcachesize = 64 * 1024 * 1024
+    resultcachestats = False
+    passstats = False
+    timings = None
 
     for opt, arg in opts:
         if opt in ('-O', '--optimizer-options'):
-            optchanges = arg.lower().split(',')
-            for chg in optchanges:
-                if not chg:
-                    continue
-                if chg in ('clear', '+clear'):
-                    options = set()
-                    continue
-                if chg == '-clear':
-                    # ignore
-                    continue
-                chgfix = chg
-                if chgfix[0] not in ('+', '-'):
-                    chgfix = '+' + chgfix
-                if chgfix[1:] not in validoptions:
-                    Usage(argv[0], 'optimizer-options')
-                    werr(u"\nError: Unrecognized"
-                         u" optimizer option: %s\n" % str2u(chg, 'utf8'))
-                    return 1
-                if chgfix[0] == '-':
-                    options.discard(chgfix[1:])
-                else:
-                    options.add(chgfix[1:])
-                del chgfix
+            try:
+                options = ApplyOptions(options, arg)
+            except ValueError as e:
+                Usage(argv[0], 'optimizer-options')
+                werr(u"\nError: Unrecognized"
+                     u" optimizer option: %s\n" % str2u(e.args[0], 'utf8'))
+                return 1
 
         elif opt in ('-h', '--help'):
             Usage(argv[0])
@@ -480,6 +1099,51 @@ def main(argv):
         elif opt in ('-L', '--libdata'):
             libdata = arg
 
+        elif opt == '--no-lib-cache':
+            libcache = False
+
+        elif opt == '--batch':
+            batchfile = arg
+
+        elif opt == '--server':
+            server = True
+
+        elif opt == '--result-cache':
+            resultcache = arg
+
+        elif opt == '--result-cache-size':
+            try:
+                resultcachesize = int(float(arg) * 1024 * 1024)
+                if resultcachesize < 0:
+                    raise ValueError
+            except ValueError:
+                Usage(argv[0])
+                werr(u"\nError: Invalid result cache size: %s\n"
+                     % str2u(arg))
+                return 1
+
+        elif opt == '--result-cache-stats':
+            resultcachestats = True
+
+        elif opt == '--pass-stats':
+            passstats = True
+
+        elif opt == '--timings':
+            timings = 'text'
+
+        elif opt == '--timings-json':
+            timings = 'json'
+
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(arg)
+                if jobs < 1:
+                    raise ValueError
+            except ValueError:
+                Usage(argv[0])
+                werr(u"\nError: Invalid number of jobs: %s\n" % str2u(arg))
+                return 1
+
         elif opt in ('-y', '--python-exceptions'):
             raise_exception = True
 
@@ -547,204 +1211,173 @@ def main(argv):
     rsrclimit = False
     try:
 
-        if 'rsrclimit' in options:
-            rsrclimit = True
-            import resource
-            resource.setrlimit(resource.RLIMIT_CPU, (5, 8))
-            resource.setrlimit(resource.RLIMIT_STACK, (0x60000, 0x80000))
-            resource.setrlimit(resource.RLIMIT_DATA, (9001000, 12001000))
-            resource.setrlimit(resource.RLIMIT_AS, (61001000, 81001000))
-
-        if 'lso' in options:
-            lslopt.lslcommon.LSO = True
-            options.remove('lso')
-
-        if 'expr' in options:
-            lslopt.lslcommon.IsCalc = True
-            options.remove('expr')
+        ctx = lslopt.lslcommon.context(LSO='lso' in options,
+                                       IsCalc='expr' in options,
+                                       Bugs=lslopt.lslcommon.Bugs)
+        options.discard('lso')
+        options.discard('expr')
 
         if 'help' in options:
             Usage(argv[0], 'optimizer-options')
             return 0
 
-        fname = args[0] if args else None
-        if fname is None:
-            Usage(argv[0])
-            werr(u"\nError: Input file not specified. Use -"
-                u" if you want to use stdin.\n")
-            return 1
-
-        del args
-
-        script = ''
-        if fname == '-':
-            script = sys.stdin.read()
-        else:
+        if batchfile is not None:
             try:
-                f = open(fname, 'r')
+                if batchfile == '-':
+                    args += sys.stdin.read().splitlines()
+                else:
+                    f = open(batchfile, 'r')
+                    try:
+                        args += f.read().splitlines()
+                    finally:
+                        f.close()
+                        del f
             except IOError as e:
                 if e.errno == 2:
-                    werr(u"Error: File not found: %s\n" % str2u(fname))
+                    werr(u"Error: File not found: %s\n" % str2u(batchfile))
                     return 2
                 raise
-            try:
-                script = f.read()
-            finally:
-                f.close()
-                del f
-
-        # Transform to str and check Unicode validity
-        if type(script) is unicode:
-            script = u2str(script, 'utf8')
-        else:
-            try:
-                # Try converting the script to Unicode, to report any encoding
-                # errors with accurate line information.
-                tmp = UniConvScript(script, options,
-                                    fname if fname != '-' else '<stdin>',
-                                    emap).to_unicode()
-                # For Python 2, just report any errors and ignore the result.
-                # For Python 3, use the Unicode.
-                if python3:
-                    script = tmp
-                del tmp
-            except EParse as e:
-                # We don't call ReportError to prevent problems due to
-                # displaying invalid UTF-8
-                werr(e.args[0] + u"\n")
+            # Skip blank lines and comments
+            args = [x.strip() for x in args
+                    if x.strip() and not x.lstrip().startswith('#')]
+
+        settings = {'preproc': preproc, 'preproc_command': preproc_command,
+            'preproc_user_preargs': preproc_user_preargs,
+            'preproc_user_postargs': preproc_user_postargs,
+            'predefines': predefines, 'avid': avid, 'avname': avname,
+            'assetid': assetid, 'shortname': shortname,
+            'script_header': script_header,
+            'script_timestamp': script_timestamp, 'preshow': preshow,
+            'bom': bom, 'emap': emap, 'ctx': ctx, 'pass_stats': passstats,
+            'timings': timings}
+
+        tools = pipeline(builtins, libdata, libcache, resultcache,
+                         resultcachesize)
+
+        if server:
+            if args:
+                werr(u"Error: Input files can't be given in server mode.\n")
                 return 1
-        # Now script is in native str format.
+            status = Server(options, tools, settings, raise_exception)
+            if resultcachestats and tools.resultcache is not None:
+                werr(tools.resultcache.stats() + u"\n")
+            return status
 
-        if script_header:
-            script_header = ScriptHeader(script, avname)
+        fname = args[0] if args else None
+        if fname is None:
+            Usage(argv[0])
+            werr(u"\nError: Input file not specified. Use -"
+                u" if you want to use stdin.\n")
+            return 1
 
-        if script_timestamp:
-            import time
-            tmp = time.time()
-            script_timestamp = time.strftime(
-                '// Generated on %Y-%m-%dT%H:%M:%S.{0:06d}Z\n'
-                .format(int(tmp % 1 * 1000000)), time.gmtime(tmp))
-            del tmp
+        if batchfile is None and jobs is None and len(args) == 1:
+            del args
+            # In server and batch modes, the limits are applied to each
+            # script instead.
+            if 'rsrclimit' in options:
+                rsrclimit = True
+                import resource
+                SetResourceLimits()
+            status = ProcessScript(fname, outfile, options, tools, **settings)
+            if resultcachestats and tools.resultcache is not None:
+                werr(tools.resultcache.stats() + u"\n")
+            return status
+
+        # Batch mode
+        if '{' not in outfile:
+            werr(u"Error: When optimizing more than one file, the output"
+                 u" must be a file name template, e.g. -o 'out/{name}'.\n")
+            return 1
 
-        if shortname == '':
-            shortname = os.path.basename(fname)
-
-        # Build preprocessor command line
-        preproc_cmdline = [preproc_command] + preproc_user_preargs
-        if preproc == 'gcpp':
-            preproc_cmdline += [
-                '-undef', '-x', 'c', '-std=c99', '-nostdinc',
-                '-trigraphs', '-dN', '-fno-extended-identifiers',
-                ]
-
-        elif preproc == 'mcpp':
-            preproc_cmdline += [
-                '-e', 'UTF-8', '-I-', '-N', '-2', '-3', '-j',
-                '-V199901L',
-                ]
-
-        if predefines:
-            preproc_cmdline += [
-                '-Dinteger(...)=((integer)(__VA_ARGS__))',
-                '-Dfloat(...)=((float)(__VA_ARGS__))',
-                '-Dstring(...)=((string)(__VA_ARGS__))',
-                '-Dkey(...)=((key)(__VA_ARGS__))',
-                '-Drotation(...)=((rotation)(__VA_ARGS__))',
-                '-Dquaternion(...)=((quaternion)(__VA_ARGS__))',
-                '-Dvector(...)=((vector)(__VA_ARGS__))',
-                '-Dlist(...)=((list)(__VA_ARGS__))',
-                ]
-            preproc_cmdline.append('-D__AGENTKEY__="%s"' % avid)
-            preproc_cmdline.append('-D__AGENTID__="%s"' % avid)
-            preproc_cmdline.append('-D__AGENTIDRAW__=' + avid)
-            preproc_cmdline.append('-D__AGENTNAME__="%s"' % avname)
-            preproc_cmdline.append('-D__ASSETID__=' + assetid)
-            preproc_cmdline.append('-D__SHORTFILE__="%s"' % shortname)
-            preproc_cmdline.append('-D__OPTIMIZER__=LSL PyOptimizer')
-            preproc_cmdline.append('-D__OPTIMIZER_VERSION__=' + VERSION)
-
-        # Append user arguments at the end to allow them to override defaults
-        preproc_cmdline += preproc_user_postargs
-
-        if preproc != 'none':
-            # PreparePreproc uses and returns Unicode string encoding.
-            script = u2b(PreparePreproc(any2u(script, 'utf8')), 'utf8')
-            # At this point, for the external preprocessor to work we need the
-            # script as a byte array, not as unicode, but it should be UTF-8.
-            if preproc == 'mcpp':
-                # As a special treatment for mcpp, we force it to output its
-                # macros so we can read if USE_xxx are defined. With GCC that
-                # is achieved with -dN, but mcpp has no command line option.
-                script += b'\n#pragma MCPP put_defines\n'
-
-            # Invoke the external preprocessor
-            import subprocess
-
-            p = subprocess.Popen(preproc_cmdline, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE)
-            script = p.communicate(input=script)[0]
-            status = p.wait()
-            if status:
-                return status
-            del p, status
-
-            script = any2str(script, 'utf8')
-
-            # This method is very imperfect, in several senses. However, since
-            # it's applied to the output of the preprocessor, all of the
-            # concerns should be addressed:
-            #    - \s includes \n, but \n should not be allowed.
-            #    - Comments preceding the directive should not cause problems.
-            #              e.g.: /* test */ #directive
-            #    - #directive within a comment or string should be ignored.
-            for x in re.findall(r'(?:(?<=\n)|^)\s*#\s*define\s+('
-                                r'USE_SWITCHES'
-                                r'|USE_LAZY_LISTS'
-                                r')(?:$|[^A-Za-z0-9_])', script, re.S):
-                if x == 'USE_SWITCHES':
-                    options.add('enableswitch')
-                elif x == 'USE_LAZY_LISTS':
-                    options.add('lazylists')
-
-        if not preshow:
-
-            if emap:
-                options.add('emap')
-
-            lib = lslopt.lslloadlib.LoadLibrary(builtins, libdata)
-            p = parser(lib)
-            assert type(script) == str
+        args = ExpandInputs(args)
+        outnames = []
+        for fname in args:
             try:
-                ts = p.parse(script, options,
-                             'stdin' if fname == '-' else fname)
-            except EParse as e:
-                ReportError(script, e)
+                outnames.append(OutputName(outfile, fname))
+            except (KeyError, IndexError, ValueError):
+                werr(u"Error: Invalid output file name template: %s\n"
+                     % str2u(outfile))
                 return 1
-            del p, script
-
-            opt = optimizer(lib)
-            ts = opt.optimize(ts, options)
-            del opt
-
-            outs = outscript()
-            script = script_header + script_timestamp + outs.output(ts, options)
-            del outs, ts
-
-        del script_header, script_timestamp
-
-        if bom:
-            if not script.startswith(b'\xEF\xBB\xBF'):
-                script = b'\xEF\xBB\xBF' + script
-
-        if outfile == '-':
-            sys.stdout.write(script)
-        else:
-            outf = open(outfile, 'w')
+        seen = {}
+        for fname, outname in zip(args, outnames):
+            key = os.path.normcase(os.path.abspath(outname))
+            if key in seen:
+                werr(u"Error: The input files %s and %s have the same output"
+                     u" file name: %s\n" % (str2u(seen[key]), str2u(fname),
+                                            str2u(outname)))
+                return 1
+            seen[key] = fname
+        del seen
+
+        def Report(fname, status):
+            werr(u"%s: %s\n" % (str2u(fname),
+                                u"OK" if status == 0
+                                else u"FAILED (exit status %d)" % status))
+
+        def AddCounters(counters):
+            if counters is not None:
+                rc = tools.resultcache
+                rc.hits += counters[0]
+                rc.misses += counters[1]
+                rc.stores += counters[2]
+                rc.evictions += counters[3]
+
+        results = []
+        if jobs is not None and jobs > 1 and len(args) > 1:
+            if '-' in args:
+                werr(u"Error: Standard input can't be used as input"
+                     u" together with -j.\n")
+                return 1
+            import multiprocessing
+            pool = multiprocessing.Pool(min(jobs, len(args)),
+                BatchWorkerInit, (builtins, libdata, libcache,
+                                  resultcache, resultcachesize,
+                                  lslopt.lslcommon.DataPath))
             try:
-                outf.write(script)
+                # imap returns the results in input order, as they become
+                # available.
+                jobresults = pool.imap(BatchWorker,
+                    [(fname, outname, options, settings, raise_exception)
+                     for fname, outname in zip(args, outnames)])
+                for i, (status, errtext, counters) in enumerate(jobresults):
+                    fname, outname = args[i], outnames[i]
+                    AddCounters(counters)
+                    if errtext:
+                        werr(errtext)
+                    Report(fname, status)
+                    results.append((fname, outname, status))
+                pool.close()
             finally:
-                outf.close()
-        return 0
+                pool.terminate()
+                pool.join()
+        else:
+            for fname, outname in zip(args, outnames):
+                if 'rsrclimit' in options:
+                    status, errtext, counters = BatchJob((fname, outname,
+                        options, settings, raise_exception), tools)
+                    AddCounters(counters)
+                    if errtext:
+                        werr(errtext)
+                    Report(fname, status)
+                    results.append((fname, outname, status))
+                    continue
+                try:
+                    status = ProcessScript(fname, outname, options, tools,
+                                           **settings)
+                except Exception as e:
+                    if raise_exception:
+                        raise
+                    werr(e.__class__.__name__ + u': ' + str(e) + u'\n')
+                    status = 1
+                Report(fname, status)
+                results.append((fname, outname, status))
+
+        nfailed = len([x for x in results if x[2]])
+        werr(u"Processed %d files, %d succeeded, %d failed.\n"
+             % (len(results), len(results) - nfailed, nfailed))
+        if resultcachestats and tools.resultcache is not None:
+            werr(tools.resultcache.stats() + u"\n")
+        return 1 if nfailed else 0
 
     except Exception as e:
         if rsrclimit:
@@ -0,0 +1,348 @@
+#!/usr/bin/env python2
+#
+#    (C) Copyright 2015-2021 Sei Lisa. All rights reserved.
+#
+#    This file is part of LSL PyOptimizer.
+#
+#    LSL PyOptimizer is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    LSL PyOptimizer is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with LSL PyOptimizer. If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarking program.
+# Runs the benchmarks whose names are given in the command line, or all of
+# them if none is given. Use -l to list the available benchmarks.
+#
+# Each benchmark prints one line per measurement, with the best time out of
+# several repetitions, to minimize the noise caused by other processes.
+
+import sys
+import os
+import time
+
+from lslopt import lslcommon, lslloadlib, lslparse, lslfoldconst, lsloptimizer
+from lslopt import lslfuncs, lslbasefuncs
+from strutil import *
+
+benchmarks = []
+
+def benchmark(fn):
+    """Decorator that registers a benchmark."""
+    benchmarks.append(fn)
+    return fn
+
+def Measure(fn, number=10, repeat=5):
+    """Return the best time per call of fn, in seconds."""
+    best = None
+    for i in xrange(repeat):
+        t = time.time()
+        for j in xrange(number):
+            fn()
+        t = (time.time() - t) / number
+        if best is None or t < best:
+            best = t
+    return best
+
+def Report(desc, t, base=None):
+    if t < .001:
+        s = u'  %-48s %10.3f us' % (desc, t * 1000000.)
+    else:
+        s = u'  %-48s %10.3f ms' % (desc, t * 1000.)
+    if base is not None:
+        s += u'  (x%.2f)' % (base / t)
+    wout(s + u'\n')
+
+@benchmark
+def loadlib():
+    """Loading of the builtins and function data files"""
+    builtins = lslcommon.DataPath + 'builtins.txt'
+    fndata = lslcommon.DataPath + 'fndata.txt'
+    cachefile = lslloadlib.LibCacheFile(builtins)
+    nocache = Measure(lambda: lslloadlib.LoadLibrary(builtins, fndata,
+                                                     cache=False))
+    Report(u'LoadLibrary, no cache', nocache)
+    lslloadlib.LoadLibrary(builtins, fndata)  # make sure it's up to date
+    if not os.path.exists(cachefile):
+        wout(u'  (cache could not be written; skipping)\n')
+        return
+    Report(u'LoadLibrary, warm cache',
+           Measure(lambda: lslloadlib.LoadLibrary(builtins, fndata)), nocache)
+
+def SampleScript(n=100):
+    """Return a valid script with n functions of typical code."""
+    script = ['// Sample script\ninteger gCount = 0;\nstring gName = "sample";\n'
+              'list gList = [1, 2.5, "three", <1., 2., 3.>, ZERO_ROTATION];\n']
+    for i in xrange(n):
+        script.append(
+            '/* Function number %(i)d */\n'
+            'integer f%(i)d(integer a, float b, string s)\n{\n'
+            '    vector v = <a, b * 0.5, -1.25e3>;\n'
+            '    list l = [a, b, s, "tab\\there\\n", 0x%(i)X];\n'
+            '    while (a > 0 && llStringLength(s) < 100)\n    {\n'
+            '        s += (string)a + "," + llList2String(l, a %% 5);\n'
+            '        a -= (integer)(b / 2.0) + 1; // decrement\n'
+            '        gCount += a << 1 | a >> 2;\n'
+            '    }\n'
+            '    if (v.x != 0.0 || gName == s) return ++gCount;\n'
+            '    return llListFindList(l, [s]) + %(i)d;\n}\n' % {'i': i})
+    script.append('default\n{\n    state_entry()\n    {\n'
+                  '        llOwnerSay((string)f0(1, 2.0, "x"));\n    }\n}\n')
+    return ''.join(script)
+
+@benchmark
+def lexer():
+    """Lexer throughput (GetToken vs. GetTokenChars)"""
+    lib = lslloadlib.LoadLibrary()
+    p = lslparse.parser(lib)
+    script = SampleScript(500)
+    p.parse('default{timer(){}}')
+
+    def Lex(method):
+        p.script = script
+        p.length = len(script)
+        p.pos = p.errorpos = 0
+        p.linestart = True
+        lex = getattr(p, method)
+        n = 0
+        while lex() != ('EOF',):
+            n += 1
+        return n
+
+    ntokens = Lex('GetToken')
+    assert ntokens == Lex('GetTokenChars')
+    wout(u'  %d tokens, %d bytes\n' % (ntokens, len(script)))
+    base = Measure(lambda: Lex('GetTokenChars'), number=1)
+    Report(u'GetTokenChars, %.0f tokens/s' % (ntokens / base), base)
+    t = Measure(lambda: Lex('GetToken'), number=1)
+    Report(u'GetToken, %.0f tokens/s' % (ntokens / t), t, base)
+
+@benchmark
+def ast():
+    """Memory used by the AST, and copying of nodes"""
+    lib = lslloadlib.LoadLibrary()
+    p = lslparse.parser(lib)
+    script = SampleScript(500)
+    try:
+        import tracemalloc
+    except ImportError:
+        wout(u'  (tracemalloc not available; skipping memory measurement)\n')
+    else:
+        tracemalloc.start()
+        tree, symtab = p.parse(script)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        wout(u'  %-48s %10.1f KiB\n' % (u'Parse, peak memory', peak / 1024.))
+        wout(u'  %-48s %10.1f KiB\n' % (u'Tree and symbol table', current / 1024.))
+    tree, symtab = p.parse(script)
+    folder = lslfoldconst.foldconst()
+    Report(u'CopyNode of the whole tree',
+           Measure(lambda: [folder.CopyNode(node) for node in tree]))
+
+@benchmark
+def foldtree():
+    """Constant folding of a large script (FoldScript)"""
+    lib = lslloadlib.LoadLibrary()
+    p = lslparse.parser(lib)
+    opt = lsloptimizer.optimizer(lib)
+    script = SampleScript(300)
+    # Let optimize() set up the options, then fold fresh trees, since
+    # FoldScript changes them in place.
+    opt.optimize(p.parse(script), ('optimize', 'constfold'))
+    trees = []
+
+    def Fold():
+        opt.tree, opt.symtab = trees.pop()
+        opt.FoldScript()
+
+    number, repeat = 1, 5
+    for i in xrange(number * repeat):
+        trees.append(p.parse(script))
+    Report(u'FoldScript', Measure(Fold, number, repeat))
+
+@benchmark
+def structhash():
+    """Folding of long XOR chains (cached structural hashes)"""
+    lib = lslloadlib.LoadLibrary()
+    p = lslparse.parser(lib)
+
+    class Uncached(lsloptimizer.optimizer):
+        """Discards the hashes before every comparison, for comparison."""
+        def CompareTrees(self, node1, node2, proven = None):
+            self.InvalidateHashes()
+            return super(Uncached, self).CompareTrees(node1, node2, proven)
+
+    options = ('optimize', 'constfold')
+    for n in (250, 1000):
+        # Every operator compares its operands, which are of the same kind.
+        script = ('default{timer(){integer b = llGetUnixTime();'
+                  'llOwnerSay((string)(%s));}}'
+                  % ' ^ '.join('(b ^ %d)' % k for k in xrange(n)))
+        base = None
+        for desc, opt in ((u'uncached', Uncached(lib)),
+                          (u'cached', lsloptimizer.optimizer(lib))):
+            # optimize() changes the trees in place; parse one for each run.
+            trees = [p.parse(script) for i in xrange(3)]
+            t = Measure(lambda: opt.optimize(trees.pop(), options), 1, 3)
+            Report(u'Optimize, %d terms, %s' % (n, desc), t, base)
+            base = t
+
+@benchmark
+def listsort():
+    """llListSort of a table of 2000 strides (reference vs. key sort)"""
+    import random
+    rnd = random.Random(1)
+    table = []
+    for i in rnd.sample(xrange(100000), 2000):
+        table += [u'item%05d' % i, i]
+    base = Measure(lambda: lslfuncs.InternalListSortExchange(table[:], 2, 1),
+                   number=1, repeat=3)
+    Report(u'InternalListSortExchange', base)
+    Report(u'llListSort', Measure(lambda: lslfuncs.llListSort(table, 2, 1)),
+           base)
+
+@benchmark
+def listfind():
+    """llListFindList in a list of 10000 elements"""
+    from lslopt.lslcommon import Vector
+    lst = []
+    for i in xrange(2500):
+        lst += [i, float(i), u'item%d' % i, Vector((float(i), 0., 0.))]
+    zeros = [0] * 10000
+    for desc, lst, elems in (
+            (u'last string', lst, [u'item2499']),
+            (u'missing vector', lst, [Vector((0., 1., 0.))]),
+            (u'sublist at the end', lst, lst[-4:]),
+            (u'many partial matches', zeros, [0] * 50 + [1])):
+        Report(u'llListFindList, %s' % desc,
+               Measure(lambda: lslfuncs.llListFindList(lst, elems), number=1))
+
+@benchmark
+def parsestring():
+    """llParseString2List of a short record (with and without cache)"""
+    record = u'name=box;size=<1,2,3>;color=red;alpha=0.5;flags=7'
+    exc = [u';', u'=']
+    inc = [u'<', u'>', u',']
+
+    def Uncached():
+        lslfuncs.ParseCache.clear()
+        lslfuncs.llParseString2List(record, exc, inc)
+
+    base = Measure(Uncached, number=1000)
+    Report(u'llParseString2List, building the pattern', base)
+    Report(u'llParseString2List, cached pattern',
+           Measure(lambda: lslfuncs.llParseString2List(record, exc, inc),
+                   number=1000), base)
+
+@benchmark
+def arith():
+    """Arithmetic helpers (F32, S32 and the operators)"""
+    from ctypes import c_float
+    from lslopt.lslcommon import Vector, Quaternion
+
+    def CFloatF32(f):
+        """F32 implemented with ctypes, for comparison."""
+        if isinstance(f, tuple):
+            return f.__class__(CFloatF32(i) for i in f)
+        return c_float(f).value
+
+    v = Vector((1.1, 2.2, 3.3))
+    q = Quaternion((.1, .2, .3, .9))
+    floats = [i * 1.1 for i in xrange(1000)]
+    for desc, arg in ((u'float', 1.1), (u'vector', v), (u'rotation', q)):
+        base = Measure(lambda: CFloatF32(arg), number=100000)
+        Report(u'F32 with c_float, %s' % desc, base)
+        Report(u'F32, %s' % desc,
+               Measure(lambda: lslfuncs.F32(arg), number=100000), base)
+    base = Measure(lambda: [CFloatF32(f) for f in floats], number=100)
+    Report(u'F32 with c_float, list of 1000 floats', base)
+    Report(u'F32List, list of 1000 floats',
+           Measure(lambda: lslfuncs.F32List(floats), number=100), base)
+    Report(u'S32 in range', Measure(lambda: lslfuncs.S32(123456),
+                                    number=100000))
+    Report(u'S32 out of range', Measure(lambda: lslfuncs.S32(0x123456789),
+                                        number=100000))
+    for desc, fn, a, b in ((u'add, floats', lslfuncs.add, 1.1, 2.2),
+                           (u'add, vectors', lslfuncs.add, v, v),
+                           (u'mul, integers', lslfuncs.mul, 123456, 654321),
+                           (u'mul, floats', lslfuncs.mul, 1.1, 2.2),
+                           (u'mul, vector by float', lslfuncs.mul, v, 2.2),
+                           (u'mul, vector by rotation', lslfuncs.mul, v, q),
+                           (u'mul, rotations', lslfuncs.mul, q, q),
+                           (u'div, floats', lslfuncs.div, 1.1, 2.2),
+                           (u'typecast, string to float', lslfuncs.typecast,
+                            u'1.1', float)):
+        Report(desc, Measure(lambda: fn(a, b), number=10000))
+
+@benchmark
+def floatstr():
+    """Float to string conversions of a vector-heavy script (f2s memo)"""
+    import random
+    rnd = random.Random(1)
+    table = ['<%.4f, %.4f, %.4f>' % (rnd.uniform(-10, 10),
+                                     rnd.uniform(-10, 10),
+                                     rnd.uniform(-10, 10))
+             for i in xrange(50)]
+    script = ['default\n{\n    timer()\n    {\n']
+    for i in xrange(500):
+        script.append('        llOwnerSay((string)%s + (string)[%s, %s]);\n'
+                      % (rnd.choice(table), rnd.choice(table),
+                         rnd.choice(table)))
+    script.append('    }\n}\n')
+    script = ''.join(script)
+
+    lib = lslloadlib.LoadLibrary()
+    p = lslparse.parser(lib)
+    opt = lsloptimizer.optimizer(lib)
+    options = ('optimize', 'constfold')
+    vectors = [lslfuncs.typecast(str2u(rnd.choice(table)), lslcommon.Vector)
+               for i in xrange(1000)]
+    # optimize() changes the trees in place; parse a fresh one for each run.
+    trees = []
+
+    def Optimize():
+        opt.optimize(trees.pop(), options)
+
+    size = lslbasefuncs.F2SMemoSize
+    try:
+        for desc, memosize in ((u'no memo', 0), (u'memo', size)):
+            lslbasefuncs.F2SMemoSize = memosize
+            lslbasefuncs.F2SMemo.clear()
+            Report(u'vr2s of 1000 vectors, %s' % desc,
+                   Measure(lambda: [lslfuncs.vr2s(v) for v in vectors]))
+            trees = [p.parse(script) for i in xrange(5)]
+            Report(u'Optimize, %s' % desc, Measure(Optimize, 1, 5))
+    finally:
+        lslbasefuncs.F2SMemoSize = size
+
+def main(argv):
+    lslcommon.DataPath = os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), '')
+
+    if '-l' in argv[1:]:
+        for fn in benchmarks:
+            wout(u'%-20s %s\n' % (str2u(fn.__name__), str2u(fn.__doc__)))
+        return 0
+
+    names = argv[1:]
+    for name in names:
+        if name not in [fn.__name__ for fn in benchmarks]:
+            werr(u'Unknown benchmark: %s\n' % str2u(name))
+            return 1
+
+    for fn in benchmarks:
+        if names and fn.__name__ not in names:
+            continue
+        wout(u'%s:\n' % str2u(fn.__doc__))
+        fn()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
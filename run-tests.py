@@ -48,10 +48,11 @@
 import unittest
 import sys
 import os
-#import math
+import math
 import main
 import glob
 import re
+import json
 try:
     import difflib
 except ImportError:
@@ -60,8 +61,8 @@ if sys.version_info.major < 3:
     from StringIO import StringIO as StringStream
 else:
     from io import BytesIO as StringStream
-from lslopt import lslcommon,lslfuncs,lslparse,lsloutput,lslloadlib
-from lslopt.lslcommon import nr
+from lslopt import lslcommon,lslfuncs,lslparse,lsloutput,lslloadlib,lslcache
+from lslopt.lslcommon import nr, Key
 from strutil import *
 
 class EArgError(Exception):
@@ -418,6 +419,744 @@ class UnitTestRegression(UnitTestCase):
         self.assertRaises(lslparse.EParseTypeMismatch, parser.parse,
             'default{timer(){if(1)return 1;}}')
 
+    def test_regression_libcache(self):
+        """Check that the cached library tables match the parsed ones, and
+        that the cache is regenerated when the data files change.
+        """
+        sys.stderr.write('\nRunning library cache tests: ')
+        import tempfile, shutil
+        tmpdir = tempfile.mkdtemp()
+        try:
+            builtins = os.path.join(tmpdir, 'builtins.txt')
+            fndata = os.path.join(tmpdir, 'fndata.txt')
+            shutil.copy('builtins.txt', builtins)
+            shutil.copy('fndata.txt', fndata)
+            cachefile = lslloadlib.LibCacheFile(builtins)
+
+            # The compiled conditions are new objects every time.
+            def unlinked(lib):
+                return lib[:2] + (dict((name, dict((k, v)
+                    for k, v in lib[2][name].items()
+                    if k == 'Fn' or k not in lslloadlib.LIBCACHE_LINKED))
+                    for name in lib[2]),)
+
+            parsed = lslloadlib.LoadLibrary(builtins, fndata, cache=False)
+            self.assertFalse(os.path.exists(cachefile))
+            self.assertEqual(unlinked(lslloadlib.LoadLibrary(builtins,
+                                                             fndata)),
+                             unlinked(parsed))
+            self.assertTrue(os.path.exists(cachefile))
+            cached = lslloadlib.ReadLibCache(cachefile,
+                lslloadlib.LibCacheKey(builtins, fndata))
+            self.assertEqual(unlinked(cached), unlinked(parsed))
+            self.assertTrue(cached[2]['llAbs']['Fn'] is lslfuncs.llAbs)
+            self.assertTrue(cached[2]['llBreakLink']['SEFPred']([257], ''))
+
+            # Changing a data file invalidates the cache.
+            f = open(fndata, 'a')
+            try:
+                f.write('\n// changed\n')
+            finally:
+                f.close()
+            self.assertTrue(lslloadlib.ReadLibCache(cachefile,
+                lslloadlib.LibCacheKey(builtins, fndata)) is None)
+            self.assertEqual(unlinked(lslloadlib.LoadLibrary(builtins,
+                                                             fndata)),
+                             unlinked(parsed))
+            self.assertEqual(unlinked(lslloadlib.ReadLibCache(cachefile,
+                lslloadlib.LibCacheKey(builtins, fndata))), unlinked(parsed))
+
+            # A corrupt cache is ignored and rewritten.
+            f = open(cachefile, 'wb')
+            try:
+                f.write(b'garbage')
+            finally:
+                f.close()
+            self.assertEqual(unlinked(lslloadlib.LoadLibrary(builtins,
+                                                             fndata)),
+                             unlinked(parsed))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_regression_resultcache(self):
+        """Check that cached results are reused with their warnings, and
+        that the cache size is bounded.
+        """
+        sys.stderr.write('\nRunning result cache tests: ')
+        import tempfile, shutil
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cachedir = os.path.join(tmpdir, 'cache')
+            script = os.path.join(tmpdir, 'test.lsl')
+            f = open(script, 'w')
+            try:
+                f.write('integer x = (integer)llFrand(3);\n'
+                        'default{timer(){llOwnerSay((string)x);}}\n')
+            finally:
+                f.close()
+            args = ['main.py', '--result-cache=' + cachedir,
+                    '--result-cache-stats', '-O', '+extendedglobalexpr',
+                    script]
+            out1, err1 = invokeMain(args)
+            self.assertTrue(b'0 hits, 1 misses' in err1)
+            out2, err2 = invokeMain(args)
+            self.assertTrue(b'1 hits, 0 misses' in err2)
+            self.assertEqual(out1, out2)
+            self.assertEqual(err1.split(b'Result cache')[0],
+                             err2.split(b'Result cache')[0])
+            self.assertTrue(b'WARNING' in err2)
+
+            # Different options give a different result.
+            out3, err3 = invokeMain(args[:-1] + ['-O', '-dcr', script])
+            self.assertTrue(b'0 hits, 1 misses' in err3)
+
+            cache = lslcache.resultcache(cachedir, 1)
+            self.assertEqual(cache.get(cache.key('nonexistent')), None)
+            cache.put(cache.key('a'), 'a')
+            self.assertEqual(len(os.listdir(cachedir)), 0)
+            self.assertEqual(cache.evictions, 3)
+            cache.maxsize = 1000000
+            cache.put(cache.key('a'), ('a', u'b'))
+            self.assertEqual(cache.get(cache.key('a')), ('a', u'b'))
+            self.assertEqual(cache.get(cache.key('b')), None)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_regression_context(self):
+        """Check that scripts with different contexts can be processed at
+        the same time in several threads.
+        """
+        sys.stderr.write('\nRunning threaded context tests: ')
+        import threading
+        from lslopt import lsloptimizer
+        lib = lslloadlib.LoadLibrary()
+        options = ('optimize', 'constfold', 'dcr')
+        script = ('default{timer(){llOwnerSay(llList2Key([],0));'
+                  'llOwnerSay((string)(1.0/3));}}')
+        jobs = [
+            (lslcommon.context(), script),
+            (lslcommon.context(LSO=True), script),
+            (lslcommon.context(IsCalc=True), '(string)llList2Key([],0)'),
+        ]
+
+        def Process(ctx, script):
+            ts = lslparse.parser(lib).parse(script, options, ctx=ctx)
+            ts = lsloptimizer.optimizer(lib).optimize(ts, options, ctx=ctx)
+            return lsloutput.outscript().output(ts, options, ctx=ctx)
+
+        expected = [Process(ctx, script) for ctx, script in jobs]
+        self.assertTrue(expected[0] != expected[1])
+        self.assertTrue(u'NULL_KEY' not in expected[0])
+        self.assertTrue('\n' not in expected[2])
+
+        def Thread(i):
+            ctx, script = jobs[i % len(jobs)]
+            for j in xrange(20):
+                results[i].append(Process(ctx, script))
+        threads = [threading.Thread(target=Thread, args=(i,))
+                   for i in xrange(len(jobs) * 2)]
+        results = [[] for t in threads]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in xrange(len(threads)):
+            self.assertEqual(results[i], [expected[i % len(jobs)]] * 20)
+
+        # Warnings can be collected in the context.
+        warnings = []
+        with lslcommon.context(warnings=warnings):
+            lslcommon.warning(u'test')
+        self.assertEqual(warnings, [u'test'])
+
+        # The globals are still in effect when no context is given.
+        self.assertFalse(lslcommon.CurrentContext().LSO)
+        lslcommon.LSO = True
+        try:
+            self.assertEqual(lslfuncs.llList2Key([], 0), lslfuncs.NULL_KEY)
+        finally:
+            lslcommon.LSO = False
+        self.assertEqual(lslfuncs.llList2Key([], 0), u'')
+
+    def test_regression_lexer(self):
+        """Check that GetToken and GetTokenChars return the same tokens and
+        leave the parser in the same state.
+        """
+        import random
+        lib = lslloadlib.LoadLibrary()
+        p = lslparse.parser(lib)
+
+        def Lex(script, options, method):
+            p.parse('default{timer(){}}', options)
+            p.script = script
+            p.length = len(script)
+            p.pos = p.errorpos = 0
+            p.linestart = True
+            p.directives = []
+            lex = getattr(p, method)
+            tokens = []
+            while True:
+                try:
+                    tok = lex()
+                except lslparse.EParse as e:
+                    tokens.append((e.__class__.__name__, p.errorpos))
+                    break
+                tokens.append((tok, p.pos, p.errorpos, p.linestart))
+                if tok == ('EOF',):
+                    break
+            return tokens, p.directives
+
+        optionsets = (
+            (),
+            ('processpre', 'extendedassignment'),
+            ('processpre', 'inline', 'breakcont', 'enableswitch'),
+        )
+        scripts = []
+        for fname in sorted(glob.glob(os.path.join('unit_tests', '*.suite',
+                                                   '*.lsl'))):
+            f = open(fname, 'rb')
+            try:
+                scripts.append(b2str(f.read(), 'utf8'))
+            finally:
+                f.close()
+        fragments = ('a', 'L', '"', '\\', '\n', '\t', ' ', '\r', '/', '*',
+            '#', '0', '0x1F', '12', '4294967296', '.', 'e', '-', '+', 'f',
+            '<', '>', '=', '|', '&', '!', '$', 'n', 't', '\xc3\xa9',
+            'pragma inline', '//', '/*', '*/', '#pragma OPT +breakcont',
+            '#line 3 "x.lsl"', 'integer', 'default', 'state_entry', 'PI',
+            'break', 'quaternion')
+        rnd = random.Random(42)
+        for i in xrange(400):
+            scripts.append(''.join(rnd.choice(fragments)
+                                   for j in xrange(rnd.randint(1, 40))))
+        for script in scripts:
+            for options in optionsets:
+                self.assertEqual(Lex(script, options, 'GetToken'),
+                                 Lex(script, options, 'GetTokenChars'),
+                                 repr(script))
+
+        # The script is lexed once for both passes of the parser; a directive
+        # that changes the keywords must cause the rest to be lexed again.
+        tree, symtab = p.parse('default{timer(){\n#pragma OPT +breakcont\n'
+                               'while(1)break;}}', ('processpre',))
+        self.assertTrue('break' in p.keywords)
+
+    def test_regression_api(self):
+        """Test the interface for other Python programs."""
+        sys.stderr.write('\nRunning API tests: ')
+        from lslopt import lslapi
+        lib = lslapi.Library()
+        self.assertEqual(lib.warnings, [])
+
+        script = ('integer x = (integer)llFrand(3);\n'
+                  'default{timer(){llOwnerSay((string)(x+1+2));}}')
+        res = lslapi.optimize_source(script, None, lib)
+        self.assertTrue(res.ok)
+        # Same as the command line version.
+        self.assertEqual(any2b(res.output, 'utf8'),
+                         invokeMain(['main.py', '-'], str2b(script))[0])
+        self.assertEqual(len(res.warnings), 1)
+        self.assertEqual(res.warnings[0].message,
+            u"Expression in globals doesn't resolve to a simple constant.")
+        self.assertEqual(res.errors, [])
+
+        # Options as changes to the defaults, or as a full set.
+        res = lslapi.optimize_source(script, '-optimize', lib)
+        self.assertTrue(u'1 + 2' in str2u(res.output, 'utf8'))
+        res = lslapi.optimize_source(script,
+            ('optimize', 'constfold', 'extendedglobalexpr'), lib)
+        self.assertTrue(u'3' in str2u(res.output, 'utf8'))
+        self.assertRaises(ValueError, lslapi.optimize_source, script,
+                          '+bogus', lib)
+        self.assertRaises(ValueError, lslapi.optimize_source, script,
+                          ('bogus',), lib)
+
+        # Errors
+        res = lslapi.optimize_source('default{timer(){\nx;}}', None, lib,
+                                     'test.lsl')
+        self.assertFalse(res.ok)
+        self.assertEqual(res.output, None)
+        self.assertEqual(len(res.errors), 1)
+        err = res.errors[0]
+        self.assertEqual((err.severity, err.message, err.line, err.column,
+                          err.filename),
+                         ('error', u'Name not defined within scope', 2, 1,
+                          'test.lsl'))
+        self.assertEqual(str(err),
+            'test.lsl:2:1: error: Name not defined within scope')
+
+        # LSO and expression modes
+        res = lslapi.optimize_source('(string)llList2Key([],0)',
+            ('optimize', 'constfold', 'expr', 'lso'), lib)
+        self.assertEqual(res.output,
+                         '"00000000-0000-0000-0000-000000000000"')
+
+    def test_regression_passes(self):
+        """Test the repeated rounds of dead code removal and folding."""
+        sys.stderr.write('\nRunning pass manager tests: ')
+        # The list can only be folded into the call after the first round.
+        script = str2b('default{timer(){key k = TEXTURE_BLANK;'
+                       ' list L = [k, ""];'
+                       ' llBreakLink(llListFindList(L, (list)k));}}\n')
+        out, err = invokeMain(['main.py', '--pass-stats', '-'], script)
+        self.assertEqual(out, invokeMain(['main.py', '-'], script)[0])
+        self.assertTrue(b'llBreakLink(0);' in out)
+        self.assertTrue(err.startswith(b'Optimizer passes (2 extra rounds)'))
+        self.assertTrue(b'FoldScript' in err)
+        self.assertTrue(b'RemoveDeadCode' in err)
+        self.assertTrue(b'Folded library calls: ' in err)
+        # The result doesn't change when optimized again.
+        self.assertEqual(invokeMain(['main.py', '-'], out)[0], out)
+
+        # No extra rounds without DCR.
+        out, err = invokeMain(['main.py', '--pass-stats', '-O', '-dcr', '-'],
+                              script)
+        self.assertTrue(err.startswith(b'Optimizer passes (0 extra rounds)'))
+        self.assertFalse(b'RemoveDeadCode' in err)
+
+    def test_regression_timings(self):
+        """Test the measurements of the processing phases."""
+        sys.stderr.write('\nRunning timings tests: ')
+        script = str2b('integer f(integer a){return a*2;}\n'
+                       'default{timer(){llSleep(f(1+2));}}\n')
+        out, err = invokeMain(['main.py', '--timings', '-O', '+inline', '-'],
+                              script)
+        self.assertEqual(out, invokeMain(['main.py', '-O', '+inline', '-'],
+                                         script)[0])
+        self.assertTrue(err.startswith(b'Timings:\n'))
+        for phase in (b'\n  Parse ', b'\n    BuildTempGlobalsTable ',
+                      b'\n    ParseScript ', b'\n    Inline ',
+                      b'\n  Optimize ', b'\n    FoldScript ',
+                      b'\n    LastPass ', b'\n  Output '):
+            self.assertTrue(phase in err, phase)
+
+        out, err = invokeMain(['main.py', '--timings-json', '-'], script)
+        phases = json.loads(b2u(err))['phases']
+        names = [rec['name'] for rec in phases]
+        self.assertEqual(names[names.index('Parse'):names.index('Optimize')],
+                         ['Parse', 'BuildTempGlobalsTable', 'ParseScript'])
+        self.assertEqual(names[-1], 'Output')
+        rec = phases[names.index('RemoveDeadCode')]
+        self.assertEqual(rec['depth'], 1)
+        self.assertTrue(rec['nodes_before'] > rec['nodes_after'])
+        self.assertTrue(rec['wall'] >= 0 and rec['cpu'] >= 0)
+        self.assertEqual(phases[names.index('Optimize')]['nodes_after'],
+                         rec['nodes_after'])
+
+        # The phases until the error are reported.
+        out, err = invokeMain(['main.py', '--timings-json', '-'],
+                              b'default{timer(){x;}}')
+        phases = json.loads(b2u(err.split(b'\n')[-2]))['phases']
+        self.assertEqual([rec['name'] for rec in phases
+                          if rec['depth'] == 0][-1], 'Parse')
+        self.assertTrue(all(rec['wall'] is not None for rec in phases))
+
+        # API
+        from lslopt import lslapi
+        lib = lslapi.Library()
+        res = lslapi.optimize_source(script, None, lib, timings=True)
+        self.assertTrue(res.ok)
+        self.assertTrue(res.timings.Report().startswith(u'Timings:\n'))
+        self.assertEqual([rec['name'] for rec in res.timings.phases
+                          if rec['depth'] == 0],
+                         ['Parse', 'Optimize', 'Output'])
+        self.assertEqual(lslapi.optimize_source(script, None, lib).timings,
+                         None)
+
+    def test_regression_structhash(self):
+        """Test the structural hashes used to compare subtrees."""
+        sys.stderr.write('\nRunning structural hash tests: ')
+        from lslopt import lsloptimizer
+        opt = lsloptimizer.optimizer(lslloadlib.LoadLibrary())
+
+        def Ident(name):
+            return nr(nt='IDENT', t='integer', name=name, scope=0, SEF=True)
+
+        def Op(op, a, b):
+            return nr(nt=op, t='integer', ch=[a, b], SEF=True)
+
+        # Balanced trees whose operands are swapped at every level.
+        def Tree(depth, swap, leaves):
+            if depth == 0:
+                return Ident(leaves.pop(0))
+            ch = [Tree(depth - 1, swap, leaves),
+                  Tree(depth - 1, swap, leaves)]
+            if swap:
+                ch.reverse()
+            return Op('*', ch[0], ch[1])
+        names = ['v%d' % i for i in xrange(256)]
+        a = Tree(8, False, list(names))
+        b = Tree(8, True, list(names))
+        self.assertEqual(opt.StructHash(a), opt.StructHash(b))
+        self.assertTrue(opt.CompareTrees(a, b))
+        c = Tree(8, True, names[1:] + names[:1])
+        self.assertNotEqual(opt.StructHash(a), opt.StructHash(c))
+        self.assertFalse(opt.CompareTrees(a, c))
+
+        # Non-commutative operators and string concatenation.
+        x, y = Ident('x'), Ident('y')
+        self.assertNotEqual(opt.StructHash(Op('-', x, y)),
+                            opt.StructHash(Op('-', y, x)))
+        s1 = nr(nt='CONST', t='string', value=u'a', SEF=True)
+        s2 = nr(nt='CONST', t='string', value=u'b', SEF=True)
+        self.assertNotEqual(
+            opt.StructHash(nr(nt='+', t='string', ch=[s1, s2], SEF=True)),
+            opt.StructHash(nr(nt='+', t='string', ch=[s2, s1], SEF=True)))
+
+        # Equivalent constants have the same hash.
+        z1 = nr(nt='CONST', t='float', value=0., SEF=True)
+        z2 = nr(nt='CONST', t='float', value=-0., SEF=True)
+        self.assertTrue(opt.CompareTrees(z1, z2))
+        self.assertEqual(opt.StructHash(Op('*', x, z1)),
+                         opt.StructHash(Op('*', z2, x)))
+
+        # The hashes are kept in the nodes across comparisons, without
+        # creating their instance dicts, and changes are seen after
+        # invalidating.
+        d = Op('*', x, Op('+', y, x))
+        e = Op('*', Op('+', x, y), x)
+        self.assertTrue(opt.CompareTrees(d, e))
+        gen = opt.shashgen
+        self.assertTrue(opt.CompareTrees(d, e))
+        self.assertEqual(opt.shashgen, gen)
+        self.assertEqual(d.shash, (gen, opt.StructHash(e)))
+        self.assertFalse(d.__dict__)
+        d.ch[1].nt = '-'
+        opt.InvalidateHashes()
+        self.assertFalse(opt.CompareTrees(d, e))
+
+        # Folding a node discards its hash, and keeps those of the rest.
+        opt.symtab = [{'x': {'Kind': 'v', 'Type': 'integer', 'Scope': 0},
+                       'y': {'Kind': 'v', 'Type': 'integer', 'Scope': 0}}]
+        opt.globalmode = False
+        d = Op('*', Op('+', y, x), Op('-', x, y))
+        opt.StructHash(d)
+        gen = opt.shashgen
+        opt.FoldTree(d.ch, 1)
+        self.assertEqual(opt.shashgen, gen)
+        self.assertEqual(d.ch[1].shash, None)
+        self.assertEqual(d.ch[0].shash[0], gen)
+
+    def test_regression_deep(self):
+        """Test expressions too deep for a recursive traversal."""
+        sys.stderr.write('\nRunning deep expression tests: ')
+        n = 10000
+        script = str2b('string a; integer i; list L = [%s];\n'
+            'default{timer(){a = llGetTimestamp(); i = llGetUnixTime();\n'
+            'string s = %s;\n'
+            'llSetText(s, <1,1,1>, (float)(%s) + llList2Float(L, 0));}}\n'
+            % (' + '.join(['1'] * n),
+               ' + '.join(['a'] * n),
+               ' + '.join('i * %d - (i ^ %d)' % (k, k) for k in xrange(n))))
+        out, err = invokeMain(['main.py', '-'], script)
+        self.assertEqual(err, b'')
+        self.assertTrue(b' + '.join([b'a'] * n) in out)
+        self.assertTrue(b'i * 9999 + -(i ^ 9999)' in out)
+        self.assertTrue(b'10000' in out)
+        self.assertEqual(invokeMain(['main.py', '-'], out)[0], out)
+        out, err = invokeMain(['main.py', '-O', '+inline,+shrinknames', '-'],
+                              script)
+        self.assertEqual(err, b'')
+        self.assertTrue(out.endswith(b'}\n'))
+
+        # The same long expression twice, under CSE.
+        expr = ' + '.join('llAbs(a + %d)' % k for k in xrange(3000))
+        script = str2b('default{touch_start(integer a){integer x = %s;\n'
+            'integer y = %s; llOwnerSay((string)(x + y));}}\n'
+            % (expr, expr))
+        for opts in ('+cse', 'speed'):
+            out, err = invokeMain(['main.py', '-O', opts, '-'], script)
+            self.assertEqual(err, b'')
+            self.assertTrue(b'integer y = x;' in out)
+
+        # The same long expression on both sides of a comparison.
+        expr = ' + '.join('a * %d' % k for k in xrange(3000))
+        script = str2b('default{touch_start(integer a){'
+                       'if (%s == %s) llOwnerSay("x");}}\n' % (expr, expr))
+        out, err = invokeMain(['main.py', '-'], script)
+        self.assertEqual(err, b'')
+        self.assertTrue(b'llOwnerSay("x");' in out)
+        self.assertFalse(b'if' in out)
+
+        # If statements nested deeper than the recursion limit, both
+        # directly and as an else if chain.
+        n = 1200
+        script = str2b('integer a; default{timer(){a = (integer)llFrand(9);'
+                       '%sllOwnerSay("x"); else llOwnerSay("y");}}\n'
+                       % ('if(a) ' * n))
+        for opts in ('+inline', '-optimize'):
+            out, err = invokeMain(['main.py', '-O', opts, '-'], script)
+            self.assertEqual(err, b'')
+            self.assertEqual(out.count(b'if (a)'), n)
+            self.assertTrue(b'else\n' in out)
+        script = str2b('integer a; default{timer(){a = (integer)llFrand(9);'
+                       '%s llOwnerSay("-");}}\n'
+                       % ' else '.join('if (a == %d) llOwnerSay("%d");'
+                                       % (k, k) for k in xrange(n)))
+        out, err = invokeMain(['main.py', '-'], script)
+        self.assertEqual(err, b'')
+        self.assertTrue(b'llOwnerSay("1199");' in out)
+        self.assertTrue(b'llOwnerSay("-");' in out)
+
+        # Statements nested deeper than a traversal step, with the
+        # expression lists of a FOR at a multiple of the step.
+        script = str2b('integer a; default{timer(){%s'
+            'for(a=0;a<1;a++) llOwnerSay((string)a);}}\n' % ('if(a) ' * 62))
+        out, err = invokeMain(['main.py', '-'], script)
+        self.assertEqual(err, b'')
+        self.assertTrue(b'for (a = 0; a < 1; ++a)' in out)
+
+    def test_regression_foldmemo(self):
+        """Test the memo of folded library calls."""
+        sys.stderr.write('\nRunning fold memo tests: ')
+        from lslopt import lsloptimizer
+        opt = lsloptimizer.optimizer(lslloadlib.LoadLibrary())
+        opt.ctx = lslcommon.GlobalContext
+        opt.CurEvent = None
+        calls = []
+        def fn(*args):
+            calls.append(args)
+            if args[0] == 0:
+                raise lslfuncs.ELSLCantCompute()
+            return list(args)
+
+        # Lists are returned as copies, and the sign of zero counts.
+        a = opt.CallLibFunc('f', fn, [1, [2., u'x']], False)
+        a.append(3)
+        b = opt.CallLibFunc('f', fn, [1, [2., u'x']], False)
+        self.assertEqual(b, [1, [2., u'x']])
+        self.assertEqual(len(calls), 1)
+        opt.CallLibFunc('f', fn, [1, [-0., u'x']], False)
+        opt.CallLibFunc('f', fn, [1, [0., u'x']], False)
+        opt.CallLibFunc('f', fn, [1, [Key(u'x')]], False)
+        opt.CallLibFunc('f', fn, [1, [u'x']], False)
+        self.assertEqual(len(calls), 5)
+
+        # Failures are remembered too.
+        for i in xrange(2):
+            self.assertRaises(lslfuncs.ELSLCantCompute,
+                              opt.CallLibFunc, 'f', fn, [0], False)
+        self.assertEqual(len(calls), 6)
+        self.assertEqual((opt.foldcalls, opt.foldhits), (8, 2))
+
+        # Unstable functions are always called.
+        opt.CallLibFunc('f', fn, [1], False, True)
+        self.assertEqual(len(calls), 7)
+        self.assertEqual((opt.foldcalls, opt.foldhits), (9, 2))
+
+        # The least recently used entries are discarded.
+        opt.FoldMemoSize = 4
+        opt.foldmemo = None
+        for i in (1, 2, 3, 4, 1, 5, 1, 2):
+            opt.CallLibFunc('f', fn, [i], False)
+        self.assertEqual([args[0] for args in calls[7:]], [1, 2, 3, 4, 5, 2])
+
+    def test_regression_listsort(self):
+        """Test llListSort against the reference exchange sort."""
+        sys.stderr.write('\nRunning list sort tests: ')
+        import random
+        from lslopt.lslcommon import Vector, Quaternion
+        rnd = random.Random(42)
+        nan = float('nan')
+        elems = {
+            'integer': lambda: rnd.randint(-5, 5),
+            'float': lambda: rnd.choice((-1.5, -0., 0., 0.5, 2., 1e38,
+                float('inf'), float('-inf'), nan, rnd.uniform(-9, 9))),
+            'string': lambda: rnd.choice((u'', u'a', u'b', u'ab', u'\xe1',
+                u'\ufb01', u'\U0001d41a', u'B')) + rnd.choice(u'xy'),
+            'key': lambda: Key(rnd.choice((u'k', u'K', u'kk', u'\xe1'))),
+            'vector': lambda: Vector(tuple(rnd.choice((0., -0., 1., -2., 3.,
+                nan, rnd.uniform(-9, 9))) for i in xrange(3))),
+            'rotation': lambda: Quaternion((rnd.uniform(-1, 1), 0., 0., 1.)),
+        }
+        types = sorted(elems)
+        fast = 0
+        for test in xrange(3000):
+            stride = rnd.choice((1, 1, 1, 2, 3, 0, -1))
+            asc = rnd.choice((1, 0, -1, 2))
+            n = rnd.randint(0, 12) * max(stride, 1) + (test % 50 == 0)
+            kinds = rnd.sample(types, rnd.choice((1, 1, 1, 2)))
+            if rnd.random() < .5:
+                # Avoid special values and ties, to test the fast path.
+                lst = rnd.sample(xrange(1000), n)
+                if kinds[0] in ('float', 'vector'):
+                    lst = [Vector((lslfuncs.F32(i / 8.), 1., 0.))
+                           if kinds[0] == 'vector' else lslfuncs.F32(i / 8.)
+                           for i in lst]
+                elif kinds[0] in ('string', 'key'):
+                    lst = [(Key if kinds[0] == 'key' else unicode)(
+                           u'%03d\U0001d41a' % i) for i in lst]
+            else:
+                lst = [elems[rnd.choice(kinds)]() for i in xrange(n)]
+            for LSO in (False, True):
+                with lslcommon.context(LSO=LSO):
+                    if (stride < 1 or n % stride == 0) and \
+                       lslfuncs.InternalListSortKeys(lst, max(stride, 1)) \
+                       is not None:
+                        fast += 1
+                    got = lslfuncs.llListSort(lst, stride, asc)
+                    ref = lslfuncs.InternalListSortExchange(lst[:],
+                        max(stride, 1), asc) if n % max(stride, 1) == 0 \
+                        else lst
+                self.assertEqual(repr(got), repr(ref),
+                                 (lst, stride, asc, LSO))
+        # Make sure both paths have been tested.
+        self.assertTrue(1000 < fast < 5000, fast)
+
+    def test_regression_listfind(self):
+        """Test llListFindList against a plain search."""
+        sys.stderr.write('\nRunning list search tests: ')
+        import random
+        from lslopt.lslcommon import Vector, Quaternion
+        rnd = random.Random(42)
+        nan = float('nan')
+        values = [1, 0, 1., 0., -0., nan, u'1', u'', Key(u'1'), Key(u''),
+                  Vector((1., 0., 0.)), Vector((1., -0., 0.)),
+                  Vector((nan, 0., 0.)), Quaternion((0., 0., 0., 1.)),
+                  Quaternion((0., 0., 0., nan))]
+
+        def Equal(a, b):
+            if type(a) != type(b):
+                return False
+            if type(a) == float:
+                return a == b or math.isnan(a) and math.isnan(b)
+            if type(a) in (Vector, Quaternion):
+                return all(x == y for x, y in zip(a, b))
+            return a == b
+
+        for test in xrange(3000):
+            lst = [rnd.choice(values[:rnd.randint(1, len(values))])
+                   for i in xrange(rnd.randint(0, 12))]
+            if lst and rnd.random() < .5:
+                i = rnd.randint(0, len(lst) - 1)
+                elems = lst[i:rnd.randint(i + 1, len(lst))]
+            else:
+                elems = [rnd.choice(values) for i in xrange(rnd.randint(1, 3))]
+            expect = -1
+            for i in xrange(len(lst) - len(elems) + 1):
+                if all(Equal(a, b) for a, b in zip(lst[i:], elems)):
+                    expect = i
+                    break
+            self.assertEqual(lslfuncs.llListFindList(lst, elems), expect,
+                             (lst, elems))
+
+    def test_regression_parsestring(self):
+        """Test llParseString2List against a plain regex split."""
+        sys.stderr.write('\nRunning string parsing tests: ')
+        import random
+        rnd = random.Random(42)
+        pieces = [u'', u'a', u'b', u'ab', u'ba', u'.', u'|', u'(', u'\\',
+                  u'\xe1', Key(u'b')]
+
+        def Split(s, exc, inc, KeepNulls):
+            if s == u'' and KeepNulls:
+                return [s]
+            exc = exc[:8]
+            inc = inc[:8]
+            regex = u'|'.join(re.escape(i) for i in exc + inc if i != u'')
+            split = re.split(u'(' + regex + u')', s) if regex else [s]
+            return [i for i in split
+                    if (KeepNulls or i != u'') and i not in exc]
+
+        for test in xrange(3000):
+            s = u''.join(rnd.choice(u'aab.|(\\\xe1')
+                         for i in xrange(rnd.randint(0, 12)))
+            exc = [rnd.choice(pieces) for i in xrange(rnd.randint(0, 10))]
+            inc = [rnd.choice(pieces) for i in xrange(rnd.randint(0, 10))]
+            for KeepNulls in (False, True):
+                self.assertEqual(
+                    lslfuncs.llParseString2List(s, exc, inc, KeepNulls),
+                    Split(s, exc, inc, KeepNulls), (s, exc, inc, KeepNulls))
+        self.assertEqual(len(lslfuncs.ParseCache), lslfuncs.ParseCacheSize)
+
+        # Only 8 separators and 8 spacers count.
+        self.assertEqual(lslfuncs.llParseString2List(u'0123456789',
+            [u'9', u'0', u'1', u'2', u'3', u'4', u'5', u'6', u'7'],
+            [u'8']), [u'7', u'8'])
+        self.assertEqual(lslfuncs.llParseStringKeepNulls(u'0123456789',
+            [u'0', u'', u'', u'', u'', u'', u'', u'', u'1'],
+            [u'', u'', u'', u'', u'', u'', u'', u'2', u'3']),
+            [u'1', u'2', u'3456789'])
+        self.assertEqual(lslfuncs.llParseStringKeepNulls(u'', [u'a'], []),
+                         [u''])
+        self.assertRaises(lslfuncs.ELSLCantCompute,
+            lslfuncs.llParseString2List, u'a1b', [1], [])
+
+    def test_regression_f32(self):
+        """Test F32 and S32 against ctypes and plain arithmetic."""
+        sys.stderr.write('\nRunning F32/S32 tests: ')
+        import random
+        from ctypes import c_float
+        from lslopt.lslcommon import Vector, Quaternion
+        rnd = random.Random(42)
+        inf = float('inf')
+        floats = [0., -0., 1e39, -1e39, 3.4028235677973366e38,
+                  -3.4028235677973362e38, 3.4028234663852886e38, inf, -inf,
+                  lslfuncs.NaN, lslfuncs.Indet, 1e-46, -1e-46,
+                  7.006492321624087e-46, 1.401298464324817e-45, 5, -7]
+        floats += [math.ldexp(rnd.uniform(-1, 1), rnd.randint(-160, 140))
+                   for i in xrange(5000)]
+
+        def Bits(f):
+            return repr(f), math.copysign(1, f)
+
+        ref = [Bits(c_float(f).value) for f in floats]
+        self.assertEqual([Bits(lslfuncs.F32(f)) for f in floats], ref)
+        self.assertEqual([Bits(f) for f in lslfuncs.F32List(floats)], ref)
+        self.assertEqual(lslfuncs.F32(1.1, False), 1.1)
+        for i in xrange(0, len(floats) - 4, 4):
+            v = lslfuncs.F32(Vector(floats[i:i+3]))
+            self.assertEqual(type(v), Vector)
+            self.assertEqual([Bits(f) for f in v], ref[i:i+3])
+            q = lslfuncs.F32(Quaternion(floats[i:i+4]))
+            self.assertEqual(type(q), Quaternion)
+            self.assertEqual([Bits(f) for f in q], ref[i:i+4])
+        self.assertRaises(TypeError, lslfuncs.F32, u'1')
+
+        for i in [0, 1, -1, 2147483647, 2147483648, -2147483648, -2147483649,
+                  4294967296, 3.7, True] + [rnd.randint(-2**40, 2**40)
+                                            for i in xrange(1000)]:
+            expect = int(i) & 0xFFFFFFFF
+            if expect >= 2147483648:
+                expect -= 4294967296
+            self.assertEqual(lslfuncs.S32(i), expect)
+            self.assertEqual(type(lslfuncs.S32(i)), int)
+
+    def test_regression_f2smemo(self):
+        """Test the memo of f2s and vr2s."""
+        sys.stderr.write('\nRunning f2s memo tests: ')
+        from lslopt import lslbasefuncs
+        from lslopt.lslcommon import Vector, Quaternion
+        lslbasefuncs.F2SMemo.clear()
+        v = Vector((1.5, -0., .25))
+        self.assertEqual(lslfuncs.vr2s(v), u'<1.500000, -0.000000, 0.250000>')
+        self.assertEqual(lslfuncs.vr2s(Vector((1.5, 0., .25))),
+                         u'<1.500000, 0.000000, 0.250000>')
+        self.assertEqual(lslfuncs.vr2s(v, 5), u'<1.50000, -0.00000, 0.25000>')
+        self.assertEqual(lslfuncs.vr2s(Quaternion((1.5, -0., 1e-7, 1.))),
+                         u'<1.500000, -0.000000, 0.000000, 1.000000>')
+        self.assertEqual(lslfuncs.f2s(-1e-7), u'0.000000')
+        self.assertEqual(lslfuncs.f2s(123456789.), u'123456800.000000')
+        with lslcommon.context(LSO=True):
+            self.assertEqual(lslfuncs.vr2s(Vector((1e-7, 0., 0.))),
+                             u'<0.000000, 0.000000, 0.000000>')
+            self.assertEqual(lslfuncs.f2s(123456789.), u'123456789.000000')
+            self.assertEqual(lslfuncs.vr2s(Vector((123456789., 0., 0.))),
+                             u'<123456789.000000, 0.000000, 0.000000>')
+        self.assertEqual(lslfuncs.vr2s(Vector((123456789., 0., 0.))),
+                         u'<123456800.000000, 0.000000, 0.000000>')
+
+        # It's emptied when full.
+        size = lslbasefuncs.F2SMemoSize
+        lslbasefuncs.F2SMemoSize = 4
+        try:
+            for i in xrange(10):
+                self.assertEqual(lslfuncs.f2s(i + .5), u'%d.500000' % i)
+                self.assertTrue(len(lslbasefuncs.F2SMemo) <= 4)
+        finally:
+            lslbasefuncs.F2SMemoSize = size
+
 class UnitTestCoverage(UnitTestCase):
     def test_coverage_misc(self):
         """Miscellaneous tests that can't be computed or are too difficult